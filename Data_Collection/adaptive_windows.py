@@ -0,0 +1,177 @@
+"""Collect the events of a time range in windows sized to the event rate.
+
+A window whose first page is not its last is not followed page by page. The order of the
+page tells which end of the window it covers: newest first (the OpenSea API), it holds
+every event from its oldest second to the end of the window; oldest first, every event from
+the start to its newest second. The rest of the window is split in two halves that are
+collected in parallel. Windows at the minimum size, and pages whose order cannot be told,
+follow the cursor. The length of new windows follows the event rate seen so far, so quiet
+periods are covered by few long windows and busy ones by many short ones.
+"""
+from collections import namedtuple
+from concurrent.futures import wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+
+# Events per page requested from the API
+PAGE_LIMIT = 300
+
+# Window lengths: the first window, and the bounds for the adaptive ones
+INITIAL_WINDOW = timedelta(minutes=60)
+MIN_WINDOW = timedelta(minutes=1)
+MAX_WINDOW = timedelta(days=1)
+
+# New windows are sized to hold this fraction of a page at the observed event rate
+TARGET_FILL = 0.8
+
+# Weight of the latest window in the event rate estimate
+RATE_SMOOTHING = 0.5
+
+# Outcome of one request: the records, the part of the window they cover completely, and the
+# part still to collect (None when done) with the ids of the events at the boundary between
+# the two, which the remainder may repeat
+WindowResult = namedtuple('WindowResult', ['records', 'covered', 'remainder', 'boundary_ids'])
+
+
+def event_time(record, tzinfo=None):
+    # event_time is ISO 8601 in UTC, e.g. 2022-04-20T21:03:12.123456
+    try:
+        return datetime.strptime(str(record.get('event_time'))[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=tzinfo)
+    except ValueError:
+        return None
+
+
+class WindowSizer:
+    """Length of the next window from a smoothed estimate of events per second.
+
+    Windows finish out of order; only those later than every window observed so far update
+    the estimate, so that new windows are sized by the most recent part of the range.
+    """
+
+    def __init__(self, initial=INITIAL_WINDOW, min_window=MIN_WINDOW, max_window=MAX_WINDOW, limit=PAGE_LIMIT):
+        self.initial = initial
+        self.min_window = min_window
+        self.max_window = max_window
+        self.limit = limit
+        self.rate = None
+        self.latest_end = None
+
+    def observe(self, events, start, end):
+        if self.latest_end is not None and end <= self.latest_end:
+            return
+        self.latest_end = end
+        rate = events / max((end - start).total_seconds(), 1.0)
+        self.rate = rate if self.rate is None else RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self.rate
+
+    def next_length(self):
+        if self.rate is None:
+            return self.initial
+        if self.rate == 0:
+            return self.max_window
+        length = timedelta(seconds=TARGET_FILL * self.limit / self.rate)
+        return max(self.min_window, min(self.max_window, length))
+
+
+class AdaptiveWindows:
+    """Collect [start, end) with fetch_page(start, end), which returns the parsed records of
+    the first page of a window and the cursor of the next page (None if it was the last), and
+    fetch_all(start, end, cursor=None), which follows the cursor through the rest of a window
+    (all of it without a cursor).
+
+    collect() yields (window_start, window_end, records) in chronological order of the
+    windows, collecting them concurrently on an executor.
+    """
+
+    def __init__(self, fetch_page, fetch_all, sizer=None, min_window=MIN_WINDOW):
+        self.fetch_page = fetch_page
+        self.fetch_all = fetch_all
+        self.sizer = sizer or WindowSizer(min_window=min_window)
+        self.min_window = min_window
+        self.windows_collected = 0
+        self.splits = 0
+
+    def windows(self, start, end):
+        # Consecutive windows covering [start, end), each sized when it is needed
+        while start < end:
+            window_end = min(start + self.sizer.next_length(), end)
+            yield start, window_end
+            start = window_end
+
+    def collect_window(self, start, end):
+        if end - start <= self.min_window:
+            return WindowResult(self.fetch_all(start, end), (start, end), None, ())
+        records, cursor = self.fetch_page(start, end)
+        if cursor is None:
+            return WindowResult(records, (start, end), None, ())
+        times = [event_time(record, start.tzinfo) for record in records]
+        if not times or None in times or times[0] == times[-1]:
+            # Cannot tell which part of the window the page covers; follow the cursor from this page
+            return WindowResult(records + self.fetch_all(start, end, cursor), (start, end), None, ())
+        if times[0] > times[-1]:
+            # Newest first: the page holds every event after its oldest second
+            edge = min(times)
+            remainder, covered = (start, edge + timedelta(seconds=1)), (edge + timedelta(seconds=1), end)
+        else:
+            # Oldest first: the page holds every event before its newest second
+            edge = max(times)
+            remainder, covered = (edge, end), (start, edge)
+        if not start <= remainder[0] < remainder[1] <= end or remainder[1] - remainder[0] >= end - start:
+            # Events at or beyond the ends of the window; the page does not tell what is left
+            return WindowResult(records + self.fetch_all(start, end, cursor), (start, end), None, ())
+        # The API may have more events in the edge second than the page holds
+        boundary_ids = {record['event_id'] for record, t in zip(records, times) if t == edge}
+        return WindowResult(records, covered, remainder, boundary_ids)
+
+    def split(self, start, end):
+        # The older half first, so that the windows stay in chronological order
+        if end - start <= self.min_window:
+            return [(start, end)]
+        middle = start + (end - start) / 2
+        return [(start, middle), (middle, end)]
+
+    def collect(self, start, end, executor, workers):
+        # Entries in output order: [window, future, boundary_ids, records]. A completed window
+        # with a remainder is replaced by the halves of the remainder and the part it collected.
+        # New windows start while fewer than 2 * workers entries are pending, so out-of-order
+        # results never pile up in memory; the halves of split windows always start.
+        windows = self.windows(start, end)
+        entries = []
+        exhausted = False
+        while entries or not exhausted:
+            while not exhausted and len(entries) < 2 * workers:
+                window = next(windows, None)
+                if window is None:
+                    exhausted = True
+                    break
+                entries.append(self._submit(executor, window))
+
+            running = [entry[1] for entry in entries if entry[3] is None]
+            if running:
+                wait(running, return_when=FIRST_COMPLETED)
+            expanded = []
+            for entry in entries:
+                if entry[3] is not None or not entry[1].done():
+                    expanded.append(entry)
+                else:
+                    expanded.extend(self._complete(executor, *entry[:3]))
+            entries = expanded
+
+            while entries and entries[0][3] is not None:
+                (window_start, window_end), _, _, records = entries.pop(0)
+                yield window_start, window_end, records
+
+    def _submit(self, executor, window, boundary_ids=()):
+        # boundary_ids are events the parent window already collected that this one may repeat
+        self.windows_collected += 1
+        return [window, executor.submit(self.collect_window, *window), boundary_ids, None]
+
+    def _complete(self, executor, window, future, boundary_ids):
+        result = future.result()
+        records = [record for record in result.records if record['event_id'] not in boundary_ids]
+        self.sizer.observe(len(records), *result.covered)
+        collected = [result.covered, future, boundary_ids, records]
+        if result.remainder is None:
+            return [collected]
+        self.splits += 1
+        halves = [self._submit(executor, half, set(boundary_ids) | result.boundary_ids)
+                  for half in self.split(*result.remainder)]
+        return [collected] + halves if result.covered[0] < result.remainder[0] else halves + [collected]
@@ -0,0 +1,135 @@
+"""Columnar output for the collectors: parse_event records written as Parquet files under
+
+    <root>/chain_identifier=<chain>/event_date=<YYYY-MM-DD>/part-*.parquet
+
+so that reads by chain or day only open the matching directories. Collection fields are
+dictionary encoded, and an event_id already in the dataset (overlapping windows, a restarted
+run) is dropped at write time.
+"""
+import os
+import time
+import uuid
+from collections import defaultdict
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Records buffered before they are written, one file per partition
+DEFAULT_BATCH_SIZE = 10000
+
+# Columns repeated across the events of a collection or contract; stored with a dictionary
+DICTIONARY_COLUMNS = [
+    'asset_contract_type', 'schema_name', 'symbol',
+    'collection_slug', 'collection_name', 'collection_url', 'collection_created_date', 'featured',
+    'featured_image_url', 'safelist_request_status', 'is_nsfw', 'hidden', 'seller_fee',
+    'collection_discord_url',
+]
+
+# Partition value of records without a chain or event time
+UNKNOWN_PARTITION = 'unknown'
+
+PARTITIONING = ds.partitioning(pa.schema([('chain_identifier', pa.string()), ('event_date', pa.string())]), flavor='hive')
+
+
+def partition_of(record):
+    chain = str(record.get('chain_identifier') or UNKNOWN_PARTITION).replace('/', '_')
+    # event_time is ISO 8601, e.g. 2022-04-20T21:03:12.123456
+    day = str(record.get('event_time') or '')[:10] or UNKNOWN_PARTITION
+    return chain, day
+
+
+def load_event_ids(root):
+    # event_ids already written under root; only that column is read
+    if not os.path.isdir(root):
+        return set()
+    table = ds.dataset(root, format='parquet', partitioning=PARTITIONING).to_table(columns=['event_id'])
+    return set(table.column('event_id').drop_null().to_pylist())
+
+
+def read_events(root, columns=None, chain=None, start_date=None, end_date=None):
+    """Read the events under root into a DataFrame, opening only the partitions of chain and
+    of the days from start_date through end_date ('YYYY-MM-DD') when these are given."""
+    dataset = ds.dataset(root, format='parquet', partitioning=PARTITIONING)
+    conditions = []
+    if chain is not None:
+        conditions.append(ds.field('chain_identifier') == chain)
+    if start_date is not None:
+        conditions.append(ds.field('event_date') >= start_date)
+    if end_date is not None:
+        conditions.append(ds.field('event_date') <= end_date)
+    condition = None
+    for part in conditions:
+        condition = part if condition is None else condition & part
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+
+class ParquetSink:
+    """Write records with the given fieldnames to a partitioned Parquet dataset at root.
+
+    writerows() buffers records and writes them once batch_size are buffered; close() writes
+    the rest. pending is the number of buffered records, 0 right after they were written.
+    Each file is written under a temporary name and renamed, so a crash never leaves a
+    partial file behind.
+    """
+
+    def __init__(self, root, fieldnames, batch_size=DEFAULT_BATCH_SIZE):
+        self.root = root
+        self.fieldnames = [name for name in fieldnames if name != 'chain_identifier']
+        self.batch_size = batch_size
+        self.seen = load_event_ids(root)
+        self.duplicates = 0
+        self.pending = 0
+        self._partitions = defaultdict(list)
+        self.schema = pa.schema([
+            (name, pa.dictionary(pa.int32(), pa.string()) if name in DICTIONARY_COLUMNS else pa.string())
+            for name in self.fieldnames])
+
+    def writerows(self, records):
+        # Buffer records whose event_id is new and return how many those were
+        written = 0
+        for record in records:
+            event_id = record.get('event_id')
+            if event_id not in (None, ''):
+                event_id = str(event_id)
+                if event_id in self.seen:
+                    self.duplicates += 1
+                    continue
+                self.seen.add(event_id)
+            self._partitions[partition_of(record)].append(record)
+            written += 1
+        self.pending += written
+        if self.pending >= self.batch_size:
+            self.flush()
+        return written
+
+    def writerow(self, record):
+        return self.writerows([record])
+
+    def flush(self):
+        for (chain, day), records in self._partitions.items():
+            directory = os.path.join(self.root, f"chain_identifier={chain}", f"event_date={day}")
+            os.makedirs(directory, exist_ok=True)
+            name = f"part-{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}.parquet"
+            # Readers skip files whose names start with '.'
+            temp_path = os.path.join(directory, f".{name}.tmp")
+            pq.write_table(self._table(records), temp_path, compression='zstd', use_dictionary=DICTIONARY_COLUMNS)
+            os.replace(temp_path, os.path.join(directory, name))
+        self._partitions.clear()
+        self.pending = 0
+
+    def _table(self, records):
+        columns = []
+        for field in self.schema:
+            values = pa.array([None if record.get(field.name) is None else str(record.get(field.name))
+                               for record in records], type=pa.string())
+            columns.append(values.dictionary_encode() if pa.types.is_dictionary(field.type) else values)
+        return pa.Table.from_arrays(columns, schema=self.schema)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -1,9 +1,14 @@
 import argparse
 import csv
+import json
+import os
 from datetime import datetime, timezone
 import requests
 import sys
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from rate_limiter import configure_rate_limiter, get_rate_limiter
+from adaptive_windows import AdaptiveWindows, PAGE_LIMIT
 
 try:
     import api_key
@@ -13,9 +18,11 @@ except:
 if (api_key.OPENSEA_APIKEY == ''):
     sys.exit('OPENSEA_APIKEY is empty in api_key.py')
 
+OPENSEA_API_ENDPOINT = "https://api.opensea.io/api/v1/events"
 
-def get_events(start_date, end_date, cursor='', event_type='successful', **kwargs):
-    url = "https://api.opensea.io/api/v1/events"
+
+def get_events(start_date, end_date, cursor='', event_type='successful', max_throttle_retries=5, **kwargs):
+    url = OPENSEA_API_ENDPOINT
     query = {"only_opensea": "false",
              "occurred_before": end_date,
              "occurred_after": start_date,
@@ -28,7 +35,17 @@ def get_events(start_date, end_date, cursor='', event_type='successful', **kwarg
         "Accept": "application/json",
         "X-API-KEY": api_key.OPENSEA_APIKEY
     }
-    response = requests.request("GET", url, headers=headers, params=query)
+    # The rate limiter paces requests to the API and backs off on 429/503 responses
+    rate_limiter = get_rate_limiter()
+    for attempt in range(max_throttle_retries + 1):
+        rate_limiter.acquire(url)
+        response = requests.request("GET", url, headers=headers, params=query)
+        if not rate_limiter.feedback(url, response.status_code, response.headers):
+            break
+    else:
+        # Every attempt was throttled; the body is not an events page
+        raise requests.HTTPError(f"OpenSea API still throttling (HTTP {response.status_code}) after "
+                                 f"{max_throttle_retries + 1} attempts", response=response)
 
     return response.json()
 # Define the function to parse the event data
@@ -81,9 +98,10 @@ def parse_event(event):
     return record
 
 
-def fetch_all_events(start_date, end_date, pause=1, **kwargs):
+def fetch_all_events(start_date, end_date, cursor='', **kwargs):
+    # Follows the cursor from the given page, from the first one by default
     result = list()
-    next = ''
+    next = cursor
     fetch = True
 
     print(f"Fetching events between {start_date} and {end_date}")
@@ -107,11 +125,167 @@ def fetch_all_events(start_date, end_date, pause=1, **kwargs):
             print(response)
             fetch = False  # Exit the loop since there's an issue with the API response
 
-        sleep(pause)
+    return result
+
+
+def fetch_events_adaptive(start_date, end_date, workers=8, **kwargs):
+    """Fetch all events between start_date and end_date in windows sized to the event rate,
+    collected concurrently by workers threads (see adaptive_windows)."""
+    def fetch_page(start, end):
+        response = get_events(int(start.timestamp()), int(end.timestamp()), limit=PAGE_LIMIT, **kwargs)
+        if 'asset_events' not in response:
+            # Print the response to debug the issue
+            print("Unexpected response format:")
+            print(response)
+            return [], None
+        records = [record for record in map(parse_event, response['asset_events']) if record is not None]
+        return records, response['next']
+
+    def fetch_window(start, end, cursor=None):
+        # Continues from the page fetch_page already fetched when given its cursor
+        return fetch_all_events(start, end, cursor=cursor or '', limit=PAGE_LIMIT, **kwargs)
 
+    result = []
+    windows = AdaptiveWindows(fetch_page, fetch_window)
+    print(f"Fetching events between {start_date} and {end_date}")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for window_start, window_end, records in windows.collect(start_date, end_date, executor, workers):
+            result.extend(records)
+    print(f"Collected {len(result)} events in {windows.windows_collected} windows ({windows.splits} split)")
     return result
 
 
+FIELDNAMES = [
+    'asset_id', 'asset_name', 'asset_token_id', 'asset_contract_date',
+    'asset_contract_address', 'chain_identifier', 'asset_contract_type',
+    'owner', 'schema_name', 'symbol', 'external_link',
+    'asset_url', 'asset_img_url', 'animation_url', 'asset_img_org_url',
+    'animation_org_url', 'collection_slug', 'collection_name', 'collection_url',
+    'collection_created_date', 'featured', 'featured_image_url',
+    'safelist_request_status', 'is_nsfw', 'hidden', 'seller_fee',
+    'token_metadata', 'collection_discord_url', 'event_id', 'event_time',
+    'event_contract_address'
+]
+
+
+def load_checkpoint(checkpoint_path):
+    try:
+        with open(checkpoint_path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(checkpoint, checkpoint_path):
+    # Write to a temporary file and rename it, so the checkpoint is never left half written
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, mode='w', encoding='utf-8') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, checkpoint_path)
+
+
+def stream_events(start_date, end_date, filename, checkpoint_path, file_format='csv', **kwargs):
+    """Fetch events page by page, appending each page to filename as it arrives.
+
+    After every page the output is fsynced and the next cursor, the time window and the
+    output size are saved to checkpoint_path. A restart with the same window truncates the
+    output to the last checkpointed size and continues from the saved cursor, so a page is
+    never written twice. Event ids of the last written page are kept in the checkpoint as
+    well and skipped if the API returns them again.
+
+    With file_format='parquet', filename is a partitioned Parquet dataset (see parquet_sink)
+    that is written in batches of pages. The checkpoint only advances once a batch is written;
+    pages fetched again after a restart are dropped by the sink's event_id dedupe.
+
+    Returns the number of events written and whether the whole window was collected; it is
+    not when the API stopped with an unexpected response.
+    """
+    start_ts, end_ts = int(start_date.timestamp()), int(end_date.timestamp())
+    checkpoint = load_checkpoint(checkpoint_path)
+
+    if checkpoint is not None:
+        if (checkpoint['start'], checkpoint['end']) != (start_ts, end_ts):
+            sys.exit(f"Checkpoint {checkpoint_path} is for a different time window "
+                     f"({datetime.fromtimestamp(checkpoint['start'], timezone.utc)} - "
+                     f"{datetime.fromtimestamp(checkpoint['end'], timezone.utc)}). Remove it to start over.")
+        if checkpoint['done']:
+            print(f"Events between {start_date} and {end_date} already collected in {filename}")
+            return checkpoint['records'], True
+        print(f"Resuming after page {checkpoint['pages']} ({checkpoint['records']} events)")
+        if file_format == 'parquet':
+            output = open_parquet_sink(filename)
+        else:
+            with open(filename, mode='r+b') as f:
+                f.truncate(checkpoint['offset'])
+            output = open(filename, mode='a', encoding='utf-8', newline='\n')
+            writer = csv.DictWriter(output, fieldnames=FIELDNAMES)
+    else:
+        checkpoint = {'start': start_ts, 'end': end_ts, 'cursor': '', 'offset': 0, 'pages': 0,
+                      'records': 0, 'last_page_event_ids': [], 'done': False}
+        if file_format == 'parquet':
+            output = open_parquet_sink(filename)
+        else:
+            output = open(filename, mode='w', encoding='utf-8', newline='\n')
+            writer = csv.DictWriter(output, fieldnames=FIELDNAMES)
+            writer.writeheader()
+
+    print(f"Fetching events between {start_date} and {end_date}")
+    with output:
+        while not checkpoint['done']:
+            response = get_events(start_ts, end_ts, cursor=checkpoint['cursor'], **kwargs)
+
+            if 'asset_events' not in response:
+                # Print the response to debug the issue; the checkpoint allows retrying this page later
+                print("Unexpected response format:")
+                print(response)
+                break
+
+            previous_ids = set(checkpoint['last_page_event_ids'])
+            page = []
+            for event in response['asset_events']:
+                record = parse_event(event)
+                if record is None or record['event_id'] in previous_ids:
+                    continue
+                page.append(record)
+            page_ids = [record['event_id'] for record in page]
+
+            if file_format == 'parquet':
+                written = output.writerows(page)
+            else:
+                writer.writerows(page)
+                written = len(page)
+                output.flush()
+                os.fsync(output.fileno())
+                checkpoint['offset'] = output.tell()
+            checkpoint.update({
+                'cursor': response['next'],
+                'pages': checkpoint['pages'] + 1,
+                'records': checkpoint['records'] + written,
+                'last_page_event_ids': page_ids or checkpoint['last_page_event_ids'],
+                'done': response['next'] is None,
+            })
+            if file_format == 'parquet':
+                if not checkpoint['done'] and output.pending:
+                    continue
+                output.flush()
+            save_checkpoint(checkpoint, checkpoint_path)
+
+    return checkpoint['records'], checkpoint['done']
+
+
+def open_parquet_sink(path):
+    # pyarrow is only needed for --format parquet
+    from parquet_sink import ParquetSink
+    return ParquetSink(path, FIELDNAMES)
+
+
+def write_parquet(data, path):
+    with open_parquet_sink(path) as sink:
+        return sink.writerows(data)
+
+
 def write_csv(data, filename):
     with open(filename, mode='w', encoding='utf-8', newline='\n') as csv_file:
         writer = csv.DictWriter(csv_file, fieldnames=data[0].keys())
@@ -147,15 +321,54 @@ def main():
                         type=valid_datetime)
     parser.add_argument('-e', "--enddate", help="The End Date (YYYY-MM-DD or YYYY-MM-DD HH:mm)", required=True,
                         type=valid_datetime)
-    parser.add_argument('-p', '--pause', help='Seconds to wait between http requests. Default: 1', required=False,
+    parser.add_argument('-p', '--pause', help='Initial seconds between http requests, 0 to start at --max_rate. The '
+                        'pace then adapts to the API: faster while it responds normally, slower on 429/503. '
+                        'Default: 1', required=False,
                         default=1, type=float)
-    parser.add_argument('-o', '--outfile', help='Output file path for saving nft sales record in csv format',
-                        required=False, default='./20november.csv', type=str)
+    parser.add_argument('--max_rate', help='Maximum http requests per second. Default: 4', required=False,
+                        default=4, type=float)
+    parser.add_argument('--adaptive', help='Split the date range into windows sized to the event rate, busy '
+                        'windows further, and fetch them concurrently instead of following a single cursor. '
+                        'Not used with --stream', action='store_true')
+    parser.add_argument('-w', '--workers', help='Time windows fetched concurrently with --adaptive. Default: 8',
+                        required=False, default=8, type=int)
+    parser.add_argument('-o', '--outfile', help='Output file path for saving nft sales record in csv format, '
+                        'or the output directory with --format parquet (a .csv extension is dropped)', required=False, default='./20november.csv', type=str)
+    parser.add_argument('--format', help='csv: one flat file. parquet: a dataset partitioned by chain and day of '
+                        'event_time, without duplicate event_ids (requires pyarrow). Default: csv',
+                        choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--stream', help='Write each page as it arrives and checkpoint progress so that a restart '
+                        'with the same dates resumes after the last completed page', action='store_true')
+    parser.add_argument('--checkpoint', help='Checkpoint file for --stream. Default: <outfile>.checkpoint.json',
+                        required=False, default=None, type=str)
     args = parser.parse_args()
-    res = fetch_all_events(args.startdate.replace(tzinfo=timezone.utc), args.enddate.replace(tzinfo=timezone.utc),
-                           args.pause)
+    if args.max_rate <= 0:
+        parser.error('--max_rate must be positive')
+    start_rate = 1 / args.pause if args.pause > 0 else args.max_rate
+    configure_rate_limiter({urlparse(OPENSEA_API_ENDPOINT).netloc: (start_rate, max(args.max_rate, start_rate))})
+    if args.format == 'parquet' and args.outfile.endswith('.csv'):
+        args.outfile = args.outfile[:-len('.csv')]
+
+    if args.stream:
+        checkpoint_path = args.checkpoint or args.outfile + '.checkpoint.json'
+        count, done = stream_events(args.startdate.replace(tzinfo=timezone.utc),
+                                    args.enddate.replace(tzinfo=timezone.utc), args.outfile, checkpoint_path, args.format)
+        if not done:
+            sys.exit(f"Incomplete: {count} events in {args.outfile} so far. "
+                     f"Run again with the same dates to resume from {checkpoint_path}")
+        print(f"Done! {count} events in {args.outfile}")
+        return
+
+    if args.adaptive:
+        res = fetch_events_adaptive(args.startdate.replace(tzinfo=timezone.utc),
+                                    args.enddate.replace(tzinfo=timezone.utc), args.workers)
+    else:
+        res = fetch_all_events(args.startdate.replace(tzinfo=timezone.utc), args.enddate.replace(tzinfo=timezone.utc))
 
-    if len(res) != 0:
+    if args.format == 'parquet':
+        count = write_parquet(res, args.outfile)
+        print(f"{count} new events in {args.outfile}")
+    elif len(res) != 0:
         write_csv(res, args.outfile)
 
     print("Done!")
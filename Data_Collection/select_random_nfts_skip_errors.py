@@ -3,8 +3,13 @@ import csv
 import requests
 import time
 import random
-from datetime import datetime, timedelta
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
 from requests.exceptions import Timeout, RequestException
+from rate_limiter import configure_rate_limiter, get_rate_limiter
+from adaptive_windows import AdaptiveWindows, WindowSizer, PAGE_LIMIT
 
 try:
     import config
@@ -20,7 +25,7 @@ if not config.OPENSEA_APIKEY:
 OPENSEA_API_ENDPOINT = "https://api.opensea.io/api/v1/events"
 
 # Define the function to get events from OpenSea API
-def get_events(start_datetime, end_datetime, cursor="", event_type="successful", limit=300):
+def get_events(start_datetime, end_datetime, cursor="", event_type="successful", limit=PAGE_LIMIT, max_retries=5, max_throttle_retries=5):
     headers = {
         "Accept": "application/json",
         "X-API-KEY": config.OPENSEA_APIKEY
@@ -35,16 +40,26 @@ def get_events(start_datetime, end_datetime, cursor="", event_type="successful",
         "cursor": cursor
     }
 
-    try:
-        response = requests.get(OPENSEA_API_ENDPOINT, params=params, headers=headers, timeout=5)
-        response.raise_for_status()
-        return response.json()
-    except Timeout:
-        print("Request timed out. Retrying...")
-        return get_events(start_datetime, end_datetime, cursor, event_type, limit)
-    except RequestException as e:
-        print(f"Request error: {str(e)}")
-        return None
+    # The rate limiter paces requests to the API and backs off on 429/503 responses
+    rate_limiter = get_rate_limiter()
+    for retry in range(max_retries + 1):
+        try:
+            for attempt in range(max_throttle_retries + 1):
+                rate_limiter.acquire(OPENSEA_API_ENDPOINT)
+                response = requests.get(OPENSEA_API_ENDPOINT, params=params, headers=headers, timeout=5)
+                if not rate_limiter.feedback(OPENSEA_API_ENDPOINT, response.status_code, response.headers):
+                    break
+            response.raise_for_status()
+            return response.json()
+        except Timeout:
+            if retry == max_retries:
+                print(f"Request timed out {max_retries + 1} times. Giving up.")
+                return None
+            print(f"Request timed out. Retrying ({retry + 1}/{max_retries})...")
+            time.sleep(min(2 ** retry, 30))
+        except RequestException as e:
+            print(f"Request error: {str(e)}")
+            return None
 
 # Define the function to parse the event data
 def parse_event(event):
@@ -94,78 +109,151 @@ def parse_event(event):
 
     return record
 
-# Define the main function to retrieve and save event data
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-s', "--start_date", required=True, help="Start date in YYYY-MM-DD format")
-    parser.add_argument('-e',"--end_date", required=True, help="End date in YYYY-MM-DD format")
-    args = parser.parse_args()
-
-    start_date = datetime.strptime(args.start_date, "%Y-%m-%d %H:%M")
-    end_date = datetime.strptime(args.end_date, "%Y-%m-%d %H:%M")
-
-    csv_filename = "Apr2022.csv"
-
-    with open(csv_filename, mode="w", encoding="utf-8", newline="\n") as csv_file:
-        fieldnames = [
-            'asset_id', 'asset_name', 'asset_token_id', 'asset_contract_date',
-            'asset_contract_address', 'chain_identifier', 'asset_contract_type',
-            'owner', 'schema_name', 'symbol', 'external_link',
-            'asset_url', 'asset_img_url', 'animation_url', 'asset_img_org_url',
-            'animation_org_url', 'collection_slug', 'collection_name', 'collection_url',
-            'collection_created_date', 'featured', 'featured_image_url',
-            'safelist_request_status', 'is_nsfw', 'hidden', 'seller_fee',
-            'token_metadata', 'collection_discord_url', 'event_id', 'event_time',
-            'event_contract_address'
-        ]
-
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-        writer.writeheader()
-
-        while start_date <= end_date:
-            total_items_written = 0
-            current_hour = 0
-
-            while current_hour < 24:
-                current_minute = 0
-
-                while current_minute < 60:
-                    start_time = start_date.replace(hour=current_hour, minute=current_minute)
-                    end_time = start_time + timedelta(minutes=60)
-
-                    print(f"Chosen time frame for {start_date.date()}: {start_time.time()} to {end_time.time()}")
-
-                    cursor = None
+FIELDNAMES = [
+    'asset_id', 'asset_name', 'asset_token_id', 'asset_contract_date',
+    'asset_contract_address', 'chain_identifier', 'asset_contract_type',
+    'owner', 'schema_name', 'symbol', 'external_link',
+    'asset_url', 'asset_img_url', 'animation_url', 'asset_img_org_url',
+    'animation_org_url', 'collection_slug', 'collection_name', 'collection_url',
+    'collection_created_date', 'featured', 'featured_image_url',
+    'safelist_request_status', 'is_nsfw', 'hidden', 'seller_fee',
+    'token_metadata', 'collection_discord_url', 'event_id', 'event_time',
+    'event_contract_address'
+]
+
+
+# Every hourly window of every day from start_date through end_date
+def hourly_windows(start_date, end_date):
+    while start_date <= end_date:
+        for current_hour in range(24):
+            start_time = start_date.replace(hour=current_hour, minute=0)
+            yield start_time, start_time + timedelta(minutes=60)
+        start_date = start_date + timedelta(days=1)
+
+
+# The records of the first page of a time window, and the cursor of the next page (None if it was the last)
+def collect_first_page(start_time, end_time):
+    event_data = get_events(start_time, end_time)
+    if not event_data:
+        return [], None
+    events = event_data.get("asset_events", [])
+    records = [record for record in map(parse_event, events) if record]
+    return records, event_data.get("cursor") or None
+
+
+# Collect all records of one time window by following the cursor, from the given page on
+def collect_window(start_time, end_time, cursor=None):
+    records = []
+    try:
+        while True:
+            event_data = get_events(start_time, end_time, cursor=cursor)
+            if not event_data:
+                break
 
-                    try:
-                        while True:
-                            event_data = get_events(start_time, end_time, cursor=cursor)
+            for event in event_data.get("asset_events", []):
+                record = parse_event(event)
+                if record:
+                    records.append(record)
 
-                            if event_data:
-                                for event in event_data.get("asset_events", []):
-                                    record = parse_event(event)
-                                    if record:
-                                        writer.writerow(record)
-                                        total_items_written += 1
+            cursor = event_data.get("cursor")
+            if not cursor:
+                break
 
-                            cursor = event_data.get("cursor")
-                            if not cursor:
-                                break
+    except Exception as e:
+        print(f"Error in time frame {start_time} to {end_time}: {str(e)}")
+        # Keep what was collected and continue with the next time frame
 
-                            time.sleep(3)
+    return records
 
-                    except Exception as e:
-                        print(f"Error: {str(e)}")
-                        pass  # Skip this time frame and continue to the next
 
-                    print(f"Data collected for {start_date.date()} {start_time.time()}: {total_items_written} items")
+# Define the main function to retrieve and save event data
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', "--start_date", required=True, help="Start date in YYYY-MM-DD HH:MM format")
+    parser.add_argument('-e',"--end_date", required=True, help="End date in YYYY-MM-DD HH:MM format")
+    parser.add_argument('-o', "--outfile", default="Apr2022.csv",
+                        help="Output CSV file, or output directory with --format parquet (a .csv extension is dropped)")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv",
+                        help="csv: one flat file. parquet: a dataset partitioned by chain and day of event_time, "
+                             "without duplicate event_ids (requires pyarrow)")
+    parser.add_argument('-w', "--workers", type=int, default=8, help="Time windows collected concurrently")
+    parser.add_argument("--max_rate", type=float, default=4,
+                        help="Maximum API requests per second shared by all workers")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Collect the hours in windows sized to the event rate instead of one window per hour: "
+                             "windows whose first page is not the last are split, quiet hours are merged")
+    parser.add_argument("--min_window_minutes", type=float, default=1,
+                        help="Shortest time window with --adaptive; busier windows are collected by following the cursor")
+    parser.add_argument("--max_window_minutes", type=float, default=24 * 60,
+                        help="Longest time window that quiet periods are merged into with --adaptive")
+    args = parser.parse_args()
 
-                    current_minute += 60
+    # Event times are UTC
+    start_date = datetime.strptime(args.start_date, "%Y-%m-%d %H:%M").replace(tzinfo=timezone.utc)
+    end_date = datetime.strptime(args.end_date, "%Y-%m-%d %H:%M").replace(tzinfo=timezone.utc)
+    if start_date > end_date:
+        print(f"Start date {args.start_date} is after end date {args.end_date}")
+        exit(1)
+
+    # All workers draw from one request budget for the API
+    configure_rate_limiter({urlparse(OPENSEA_API_ENDPOINT).netloc: (min(1.0, args.max_rate), args.max_rate)})
+
+    if args.format == "parquet":
+        # pyarrow is only needed for --format parquet
+        from parquet_sink import ParquetSink
+        if args.outfile.endswith(".csv"):
+            args.outfile = args.outfile[:-len(".csv")]
+        output = writer = ParquetSink(args.outfile, FIELDNAMES)
+    else:
+        output = open(args.outfile, mode="w", encoding="utf-8", newline="\n")
+        writer = csv.DictWriter(output, fieldnames=FIELDNAMES)
+        writer.writeheader()
 
-                current_hour += 1
+    with output:
+        # Windows are collected concurrently but written in chronological order
+        total_items_written = 0
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            if args.adaptive:
+                sizer = WindowSizer(min_window=timedelta(minutes=args.min_window_minutes),
+                                    max_window=timedelta(minutes=args.max_window_minutes))
+                windows = AdaptiveWindows(collect_first_page, collect_window, sizer, sizer.min_window)
+                collected = collect_adaptive(windows, start_date, end_date, executor, args.workers)
+            else:
+                collected = collect_hourly(start_date, end_date, executor, args.workers)
+            for start_time, end_time, records in collected:
+                total_items_written += write_window(writer, start_time, end_time, records)
+
+        print(f"Done! {total_items_written} items written to {args.outfile}")
+
+
+# Yield (start_time, end_time, records) for every hour from start_date through end_date, one
+# window per hour. At most 2 * workers windows are pending, so out-of-order results never pile up in memory.
+def collect_hourly(start_date, end_date, executor, workers):
+    pending = deque()
+    for window in hourly_windows(start_date, end_date):
+        pending.append((window, executor.submit(collect_window, *window)))
+        if len(pending) >= 2 * workers:
+            (start_time, end_time), future = pending.popleft()
+            yield start_time, end_time, future.result()
+    while pending:
+        (start_time, end_time), future = pending.popleft()
+        yield start_time, end_time, future.result()
+
+
+# The same hours as collect_hourly, collected in the windows of an AdaptiveWindows
+def collect_adaptive(windows, start_date, end_date, executor, workers):
+    hours = list(hourly_windows(start_date, end_date))
+    yield from windows.collect(hours[0][0], hours[-1][1], executor, workers)
+    print(f"Collected {windows.windows_collected} windows ({windows.splits} split)")
+
+
+def write_window(writer, start_time, end_time, records):
+    written = writer.writerows(records)
+    # The Parquet sink returns how many records were not duplicates; csv writers return None
+    written = len(records) if written is None else written
+    print(f"Data collected for {start_time} to {end_time}: {written} items")
+    return written
 
-            start_date = start_date + timedelta(days=1)
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,391 @@
+"""Incremental aggregates over the comparison results, kept up to date while they are written.
+
+For every value of the collection_slug, chain_identifier, opensea_extension,
+original_extension and extension pair dimensions (and 'all') the store keeps the count,
+sum, sum of squares, min, max and a fixed-bucket histogram of ssim_score, mse_score and
+phash_difference, and the number of mismatches: pairs whose pHash difference is above the
+mismatch threshold. main.py adds every flushed batch of results, so queries read a few
+rows instead of rescanning the results and joining them with the dataset.
+
+    python analytics.py build --results /data/comparison_results.csv --dataset dataset.csv
+    python analytics.py summary --dimension collection_slug --order mismatch_rate --min_results 50 --limit 20
+    python analytics.py histogram --dimension chain_identifier --value ethereum --metric ssim_score
+    python analytics.py merge --shard_count 4
+"""
+import argparse
+import bisect
+import csv
+import logging
+import math
+import os
+import sqlite3
+import sys
+import threading
+from collections import defaultdict
+import pandas as pd
+from checkpoint_store import asset_key
+from metrics import Histogram
+from result_writer import parquet_output_path, read_parquet_output
+from sharding import shard_path
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Scores aggregated, with their histogram bucket upper bounds
+METRICS = {
+    'ssim_score': tuple(round(-1 + i * 0.05, 2) for i in range(41)),
+    'mse_score': (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2000, 3000, 4000, 5000, 7500, 10000, 15000, 20000,
+                  30000, 65025),
+    'phash_difference': tuple(range(257)),
+}
+
+# Dimensions results are broken down by; extension_pair is '<opensea_extension>-><original_extension>'
+DIMENSIONS = ['all', 'collection_slug', 'chain_identifier', 'opensea_extension', 'original_extension', 'extension_pair']
+
+# Pairs with a larger pHash difference are counted as mismatches: the lower end of
+# comparison.CASCADE_PHASH_BAND, below which two images are taken to be the same
+MISMATCH_PHASH_DIFFERENCE = 8
+
+# Dimension value of records without one
+UNKNOWN_VALUE = 'unknown'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS counted (
+    asset_id TEXT PRIMARY KEY
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS group_counts (
+    dimension TEXT NOT NULL,
+    value TEXT NOT NULL,
+    results INTEGER NOT NULL,
+    mismatches INTEGER NOT NULL,
+    PRIMARY KEY (dimension, value)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS stats (
+    dimension TEXT NOT NULL,
+    value TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    sum_sq REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    PRIMARY KEY (dimension, value, metric)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS buckets (
+    dimension TEXT NOT NULL,
+    value TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (dimension, value, metric, bucket)
+) WITHOUT ROWID;
+"""
+
+# Upserts adding rows of the three aggregate tables, given as VALUES or as a SELECT (which
+# needs a WHERE clause for SQLite to parse the ON CONFLICT clause after it)
+ADD_GROUPS = """INSERT INTO main.group_counts (dimension, value, results, mismatches) {rows}
+    ON CONFLICT (dimension, value) DO UPDATE SET
+    results = results + excluded.results, mismatches = mismatches + excluded.mismatches"""
+ADD_STATS = """INSERT INTO main.stats (dimension, value, metric, count, sum, sum_sq, min, max) {rows}
+    ON CONFLICT (dimension, value, metric) DO UPDATE SET
+    count = count + excluded.count, sum = sum + excluded.sum, sum_sq = sum_sq + excluded.sum_sq,
+    min = MIN(min, excluded.min), max = MAX(max, excluded.max)"""
+ADD_BUCKETS = """INSERT INTO main.buckets (dimension, value, metric, bucket, count) {rows}
+    ON CONFLICT (dimension, value, metric, bucket) DO UPDATE SET count = count + excluded.count"""
+
+# SQLite limits the number of parameters of one statement
+MAX_PARAMETERS = 900
+
+
+def dimension_value(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)) or str(value) == '':
+        return UNKNOWN_VALUE
+    return str(value)
+
+
+def metric_value(value):
+    # A finite float, or None for scores that were not computed (NaN in cascade mode, empty in CSVs)
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+def record_dimensions(record):
+    opensea_extension = dimension_value(record.get('opensea_extension'))
+    original_extension = dimension_value(record.get('original_extension'))
+    return [
+        ('all', 'all'),
+        ('collection_slug', dimension_value(record.get('collection_slug'))),
+        ('chain_identifier', dimension_value(record.get('chain_identifier'))),
+        ('opensea_extension', opensea_extension),
+        ('original_extension', original_extension),
+        ('extension_pair', f"{opensea_extension}->{original_extension}"),
+    ]
+
+
+class ResultAnalytics:
+    """Aggregates of the comparison results in an SQLite file, one connection per thread.
+
+    Each asset is counted once: records of assets already counted are skipped, so
+    re-importing a results file or a resumed run never counts a result twice.
+    """
+
+    def __init__(self, path, mismatch_threshold=None):
+        # mismatch_threshold is fixed when the file is created; None keeps the file's threshold
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.executescript(SCHEMA)
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO settings (name, value) VALUES ('mismatch_threshold', ?)",
+                         (str(MISMATCH_PHASH_DIFFERENCE if mismatch_threshold is None else mismatch_threshold),))
+        self.mismatch_threshold = int(conn.execute(
+            "SELECT value FROM settings WHERE name = 'mismatch_threshold'").fetchone()[0])
+        if mismatch_threshold is not None and self.mismatch_threshold != mismatch_threshold:
+            logger.warning(f"{path} counts mismatches above a pHash difference of {self.mismatch_threshold}, "
+                           f"not {mismatch_threshold}; rebuild it to change the threshold")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def add_records(self, records):
+        # ResultWriter on_flush callback for the comparison results; returns the number of
+        # records counted. The batch is aggregated first, so each group is written once per batch.
+        groups = defaultdict(lambda: [0, 0])
+        stats = {}
+        buckets = defaultdict(int)
+        added = 0
+        with self._connection() as conn:
+            for record in records:
+                key = asset_key(record['asset_id'])
+                if conn.execute('INSERT OR IGNORE INTO counted (asset_id) VALUES (?)', (key,)).rowcount == 0:
+                    continue
+                added += 1
+                values = {metric: metric_value(record.get(metric)) for metric in METRICS}
+                mismatch = values['phash_difference'] is not None and values['phash_difference'] > self.mismatch_threshold
+                for dimension, value in record_dimensions(record):
+                    group = groups[dimension, value]
+                    group[0] += 1
+                    group[1] += mismatch
+                    for metric, bounds in METRICS.items():
+                        x = values[metric]
+                        if x is None:
+                            continue
+                        stat = stats.get((dimension, value, metric))
+                        if stat is None:
+                            stats[dimension, value, metric] = [1, x, x * x, x, x]
+                        else:
+                            stat[0] += 1
+                            stat[1] += x
+                            stat[2] += x * x
+                            stat[3] = min(stat[3], x)
+                            stat[4] = max(stat[4], x)
+                        buckets[dimension, value, metric, bisect.bisect_left(bounds, x)] += 1
+
+            conn.executemany(ADD_GROUPS.format(rows='VALUES (?, ?, ?, ?)'),
+                             [key + tuple(group) for key, group in groups.items()])
+            conn.executemany(ADD_STATS.format(rows='VALUES (?, ?, ?, ?, ?, ?, ?, ?)'),
+                             [key + tuple(stat) for key, stat in stats.items()])
+            conn.executemany(ADD_BUCKETS.format(rows='VALUES (?, ?, ?, ?, ?)'),
+                             [key + (count,) for key, count in buckets.items()])
+        return added
+
+    def import_results(self, path, dataset_path=None, chunk_size=100000):
+        """Count the results of an existing comparison_results.csv or its Parquet output directory.
+
+        Results written before records carried their collection_slug and chain_identifier
+        take them from dataset_path, read once for its asset_id and those two columns.
+        """
+        columns = ['asset_id', 'opensea_extension', 'original_extension', 'collection_slug', 'chain_identifier']
+        columns += list(METRICS)
+        if not os.path.exists(path) and os.path.isdir(parquet_output_path(path)):
+            df = read_parquet_output(path)
+            chunks = [df[[c for c in columns if c in df]]]
+        else:
+            chunks = pd.read_csv(path, usecols=lambda c: c in columns, dtype={'asset_id': str}, chunksize=chunk_size)
+
+        dataset = None
+        if dataset_path:
+            dataset = pd.read_csv(dataset_path, usecols=['asset_id', 'collection_slug', 'chain_identifier'],
+                                  dtype=str)
+            dataset = dataset.assign(asset_id=dataset['asset_id'].map(asset_key)).drop_duplicates('asset_id')
+            dataset = dataset.set_index('asset_id')
+
+        imported = 0
+        for chunk in chunks:
+            if dataset is not None:
+                keys = chunk['asset_id'].map(asset_key)
+                for column in ('collection_slug', 'chain_identifier'):
+                    looked_up = keys.map(dataset[column]).to_numpy()
+                    chunk = chunk.assign(**{column: chunk[column].where(chunk[column].notna(), looked_up)
+                                            if column in chunk else looked_up})
+            imported += self.add_records(chunk.to_dict('records'))
+        return imported
+
+    def merge(self, path):
+        # Add the aggregates of another analytics file holding different assets, e.g. a shard's
+        conn = self._connection()
+        conn.execute('ATTACH DATABASE ? AS other', (path,))
+        try:
+            with conn:
+                overlap = conn.execute('SELECT COUNT(*) FROM other.counted JOIN counted USING (asset_id)').fetchone()[0]
+                if overlap:
+                    raise ValueError(f"{path} counts {overlap} assets already counted in {self.path}")
+                conn.execute('INSERT INTO counted (asset_id) SELECT asset_id FROM other.counted')
+                conn.execute(ADD_GROUPS.format(
+                    rows='SELECT dimension, value, results, mismatches FROM other.group_counts WHERE true'))
+                conn.execute(ADD_STATS.format(
+                    rows='SELECT dimension, value, metric, count, sum, sum_sq, min, max FROM other.stats WHERE true'))
+                conn.execute(ADD_BUCKETS.format(
+                    rows='SELECT dimension, value, metric, bucket, count FROM other.buckets WHERE true'))
+        finally:
+            conn.execute('DETACH DATABASE other')
+
+    def histogram(self, dimension, value, metric):
+        # metrics.Histogram of metric over the results of one dimension value
+        histogram = Histogram(METRICS[metric])
+        conn = self._connection()
+        for bucket, count in conn.execute('SELECT bucket, count FROM buckets WHERE dimension = ? AND value = ? AND metric = ?',
+                                          (dimension, value, metric)):
+            histogram.counts[bucket] = count
+        row = conn.execute('SELECT count, sum FROM stats WHERE dimension = ? AND value = ? AND metric = ?',
+                           (dimension, value, metric)).fetchone()
+        if row:
+            histogram.count, histogram.sum = row
+        return histogram
+
+    def summary(self, dimension='all', value=None, order='results', min_results=1, limit=None):
+        """Results, mismatches and score statistics of each value of dimension.
+
+        Returns a list of dicts ordered by 'results' or 'mismatch_rate', descending. value
+        restricts it to one value; groups with fewer than min_results results are left out.
+        """
+        conn = self._connection()
+        conditions, parameters = ['dimension = ?', 'results >= ?'], [dimension, min_results]
+        if value is not None:
+            conditions.append('value = ?')
+            parameters.append(value)
+        order_by = 'results DESC' if order == 'results' else 'CAST(mismatches AS REAL) / results DESC, results DESC'
+        query = f"SELECT value, results, mismatches FROM group_counts WHERE {' AND '.join(conditions)} ORDER BY {order_by}, value"
+        if limit:
+            query += ' LIMIT ?'
+            parameters.append(limit)
+        groups = conn.execute(query, parameters).fetchall()
+
+        rows = {}
+        for group_value, results, mismatches in groups:
+            rows[group_value] = {'dimension': dimension, 'value': group_value, 'results': results,
+                                 'mismatches': mismatches, 'mismatch_rate': mismatches / results}
+        for values in batched(list(rows)):
+            placeholders = ','.join('?' * len(values))
+            for group_value, metric, count, total, total_sq, low, high in conn.execute(
+                    f"""SELECT value, metric, count, sum, sum_sq, min, max FROM stats
+                        WHERE dimension = ? AND value IN ({placeholders})""", [dimension] + values):
+                mean = total / count
+                rows[group_value].update({
+                    f"{metric}_mean": mean,
+                    f"{metric}_std": math.sqrt(max(total_sq / count - mean * mean, 0.0)),
+                    f"{metric}_min": low,
+                    f"{metric}_max": high,
+                })
+            histograms = {}
+            for group_value, metric, bucket, count in conn.execute(
+                    f"""SELECT value, metric, bucket, count FROM buckets
+                        WHERE dimension = ? AND value IN ({placeholders})""", [dimension] + values):
+                histogram = histograms.setdefault((group_value, metric), Histogram(METRICS[metric]))
+                histogram.counts[bucket] = count
+                histogram.count += count
+            for (group_value, metric), histogram in histograms.items():
+                # Interpolated within a bucket; the exact min and max bound them
+                row = rows[group_value]
+                for name, q in (('p50', 0.50), ('p95', 0.95)):
+                    row[f"{metric}_{name}"] = min(max(histogram.quantile(q), row[f"{metric}_min"]), row[f"{metric}_max"])
+        return list(rows.values())
+
+
+def batched(items, size=MAX_PARAMETERS):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def summary_fieldnames():
+    fieldnames = ['dimension', 'value', 'results', 'mismatches', 'mismatch_rate']
+    for metric in METRICS:
+        fieldnames += [f"{metric}_{stat}" for stat in ('mean', 'std', 'min', 'p50', 'p95', 'max')]
+    return fieldnames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--analytics', default='/data/analytics.sqlite', help='Analytics file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='Count the results of a comparison results file')
+    build.add_argument('--results', default='/data/comparison_results.csv', help='Comparison results CSV')
+    build.add_argument('--dataset', help='Dataset CSV providing collection_slug and chain_identifier of older results')
+    build.add_argument('--mismatch_threshold', type=int, default=MISMATCH_PHASH_DIFFERENCE,
+                       help='pHash difference above which a pair is a mismatch, fixed when the file is created')
+
+    summary = subparsers.add_parser('summary', help='Write results, mismatch rate and score statistics per value as CSV')
+    summary.add_argument('--dimension', choices=DIMENSIONS, default='all')
+    summary.add_argument('--value', help='Only this value of the dimension')
+    summary.add_argument('--order', choices=['results', 'mismatch_rate'], default='results')
+    summary.add_argument('--min_results', type=int, default=1, help='Leave out values with fewer results')
+    summary.add_argument('--limit', type=int, help='Maximum number of values')
+
+    histogram = subparsers.add_parser('histogram', help='Write the histogram of a score for one value as CSV')
+    histogram.add_argument('--dimension', choices=DIMENSIONS, default='all')
+    histogram.add_argument('--value', default='all')
+    histogram.add_argument('--metric', choices=list(METRICS), default='ssim_score')
+
+    merge = subparsers.add_parser('merge', help='Add the analytics files of a sharded run to --analytics')
+    merge.add_argument('--shard_count', type=int, required=True, help='Number of shards of the run')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        analytics = ResultAnalytics(args.analytics, args.mismatch_threshold)
+        logger.info(f"Counted {analytics.import_results(args.results, args.dataset)} results from {args.results}")
+        return
+
+    analytics = ResultAnalytics(args.analytics)
+    if args.command == 'summary':
+        writer = csv.DictWriter(sys.stdout, fieldnames=summary_fieldnames())
+        writer.writeheader()
+        writer.writerows(analytics.summary(args.dimension, args.value, args.order, args.min_results, args.limit))
+
+    elif args.command == 'histogram':
+        data = analytics.histogram(args.dimension, args.value, args.metric)
+        writer = csv.writer(sys.stdout)
+        writer.writerow(['upper_bound', 'count'])
+        for bound, count in zip(list(data.bounds) + ['inf'], data.counts):
+            if count:
+                writer.writerow([bound, count])
+
+    else:
+        for shard_index in range(args.shard_count):
+            path = shard_path(args.analytics, shard_index, args.shard_count)
+            if not os.path.exists(path):
+                logger.warning(f"No analytics for shard {shard_index} at {path}")
+                continue
+            analytics.merge(path)
+            logger.info(f"Merged {path} into {args.analytics}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import asyncio
+import os
+from concurrent.futures import wait, FIRST_COMPLETED
+from metrics import get_metrics
+
+# Seconds between memory checks while admission is paused for the memory ceiling
+MEMORY_POLL_INTERVAL = 0.1
+
+
+def current_rss_bytes():
+    # Resident set size of this process from /proc; None where that is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class InFlightLimit:
+    """Feed work items through the pipeline continuously while bounding the work in progress.
+
+    Work arrives as an iterator of lists of items (one list per input chunk) and is started as
+    soon as earlier items finish, so the pipeline never drains at chunk boundaries. At most
+    max_in_flight items are in progress, and while the process RSS exceeds max_rss_bytes no new
+    item is started until one finishes. The next chunk is read only when its items are needed.
+    """
+
+    def __init__(self, max_in_flight, max_rss_bytes=0):
+        self.max_in_flight = max(int(max_in_flight), 1)
+        self.max_rss_bytes = max_rss_bytes
+        self.in_flight = 0
+        metrics = get_metrics()
+        metrics.register_gauge('rows_in_flight', lambda: self.in_flight)
+        metrics.register_gauge('rss_bytes', lambda: current_rss_bytes() or 0)
+
+    def memory_exceeded(self):
+        if not self.max_rss_bytes:
+            return False
+        rss = current_rss_bytes()
+        return rss is not None and rss > self.max_rss_bytes
+
+    def _must_wait(self, pending):
+        # Never wait for memory with nothing in flight, or the pipeline could stall for good
+        return len(pending) >= self.max_in_flight or (pending and self.memory_exceeded())
+
+    def run(self, executor, fn, chunks, on_done=None):
+        # Run fn(*item) for every item on a concurrent.futures executor; on_done(*item) after each
+        pending = {}
+        try:
+            for items in chunks:
+                for item in items:
+                    while self._must_wait(pending):
+                        done, _ = wait(pending, timeout=MEMORY_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                        self._finish(done, pending, on_done)
+                    pending[executor.submit(fn, *item)] = item
+                    self.in_flight = len(pending)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                self._finish(done, pending, on_done)
+        finally:
+            self.in_flight = 0
+
+    async def run_async(self, coroutine_function, chunks, on_done=None):
+        # Run coroutine_function(*item) for every item as tasks on the running loop. Chunks are
+        # read in the default executor so the event loop keeps serving downloads meanwhile.
+        loop = asyncio.get_running_loop()
+        chunks = iter(chunks)
+        pending = {}
+        try:
+            while True:
+                items = await loop.run_in_executor(None, next, chunks, None)
+                if items is None:
+                    break
+                for item in items:
+                    while self._must_wait(pending):
+                        done, _ = await asyncio.wait(pending, timeout=MEMORY_POLL_INTERVAL,
+                                                     return_when=asyncio.FIRST_COMPLETED)
+                        self._finish(done, pending, on_done)
+                    pending[asyncio.ensure_future(coroutine_function(*item))] = item
+                    self.in_flight = len(pending)
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                self._finish(done, pending, on_done)
+        finally:
+            for task in pending:
+                task.cancel()
+            self.in_flight = 0
+
+    def _finish(self, done, pending, on_done):
+        for future in done:
+            item = pending.pop(future)
+            if on_done is not None:
+                on_done(*item)
+        self.in_flight = len(pending)
+        for future in done:
+            # Re-raise unexpected errors of a row, as gathering the chunk did
+            future.result()
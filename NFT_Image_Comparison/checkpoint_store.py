@@ -0,0 +1,213 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+import pandas as pd
+from result_writer import parquet_output_path, read_parquet_output
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS assets (
+    asset_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    reason TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID
+"""
+
+
+def asset_key(asset_id):
+    # pandas reads asset_id as float when the column has gaps, and CSVs written from such a
+    # column hold '123.0'; 123.0, '123.0' and 123 are the same asset
+    if isinstance(asset_id, float) and asset_id.is_integer():
+        asset_id = int(asset_id)
+    asset_id = str(asset_id)
+    if asset_id.endswith('.0') and asset_id[:-2].isdigit():
+        asset_id = asset_id[:-2]
+    return asset_id
+
+
+class CheckpointStore:
+    """Per-asset processing state in an SQLite database (WAL mode).
+
+    Each asset has a status ('done', 'failed', 'retry' while it waits for a retry after a
+    transient failure, or 'retrying' while it is retried), the last failure reason and the
+    number of attempts. Lookups are primary-key queries, so resuming a run does not load previous
+    results into memory. Every thread gets its own connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def status(self, asset_id):
+        row = self._connection().execute('SELECT status FROM assets WHERE asset_id = ?', (asset_key(asset_id),)).fetchone()
+        return row[0] if row else None
+
+    def get(self, asset_id):
+        # Return {'status', 'reason', 'attempts', 'updated_at'} or None
+        row = self._connection().execute(
+            'SELECT status, reason, attempts, updated_at FROM assets WHERE asset_id = ?', (asset_key(asset_id),)
+        ).fetchone()
+        return dict(zip(('status', 'reason', 'attempts', 'updated_at'), row)) if row else None
+
+    def mark_done(self, asset_ids):
+        now = time.time()
+        with self._connection() as conn:
+            conn.executemany(
+                """INSERT INTO assets (asset_id, status, reason, attempts, updated_at) VALUES (?, 'done', NULL, 1, ?)
+                   ON CONFLICT(asset_id) DO UPDATE SET status = 'done', reason = NULL,
+                   attempts = attempts + 1, updated_at = excluded.updated_at""",
+                [(asset_key(asset_id), now) for asset_id in asset_ids])
+
+    def mark_failed(self, asset_id, reason=None):
+        # Count one failed attempt; a None reason keeps the previously recorded one
+        with self._connection() as conn:
+            conn.execute(
+                """INSERT INTO assets (asset_id, status, reason, attempts, updated_at) VALUES (?, 'failed', ?, 1, ?)
+                   ON CONFLICT(asset_id) DO UPDATE SET status = 'failed', reason = COALESCE(excluded.reason, reason),
+                   attempts = attempts + 1, updated_at = excluded.updated_at""",
+                (asset_key(asset_id), reason, time.time()))
+
+    def mark_retry(self, asset_id, reason=None):
+        # Count one failed attempt and queue the asset for a retry (see retry_queue)
+        with self._connection() as conn:
+            conn.execute(
+                """INSERT INTO assets (asset_id, status, reason, attempts, updated_at) VALUES (?, 'retry', ?, 1, ?)
+                   ON CONFLICT(asset_id) DO UPDATE SET status = 'retry', reason = COALESCE(excluded.reason, reason),
+                   attempts = attempts + 1, updated_at = excluded.updated_at""",
+                (asset_key(asset_id), reason, time.time()))
+
+    def retries(self):
+        # (asset_id, attempts, updated_at) of every asset waiting for a retry
+        return self._connection().execute(
+            "SELECT asset_id, attempts, updated_at FROM assets WHERE status = 'retry'").fetchall()
+
+    def begin_retry(self, asset_ids):
+        with self._connection() as conn:
+            conn.executemany("UPDATE assets SET status = 'retrying' WHERE asset_id = ? AND status = 'retry'",
+                             [(asset_key(asset_id),) for asset_id in asset_ids])
+
+    def mark_errors(self, reasons):
+        # mark_failed for every (asset_id, reason) of a batch written to the error log
+        now = time.time()
+        with self._connection() as conn:
+            conn.executemany(
+                """INSERT INTO assets (asset_id, status, reason, attempts, updated_at) VALUES (?, 'failed', ?, 1, ?)
+                   ON CONFLICT(asset_id) DO UPDATE SET status = 'failed', reason = COALESCE(excluded.reason, reason),
+                   attempts = attempts + 1, updated_at = excluded.updated_at""",
+                [(asset_key(asset_id), reason, now) for asset_id, reason in reasons])
+
+    def counts(self):
+        return dict(self._connection().execute('SELECT status, COUNT(*) FROM assets GROUP BY status').fetchall())
+
+    def is_empty(self):
+        return self._connection().execute('SELECT 1 FROM assets LIMIT 1').fetchone() is None
+
+    def import_output(self, path, status, chunk_size=100000):
+        # One-off import of asset_ids from an existing comparison_results.csv or error_log.csv,
+        # or from their Parquet output directories
+        imported = 0
+        now = time.time()
+        reason_column = 'error_type' if status == 'failed' else None
+        columns = ['asset_id', reason_column] if reason_column else ['asset_id']
+        try:
+            if not os.path.exists(path) and os.path.isdir(parquet_output_path(path)):
+                df = read_parquet_output(path)
+                chunks = [df[[c for c in columns if c in df]]]
+            else:
+                chunks = pd.read_csv(path, usecols=lambda c: c in columns, chunksize=chunk_size)
+            with self._connection() as conn:
+                for chunk in chunks:
+                    reasons = chunk[reason_column] if reason_column in chunk else [None] * len(chunk)
+                    conn.executemany(
+                        """INSERT INTO assets (asset_id, status, reason, attempts, updated_at) VALUES (?, ?, ?, 1, ?)
+                           ON CONFLICT(asset_id) DO NOTHING""",
+                        [(asset_key(asset_id), status, None if pd.isna(reason) else reason, now)
+                         for asset_id, reason in zip(chunk['asset_id'], reasons)])
+                    imported += len(chunk)
+        except FileNotFoundError:
+            logger.info(f"No existing file to import at {path}")
+        return imported
+
+
+class DoneView:
+    """Set-like view of assets that need no further processing in this pass (done, failed
+    or waiting for a retry), used in place of the processed_ids set.
+
+    add() only marks the asset in memory; the store is updated by commit() once the
+    result writer has written the result, so a crash never records an unwritten result.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, asset_id):
+        with self._lock:
+            if asset_key(asset_id) in self._pending:
+                return True
+        return self.store.status(asset_id) in ('done', 'failed', 'retry')
+
+    def add(self, asset_id):
+        # Failed assets are already in the store and will never be committed as results
+        if self.store.status(asset_id) == 'failed':
+            return
+        with self._lock:
+            self._pending.add(asset_key(asset_id))
+
+    def commit(self, records):
+        # ResultWriter on_flush callback for the comparison results
+        asset_ids = [record['asset_id'] for record in records]
+        self.store.mark_done(asset_ids)
+        with self._lock:
+            self._pending.difference_update(asset_key(asset_id) for asset_id in asset_ids)
+
+
+class FailedView:
+    """Set-like view of failed assets, used in place of the errors_logged set. Assets waiting
+    for a retry are included, so the rest of their row is skipped until the retry.
+
+    As in DoneView, add() only marks the asset in memory; commit() marks it failed in the store
+    once the error writer has written its error record.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, asset_id):
+        with self._lock:
+            if asset_key(asset_id) in self._pending:
+                return True
+        return self.store.status(asset_id) in ('failed', 'retry')
+
+    def add(self, asset_id):
+        with self._lock:
+            self._pending.add(asset_key(asset_id))
+
+    def commit(self, records):
+        # ResultWriter on_flush callback for the error log
+        self.store.mark_errors((record['asset_id'], record.get('error_type')) for record in records)
+        with self._lock:
+            self._pending.difference_update(asset_key(record['asset_id']) for record in records)
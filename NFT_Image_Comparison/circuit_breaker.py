@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import aiohttp
+from requests.exceptions import ConnectionError, Timeout, ChunkedEncodingError
+from metrics import get_metrics
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# A host failing this many requests in a row with transient errors is not contacted for a
+# cooldown that doubles with every failed probe after it
+FAILURE_THRESHOLD = 5
+BASE_OPEN_SECONDS = 30.0
+MAX_OPEN_SECONDS = 600.0
+
+# HTTP statuses worth asking again later; every other 4xx/5xx is a permanent failure
+TRANSIENT_STATUS_CODES = (408, 425, 429, 500, 502, 503, 504)
+
+# Network errors and timeouts of requests and aiohttp
+TRANSIENT_ERRORS = (ConnectionError, Timeout, ChunkedEncodingError, aiohttp.ClientConnectionError,
+                    aiohttp.ClientPayloadError, asyncio.TimeoutError)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request to a host whose circuit is open."""
+
+    def __init__(self, host, retry_in):
+        super().__init__(f"Circuit open for {host}, next attempt in {retry_in:.0f}s")
+        self.host = host
+        self.retry_in = retry_in
+
+
+def http_status(error):
+    # Status code of a requests HTTPError or an aiohttp ClientResponseError, else None
+    response = getattr(error, 'response', None)
+    if response is not None and getattr(response, 'status_code', None) is not None:
+        return response.status_code
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status
+    return None
+
+
+def is_transient(error):
+    # Transient failures (timeouts, dropped connections, 429/5xx, open circuits) may succeed
+    # later; anything else (404, not an image, too large, undecodable) never will
+    status = http_status(error)
+    if status is not None:
+        return status in TRANSIENT_STATUS_CODES
+    return isinstance(error, (CircuitOpenError,) + TRANSIENT_ERRORS)
+
+
+class CircuitBreaker:
+    """Closed, open and half-open state of one host.
+
+    The circuit opens after failure_threshold consecutive transient failures. While it is
+    open every request fails at once; after the cooldown one probe request is let through
+    (half-open), which closes the circuit on success and reopens it for twice as long on failure.
+    """
+
+    def __init__(self, host, failure_threshold=FAILURE_THRESHOLD, base_open_seconds=BASE_OPEN_SECONDS,
+                 max_open_seconds=MAX_OPEN_SECONDS):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.base_open_seconds = base_open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.consecutive_failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.consecutive_failures < self.failure_threshold:
+            return 'closed'
+        if self.probing or time.monotonic() >= self.open_until:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        # None if no request may be sent now, else whether the request is the half-open probe
+        with self._lock:
+            if self.consecutive_failures < self.failure_threshold:
+                return False
+            if self.probing or time.monotonic() < self.open_until:
+                return None
+            self.probing = True
+            return True
+
+    def retry_in(self):
+        return max(self.open_until - time.monotonic(), 0.0)
+
+    def record_success(self, probe=False):
+        with self._lock:
+            if self.consecutive_failures >= self.failure_threshold:
+                logger.info(f"Circuit for {self.host} closed")
+            self.consecutive_failures = 0
+            self.trips = 0
+            if probe:
+                self.probing = False
+
+    def record_failure(self, probe=False):
+        with self._lock:
+            self.consecutive_failures += 1
+            if probe:
+                self.probing = False
+            # Requests sent before the circuit opened do not extend the cooldown, only the
+            # failure that opens it and failed probes do
+            elif self.consecutive_failures != self.failure_threshold:
+                return
+            cooldown = min(self.max_open_seconds, self.base_open_seconds * 2 ** self.trips)
+            self.trips += 1
+            self.open_until = time.monotonic() + cooldown
+        get_metrics().inc('circuit_breaker_opened_total', host=self.host)
+        logger.warning(f"Circuit for {self.host} opened after {self.consecutive_failures} consecutive failures; "
+                       f"next attempt in {cooldown:.0f}s")
+
+    def release(self, probe=False):
+        # The request ended without an outcome (e.g. a cancelled hedge); let another probe through
+        if probe:
+            with self._lock:
+                self.probing = False
+
+
+class BreakerRegistry:
+    """Per-host circuit breakers shared by every thread or coroutine of a process.
+
+    Wrap each request in ``with breakers.attempt(url):``. It raises CircuitOpenError while the
+    host's circuit is open and records the request's outcome; only transient errors count as
+    failures, a 404 shows the host is up. A failure_threshold of 0 disables the breakers.
+    """
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, base_open_seconds=BASE_OPEN_SECONDS,
+                 max_open_seconds=MAX_OPEN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.base_open_seconds = base_open_seconds
+        self.max_open_seconds = max_open_seconds
+        self._breakers = {}
+        self._lock = threading.Lock()
+        get_metrics().register_gauge('circuit_breakers_open', self.open_count)
+
+    def breaker(self, url):
+        if not self.failure_threshold:
+            return None
+        host = urlparse(url).netloc or url
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(host, self.failure_threshold, self.base_open_seconds,
+                                                      self.max_open_seconds)
+            return self._breakers[host]
+
+    @contextmanager
+    def attempt(self, url):
+        breaker = self.breaker(url)
+        if breaker is None:
+            yield
+            return
+        probe = breaker.allow()
+        if probe is None:
+            get_metrics().inc('circuit_breaker_rejected_total', host=breaker.host)
+            raise CircuitOpenError(breaker.host, breaker.retry_in())
+        try:
+            yield
+        except Exception as e:
+            if is_transient(e):
+                breaker.record_failure(probe)
+            else:
+                breaker.record_success(probe)
+            raise
+        except BaseException:
+            breaker.release(probe)
+            raise
+        breaker.record_success(probe)
+
+    def open_count(self):
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return sum(1 for breaker in breakers if breaker.state != 'closed')
+
+    def all_probes_in(self):
+        # Seconds until every open circuit lets its next probe through
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return max([breaker.retry_in() for breaker in breakers if breaker.state == 'open'], default=0.0)
+
+    def snapshot(self):
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return [{'host': breaker.host, 'state': breaker.state, 'trips': breaker.trips}
+                for breaker in breakers if breaker.state != 'closed']
+
+
+_breakers = BreakerRegistry()
+
+
+def configure_circuit_breakers(failure_threshold=FAILURE_THRESHOLD, base_open_seconds=BASE_OPEN_SECONDS,
+                               max_open_seconds=MAX_OPEN_SECONDS):
+    global _breakers
+    _breakers = BreakerRegistry(failure_threshold, base_open_seconds, max_open_seconds)
+    return _breakers
+
+
+def get_circuit_breakers():
+    return _breakers
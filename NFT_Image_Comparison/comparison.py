@@ -1,8 +1,12 @@
 
 import imagehash
+import scipy.fftpack
+from scipy.ndimage import uniform_filter
 from skimage.metrics import structural_similarity as ssim
 from utils import *
 from processing import *
+from result_writer import get_writer
+from metrics import get_metrics
 from PIL import Image
 import logging
 import pandas as pd
@@ -11,41 +15,197 @@ import numpy as np
 # Set up logging
 logger = logging.getLogger(__name__)
 
-def compare_images(opensea_image, original_image, asset_id, results_path, opensea_extension, original_extension):
+# Cascade mode: pairs with a pHash difference of at most the first value are decided as the
+# same image, pairs with at least the second value as different images. Only pairs in between
+# are compared with SSIM and MSE.
+CASCADE_PHASH_BAND = (8, 64)
 
+def ssim_and_mse(opensea_image, original_image):
+    # Convert images to grayscale for SSIM computation
+    opensea_grey = np.array(opensea_image.convert('L'))
+    original_grey = np.array(original_image.convert('L'))
+
+    # Compute SSIM between two images
+    ssim_score = ssim(opensea_grey,original_grey)
+    
+    # Compute Mean Square Error between two images
+    if opensea_image.size != original_image.size:
+        raise ValueError("Images must be the same size for MSE calculation")
+    # Subtract in floating point, uint8 arithmetic would wrap around
+    mse_score = np.mean((opensea_grey.astype(np.float64) - original_grey.astype(np.float64)) ** 2)
+    return ssim_score, mse_score
+
+
+def compute_similarity(opensea_image, original_image):
+    ssim_score, mse_score = ssim_and_mse(opensea_image, original_image)
+
+    # Compute pHash for both images
+    opensea_phash = imagehash.phash(opensea_image, hash_size=16)
+    original_phash = imagehash.phash(original_image, hash_size=16)
+    phash_diff = opensea_phash - original_phash
+
+    return {
+        'ssim_score': ssim_score,
+        'mse_score' : mse_score,
+        'opensea_phash': str(opensea_phash),
+        'original_phash': str(original_phash),
+        'phash_difference': phash_diff,
+        'comparison_tier': 'full',
+    }
+
+
+def cascade_similarity(opensea_image, original_image, identical=False, phash_band=CASCADE_PHASH_BAND):
+    """compute_similarity that stops at the first tier able to decide the pair.
+
+    comparison_tier is 'identical' for pairs known to be the same content (same bytes or
+    CID), 'phash' for pairs decided by the pHash difference alone and 'full' for pairs in the
+    ambiguous band. ssim_score and mse_score are NaN for pairs decided by pHash.
+    """
+    opensea_phash = imagehash.phash(opensea_image, hash_size=16)
+    if identical:
+        return {
+            'ssim_score': 1.0,
+            'mse_score': 0.0,
+            'opensea_phash': str(opensea_phash),
+            'original_phash': str(opensea_phash),
+            'phash_difference': 0,
+            'comparison_tier': 'identical',
+        }
+
+    original_phash = imagehash.phash(original_image, hash_size=16)
+    phash_diff = opensea_phash - original_phash
+    ssim_score, mse_score, tier = np.nan, np.nan, 'phash'
+    if phash_band[0] < phash_diff < phash_band[1]:
+        ssim_score, mse_score = ssim_and_mse(opensea_image, original_image)
+        tier = 'full'
+
+    return {
+        'ssim_score': ssim_score,
+        'mse_score': mse_score,
+        'opensea_phash': str(opensea_phash),
+        'original_phash': str(original_phash),
+        'phash_difference': phash_diff,
+        'comparison_tier': tier,
+    }
+
+
+def to_grey_array(image):
+    # Stackable float32 greyscale array, the input format of compare_image_batch
+    return np.asarray(image.convert('L'), dtype=np.float32)
+
+
+def batch_ssim(opensea_stack, original_stack, win_size=7, data_range=255, K1=0.01, K2=0.03):
+    # Same computation as skimage's structural_similarity defaults (uniform 7x7 window,
+    # sample covariance, 8-bit data range), with each windowed filter run once over the whole stack
+    x = opensea_stack.astype(np.float64)
+    y = original_stack.astype(np.float64)
+    filter_size = (1, win_size, win_size)
+    cov_norm = win_size ** 2 / (win_size ** 2 - 1)
+
+    ux = uniform_filter(x, size=filter_size)
+    uy = uniform_filter(y, size=filter_size)
+    vx = cov_norm * (uniform_filter(x * x, size=filter_size) - ux * ux)
+    vy = cov_norm * (uniform_filter(y * y, size=filter_size) - uy * uy)
+    vxy = cov_norm * (uniform_filter(x * y, size=filter_size) - ux * uy)
+
+    C1 = (K1 * data_range) ** 2
+    C2 = (K2 * data_range) ** 2
+    S = ((2 * ux * uy + C1) * (2 * vxy + C2)) / ((ux ** 2 + uy ** 2 + C1) * (vx + vy + C2))
+
+    # Ignore the filter radius strip around the edges, as skimage does
+    pad = (win_size - 1) // 2
+    return S[:, pad:-pad, pad:-pad].mean(axis=(1, 2), dtype=np.float64)
+
+
+def batch_phash(stack, hash_size=16, highfreq_factor=4):
+    # imagehash.phash for every image of the stack: the LANCZOS downscale stays per image
+    # so the hashes are identical, the DCT and median thresholding run on the whole stack
+    img_size = hash_size * highfreq_factor
+    pixels = np.stack([
+        np.asarray(Image.fromarray(grey.astype(np.uint8)).resize((img_size, img_size), Image.Resampling.LANCZOS))
+        for grey in stack
+    ])
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=1), axis=2)
+    dctlowfreq = dct[:, :hash_size, :hash_size]
+    med = np.median(dctlowfreq.reshape(len(stack), -1), axis=1)
+    return dctlowfreq > med[:, None, None]
+
+
+def phash_to_hex(bits):
+    # Same hex string as str() of the equivalent imagehash.ImageHash
+    return np.packbits(bits.reshape(-1)).tobytes().hex()
+
+
+def compare_image_batch(opensea_stack, original_stack, phash_band=None):
+    """Score N image pairs at once.
+
+    Takes two (N, H, W) float32 stacks of greyscale values in [0, 255] (see to_grey_array) and
+    returns arrays of ssim_score, mse_score and phash_difference and lists of the opensea_phash,
+    original_phash and comparison_tier values, matching compute_similarity. With a phash_band,
+    SSIM and MSE are only computed for the pairs in the band, as in cascade_similarity.
+    """
+    if opensea_stack.shape != original_stack.shape:
+        raise ValueError("Images must be the same size for MSE calculation")
+
+    opensea_phashes = batch_phash(opensea_stack)
+    original_phashes = batch_phash(original_stack)
+    phash_diffs = np.count_nonzero(opensea_phashes != original_phashes, axis=(1, 2))
+
+    full = np.ones(len(phash_diffs), dtype=bool)
+    if phash_band is not None:
+        full = (phash_diffs > phash_band[0]) & (phash_diffs < phash_band[1])
+    ssim_scores = np.full(len(phash_diffs), np.nan)
+    mse_scores = np.full(len(phash_diffs), np.nan)
+    if full.any():
+        ssim_scores[full] = batch_ssim(opensea_stack[full], original_stack[full])
+        mse_scores[full] = np.mean((opensea_stack[full].astype(np.float64) - original_stack[full].astype(np.float64)) ** 2,
+                                   axis=(1, 2))
+
+    return {
+        'ssim_score': ssim_scores,
+        'mse_score': mse_scores,
+        'opensea_phash': [phash_to_hex(bits) for bits in opensea_phashes],
+        'original_phash': [phash_to_hex(bits) for bits in original_phashes],
+        'phash_difference': phash_diffs,
+        'comparison_tier': ['full' if is_full else 'phash' for is_full in full],
+    }
+
+
+def save_comparison_result(results, results_path):
+    writer = get_writer(results_path)
+    if writer is not None:
+        writer.write(results)
+        return
+    df_results = pd.DataFrame([results])
+    df_results.to_csv(results_path, mode='a', header=not pd.io.common.file_exists(results_path), index=False)
+
+
+def compare_images(opensea_image, original_image, asset_id, results_path, opensea_extension, original_extension,
+                   identical=False, phash_band=None, fields=None):
+    # phash_band switches to cascade_similarity; identical marks pairs with the same bytes or CID;
+    # fields are added to the record. Returns the saved record, or None if the comparison failed
+    metrics = get_metrics()
     try:
-        # Convert images to grayscale for SSIM computation
-        opensea_grey = np.array(opensea_image.convert('L'))
-        original_grey = np.array(original_image.convert('L'))
-
-        # Compute SSIM between two images
-        ssim_score = ssim(opensea_grey,original_grey)
-        
-        # Compute Mean Square Error between two images
-        if opensea_image.size != original_image.size:
-            raise ValueError("Images must be the same size for MSE calculation")
-        mse_score = np.mean((opensea_grey -original_grey) ** 2)
-        
-        # Compute pHash for both images
-        opensea_phash = imagehash.phash(opensea_image, hash_size=16)
-        original_phash = imagehash.phash(original_image, hash_size=16)
-        phash_diff = opensea_phash - original_phash
+        with metrics.timer('stage_seconds', stage='compare_images'):
+            if phash_band is not None:
+                similarity = cascade_similarity(opensea_image, original_image, identical, phash_band)
+            else:
+                similarity = compute_similarity(opensea_image, original_image)
 
         # Save the results to a CSV file
         results = {
             'asset_id': asset_id,
-            'ssim_score': ssim_score,
-            'mse_score' : mse_score,
-            #'opensea_phash': str(opensea_phash),
-            #'original_phash': str(original_phash),
-            'phash_difference': phash_diff,
+            **similarity,
             'opensea_extension': opensea_extension,
-            'original_extension': original_extension
+            'original_extension': original_extension,
+            **(fields or {}),
         }
-        df_results = pd.DataFrame([results])
-        df_results.to_csv(results_path, mode='a', header=not pd.io.common.file_exists(results_path), index=False)
+        save_comparison_result(results, results_path)
 
-        logger.info(f"Comparison for asset ID {asset_id} saved to {results_path}")
+        if metrics.should_log('comparison_saved'):
+            logger.info(f"Comparison for asset ID {asset_id} saved to {results_path}")
+        return results
     except Exception as e:
+        metrics.inc('errors_total', stage='compare_images', type=type(e).__name__)
         logger.error(f"Error comparing images for asset ID {asset_id}: {e}")
-
+        return None
@@ -0,0 +1,143 @@
+from multiprocessing import shared_memory
+import numpy as np
+from utils import decode_image, decode_inline_image, normalize_image, get_extension
+from comparison import compute_similarity, cascade_similarity, compare_image_batch, to_grey_array
+from metrics import get_metrics
+
+# Payloads smaller than this are pickled directly; larger ones go through shared memory
+SHARED_MEMORY_THRESHOLD = 64 * 1024
+
+
+def share_payload(content, content_type):
+    """Package downloaded bytes for a worker process.
+
+    Returns (payload, shm). Large contents are copied once into a shared memory block that
+    the caller must release with release_payload after the worker is done.
+    """
+    if len(content) < SHARED_MEMORY_THRESHOLD:
+        return ('bytes', content, content_type), None
+    shm = shared_memory.SharedMemory(create=True, size=len(content))
+    shm.buf[:len(content)] = content
+    return ('shm', shm.name, len(content), content_type), shm
+
+
+def inline_payload(url):
+    # Raw SVG and data URLs are decoded in the worker straight from the URL string
+    return ('inline', url), None
+
+
+def release_payload(shm):
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+
+def load_payload(payload):
+    # Runs in the worker: turn a payload back into (PIL image, content_type)
+    kind = payload[0]
+    if kind == 'inline':
+        return decode_inline_image(payload[1])
+    if kind == 'bytes':
+        _, content, content_type = payload
+        return decode_image(content, content_type)
+
+    _, name, size, content_type = payload
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        content = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+    return decode_image(content, content_type)
+
+
+def payload_content_type(payload):
+    # The content_type load_payload would return, without decoding downloaded bytes
+    if payload[0] == 'inline':
+        return load_payload(payload)[1]
+    content_type = payload[-1]
+    return 'image/svg+xml' if 'image/svg+xml' in content_type else content_type
+
+
+def score_pair(asset_id, opensea_payload, original_payload, size=(500, 500)):
+    """Decode, normalize and compare one image pair inside a worker process.
+
+    Only the small score record is sent back to the parent; exceptions propagate to the caller.
+    """
+    opensea_image, opensea_content_type = load_payload(opensea_payload)
+    original_image, original_content_type = load_payload(original_payload)
+    if opensea_image is None or original_image is None:
+        raise ValueError("Image could not be decoded")
+
+    opensea_image = normalize_image(opensea_image, size)
+    original_image = normalize_image(original_image, size)
+
+    return {
+        'asset_id': asset_id,
+        **compute_similarity(opensea_image, original_image),
+        'opensea_extension': get_extension(opensea_content_type),
+        'original_extension': get_extension(original_content_type)
+    }
+
+
+def score_pairs(items, size=(500, 500), phash_band=None):
+    """Batched score_pair: items is a list of (asset_id, opensea_payload, original_payload, identical).
+
+    All pairs that decode successfully are compared in one compare_image_batch call. Returns a
+    list aligned with items holding either the score record or the exception for that pair.
+    With a phash_band the comparison is tiered as in cascade_similarity, and identical pairs
+    (same bytes or CID) are not compared at all.
+    """
+    metrics = get_metrics()
+    results = [None] * len(items)
+    decoded = []
+    for i, (asset_id, opensea_payload, original_payload, identical) in enumerate(items):
+        try:
+            if identical and phash_band is not None:
+                with metrics.timer('stage_seconds', stage='decode'):
+                    opensea_image, opensea_content_type = load_payload(opensea_payload)
+                if opensea_image is None:
+                    raise ValueError("Image could not be decoded")
+                with metrics.timer('stage_seconds', stage='process_image'):
+                    opensea_image = normalize_image(opensea_image, size)
+                results[i] = {
+                    'asset_id': asset_id,
+                    **cascade_similarity(opensea_image, None, identical=True),
+                    'opensea_extension': get_extension(opensea_content_type),
+                    'original_extension': get_extension(payload_content_type(original_payload))
+                }
+                continue
+            with metrics.timer('stage_seconds', stage='decode'):
+                opensea_image, opensea_content_type = load_payload(opensea_payload)
+                original_image, original_content_type = load_payload(original_payload)
+            if opensea_image is None or original_image is None:
+                raise ValueError("Image could not be decoded")
+            with metrics.timer('stage_seconds', stage='process_image'):
+                opensea_array = to_grey_array(normalize_image(opensea_image, size))
+                original_array = to_grey_array(normalize_image(original_image, size))
+            decoded.append((i, asset_id, opensea_array, original_array, opensea_content_type, original_content_type))
+        except Exception as e:
+            metrics.inc('errors_total', stage='score_pairs', type=type(e).__name__)
+            results[i] = e
+
+    if decoded:
+        with metrics.timer('stage_seconds', stage='compare_image_batch'):
+            scores = compare_image_batch(np.stack([item[2] for item in decoded]),
+                                         np.stack([item[3] for item in decoded]), phash_band)
+        for j, (i, asset_id, _, _, opensea_content_type, original_content_type) in enumerate(decoded):
+            results[i] = {
+                'asset_id': asset_id,
+                'ssim_score': float(scores['ssim_score'][j]),
+                'mse_score': float(scores['mse_score'][j]),
+                'opensea_phash': scores['opensea_phash'][j],
+                'original_phash': scores['original_phash'][j],
+                'phash_difference': int(scores['phash_difference'][j]),
+                'comparison_tier': scores['comparison_tier'][j],
+                'opensea_extension': get_extension(opensea_content_type),
+                'original_extension': get_extension(original_content_type)
+            }
+    return results
+
+
+def score_pairs_with_metrics(items, size=(500, 500), phash_band=None):
+    # score_pairs plus the worker's metrics since its last call, for MetricsRegistry.merge in the parent
+    return score_pairs(items, size, phash_band), get_metrics().drain()
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+from urllib.parse import urlparse
+import aiohttp
+from image_cache import get_image_cache
+from rate_limiter import get_rate_limiter
+from response_body import ResponseBody, DOWNLOAD_CHUNK_SIZE
+from processing import get_image_urls
+from utils import image_cache_key, get_ipfs_path
+from metrics import get_metrics, BYTES_BUCKETS
+from circuit_breaker import CircuitOpenError, get_circuit_breakers
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Maximum number of simultaneous requests per host. Hosts not listed here use DEFAULT_HOST_LIMIT.
+HOST_LIMITS = {
+    'i.seadn.io': 64,
+    'ipfs:8080': 32,
+    'ipfs.io': 8,
+    'cloudflare-ipfs.com': 8,
+    'dweb.link': 8,
+    'gateway.pinata.cloud': 8,
+}
+DEFAULT_HOST_LIMIT = 16
+
+# Errors after which an IPFS image is retried on another gateway
+RETRYABLE_ERRORS = (aiohttp.ClientConnectionError, aiohttp.ClientResponseError, asyncio.TimeoutError, CircuitOpenError)
+
+
+def is_remote_url(url):
+    return isinstance(url, str) and url.startswith(('http://', 'https://'))
+
+
+class AsyncFetcher:
+    """Fetch image bytes over pooled keep-alive connections.
+
+    max_concurrency bounds the total number of requests in flight, host_limits bounds
+    the requests in flight per host (``netloc``, e.g. 'ipfs:8080'). With a gateway_pool,
+    IPFS images are fetched from its gateways with hedging instead of the URL's own host.
+    """
+
+    def __init__(self, max_concurrency=256, host_limits=None, default_host_limit=DEFAULT_HOST_LIMIT,
+                 timeout=60, retry_timeout=20, keepalive_timeout=30, max_throttle_retries=3, gateway_pool=None):
+        self.max_concurrency = max_concurrency
+        self.host_limits = dict(HOST_LIMITS, **(host_limits or {}))
+        self.default_host_limit = default_host_limit
+        self.timeout = timeout
+        self.retry_timeout = retry_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.max_throttle_retries = max_throttle_retries
+        self.gateway_pool = gateway_pool
+        self.session = None
+        self.in_flight = 0
+        self._global_semaphore = None
+        self._host_semaphores = {}
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=0,
+                                         keepalive_timeout=self.keepalive_timeout, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(connector=connector)
+        self._global_semaphore = asyncio.Semaphore(self.max_concurrency)
+        get_metrics().register_gauge('downloads_in_flight', lambda: self.in_flight)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+
+    def _host_semaphore(self, host):
+        if host not in self._host_semaphores:
+            limit = self.host_limits.get(host, self.default_host_limit)
+            self._host_semaphores[host] = asyncio.Semaphore(limit)
+        return self._host_semaphores[host]
+
+    async def fetch(self, url, timeout=None):
+        # Return (content, content_type) for url, raising on HTTP or network errors
+        loop = asyncio.get_running_loop()
+        metrics = get_metrics()
+        cache = get_image_cache()
+        if cache is not None:
+            cached = await loop.run_in_executor(None, cache.get, image_cache_key(url))
+            if cached is not None:
+                metrics.inc('image_cache_hits_total')
+                return cached
+
+        host = urlparse(url).netloc
+        start = loop.time()
+        try:
+            # Fails at once while the host's circuit breaker is open
+            with get_circuit_breakers().attempt(url):
+                content, content_type = await self._request(url, host, timeout)
+        except Exception as e:
+            metrics.inc('download_errors_total', host=host, type=type(e).__name__)
+            raise
+        metrics.observe('download_seconds', loop.time() - start, host=host)
+        metrics.observe('download_size_bytes', len(content), bounds=BYTES_BUCKETS, host=host)
+        metrics.inc('download_bytes_total', len(content), host=host)
+
+        if cache is not None:
+            await loop.run_in_executor(None, cache.put, image_cache_key(url), content, content_type)
+        return content, content_type
+
+    async def _request(self, url, host, timeout=None):
+        client_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        rate_limiter = get_rate_limiter()
+        for attempt in range(self.max_throttle_retries + 1):
+            await rate_limiter.acquire_async(url)
+            async with self._global_semaphore, self._host_semaphore(host):
+                self.in_flight += 1
+                try:
+                    async with self.session.get(url, timeout=client_timeout) as response:
+                        throttled = rate_limiter.feedback(url, response.status, response.headers)
+                        if throttled and attempt < self.max_throttle_retries:
+                            continue
+                        response.raise_for_status()
+                        body = ResponseBody(response.headers.get('Content-Type'), response.headers.get('Content-Length'))
+                        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                            body.feed(chunk)
+                        content, content_type = body.finish()
+                        break
+                finally:
+                    self.in_flight -= 1
+        return content, content_type
+
+    async def fetch_image(self, url, is_original_image=False):
+        ipfs_path = get_ipfs_path(url)
+        if ipfs_path and self.gateway_pool is not None:
+            return await self.gateway_pool.fetch_async(ipfs_path, self.fetch, RETRYABLE_ERRORS)
+
+        # Same fallback as utils.download_image: originals that fail on the local
+        # IPFS node are retried once on the public gateway.
+        try:
+            return await self.fetch(url)
+        except RETRYABLE_ERRORS as e:
+            if 'ipfs:8080' in url and is_original_image:
+                logger.error(f"Error downloading image {url}: {e!r}")
+                new_url = url.replace('http://ipfs:8080/ipfs/', 'https://ipfs.io/ipfs/')
+                logger.warning(f"Retrying with public gateway: {new_url}")
+                return await self.fetch(new_url, timeout=self.retry_timeout)
+            raise
+
+    async def prefetch_row_images(self, row):
+        # Fetch both images of a row concurrently. Returns {url: (content, content_type) or exception}
+        # suitable for processing.make_prefetched_downloader.
+        opensea_image_url, original_image_url = get_image_urls(row)
+        urls = [(url, is_original) for url, is_original in
+                ((opensea_image_url, False), (original_image_url, True)) if is_remote_url(url)]
+        results = await asyncio.gather(*(self.fetch_image(url, is_original) for url, is_original in urls),
+                                       return_exceptions=True)
+        return {url: result for (url, _), result in zip(urls, results)}
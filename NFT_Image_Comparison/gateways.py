@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from circuit_breaker import is_transient
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# IPFS gateways in order of preference until their latencies are known
+DEFAULT_GATEWAYS = [
+    'http://ipfs:8080',
+    'https://ipfs.io',
+    'https://dweb.link',
+    'https://gateway.pinata.cloud',
+]
+
+# Latency samples kept per gateway, and how many are needed before its p95 is trusted
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+
+# Hedge delay while a gateway has too few samples, and bounds for the p95-based delay
+DEFAULT_HEDGE_DELAY = 2.0
+MIN_HEDGE_DELAY = 0.2
+MAX_HEDGE_DELAY = 30.0
+
+# A gateway failing this many times in a row is skipped for a backoff that doubles with
+# every further failure
+MAX_CONSECUTIVE_FAILURES = 3
+BASE_UNHEALTHY_SECONDS = 30.0
+MAX_UNHEALTHY_SECONDS = 600.0
+
+# Threads calling fetch_sync concurrently when not configured; each may have 1 + max_hedges
+# requests running in the shared request pool
+DEFAULT_SYNC_WORKERS = 8
+
+
+class GatewayStats:
+    def __init__(self, gateway, rank):
+        self.gateway = gateway
+        self.rank = rank
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    def percentile(self, q):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+    def is_healthy(self, now):
+        return now >= self.unhealthy_until
+
+    def snapshot(self):
+        return {
+            'gateway': self.gateway,
+            'successes': self.successes,
+            'failures': self.failures,
+            'p50': self.percentile(0.50),
+            'p95': self.percentile(0.95),
+            'healthy': self.is_healthy(time.monotonic()),
+        }
+
+
+class GatewayPool:
+    """Health and latency tracking for a set of IPFS gateways.
+
+    ranked() orders the gateways by median latency, with unhealthy gateways last. A request
+    that takes longer than the chosen gateway's observed p95 is hedged with a request to the
+    next gateway; the first successful response wins. fetch_async cancels the loser, fetch_sync
+    abandons it (its thread finishes the request in the background). fetch_sync runs its requests
+    in a pool of workers * (1 + max_hedges) threads, so that workers threads calling it at once
+    never wait for a free thread.
+    """
+
+    def __init__(self, gateways=None, max_hedges=1, workers=DEFAULT_SYNC_WORKERS):
+        self.gateways = [gateway.rstrip('/') for gateway in (gateways or DEFAULT_GATEWAYS)]
+        self.max_hedges = max_hedges
+        self.workers = workers
+        self._stats = {gateway: GatewayStats(gateway, rank) for rank, gateway in enumerate(self.gateways)}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def url(self, gateway, ipfs_path):
+        return f"{gateway}/ipfs/{ipfs_path}"
+
+    def ranked(self):
+        now = time.monotonic()
+        with self._lock:
+            stats = list(self._stats.values())
+            return [s.gateway for s in sorted(stats, key=lambda s: (
+                not s.is_healthy(now),
+                s.percentile(0.5) if len(s.latencies) >= MIN_LATENCY_SAMPLES else 0.0,
+                s.rank))]
+
+    def hedge_delay(self, gateway):
+        with self._lock:
+            stats = self._stats[gateway]
+            if len(stats.latencies) < MIN_LATENCY_SAMPLES:
+                return DEFAULT_HEDGE_DELAY
+            return min(max(stats.percentile(0.95), MIN_HEDGE_DELAY), MAX_HEDGE_DELAY)
+
+    def record_success(self, gateway, latency):
+        with self._lock:
+            stats = self._stats[gateway]
+            stats.latencies.append(latency)
+            stats.successes += 1
+            stats.consecutive_failures = 0
+            stats.unhealthy_until = 0.0
+
+    def record_cancelled(self, gateway, elapsed):
+        # A request that lost the race took at least elapsed; keeping that as a sample lets a
+        # gateway that never wins fall behind in ranked()
+        with self._lock:
+            self._stats[gateway].latencies.append(elapsed)
+
+    def record_failure(self, gateway, error):
+        # Only transient failures (network errors, timeouts, 429/5xx) count against the gateway's
+        # health. A 404 for a CID that nobody has pinned says nothing about the gateway.
+        if not is_transient(error):
+            logger.info(f"IPFS gateway {gateway} could not serve the request: {error!r}")
+            return
+        with self._lock:
+            stats = self._stats[gateway]
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            if stats.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                backoff = BASE_UNHEALTHY_SECONDS * 2 ** (stats.consecutive_failures - MAX_CONSECUTIVE_FAILURES)
+                stats.unhealthy_until = time.monotonic() + min(backoff, MAX_UNHEALTHY_SECONDS)
+        logger.warning(f"IPFS gateway {gateway} failed: {error!r}")
+
+    def snapshot(self):
+        with self._lock:
+            return [stats.snapshot() for stats in self._stats.values()]
+
+    async def fetch_async(self, ipfs_path, fetch, gateway_errors):
+        """Fetch ipfs_path with hedging. fetch(url) is a coroutine function returning the content.
+
+        Exceptions of the types in gateway_errors move on to the next gateway, and count against
+        the gateway's health if they are transient (see record_failure); any other exception (e.g. a response that is not an image) is raised at once,
+        since every gateway serves the same content.
+        """
+        gateways = deque(self.ranked())
+        pending = {}
+        hedges = 0
+        last_error = None
+        try:
+            while True:
+                # One request, plus one more for each time the newest was slower than its p95
+                while gateways and len(pending) < 1 + min(hedges, self.max_hedges):
+                    gateway = gateways.popleft()
+                    pending[asyncio.ensure_future(fetch(self.url(gateway, ipfs_path)))] = (gateway, time.monotonic())
+                if not pending:
+                    raise last_error
+                newest = max(pending.values(), key=lambda started: started[1])[0]
+                done, _ = await asyncio.wait(pending, timeout=self.hedge_delay(newest),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                hedges += not done
+                for task in done:
+                    gateway, started = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except gateway_errors as e:
+                        self.record_failure(gateway, e)
+                        last_error = e
+                        continue
+                    self.record_success(gateway, time.monotonic() - started)
+                    return result
+        finally:
+            for task, (gateway, started) in pending.items():
+                task.cancel()
+                self.record_cancelled(gateway, time.monotonic() - started)
+
+    def fetch_sync(self, ipfs_path, fetch, gateway_errors):
+        # Blocking fetch_async: fetch(url) returns the content; requests are run in a thread pool.
+        # Latencies are timed from when a pool thread picks the request up, not from the submit.
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers * (1 + self.max_hedges),
+                                                    thread_name_prefix='GatewayPool')
+        gateways = deque(self.ranked())
+        pending = {}
+        hedges = 0
+        last_error = None
+        try:
+            while True:
+                while gateways and len(pending) < 1 + min(hedges, self.max_hedges):
+                    gateway = gateways.popleft()
+                    started = []
+                    future = self._executor.submit(timed_call, started, fetch, self.url(gateway, ipfs_path))
+                    pending[future] = (gateway, time.monotonic(), started)
+                if not pending:
+                    raise last_error
+                newest = max(pending.values(), key=lambda request: request[1])[0]
+                done, _ = wait(pending, timeout=self.hedge_delay(newest), return_when=FIRST_COMPLETED)
+                hedges += not done
+                for future in done:
+                    gateway, _, started = pending.pop(future)
+                    try:
+                        result, latency = future.result()
+                    except gateway_errors as e:
+                        self.record_failure(gateway, e)
+                        last_error = e
+                        continue
+                    self.record_success(gateway, latency)
+                    return result
+        finally:
+            for future, (gateway, _, started) in pending.items():
+                # A request cancelled before a thread picked it up says nothing about the gateway
+                if not future.cancel() and started:
+                    self.record_cancelled(gateway, time.monotonic() - started[0])
+
+
+def timed_call(started, fetch, url):
+    # Runs fetch(url) in a pool thread, appending the start time to started;
+    # returns the content and the time the request took
+    started.append(time.monotonic())
+    return fetch(url), time.monotonic() - started[0]
+
+
+_gateway_pool = GatewayPool()
+
+
+def configure_gateway_pool(gateways=None, max_hedges=1, workers=DEFAULT_SYNC_WORKERS):
+    global _gateway_pool
+    _gateway_pool = GatewayPool(gateways, max_hedges, workers) if gateways != [] else None
+    return _gateway_pool
+
+
+def get_gateway_pool():
+    return _gateway_pool
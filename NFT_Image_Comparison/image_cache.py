@@ -0,0 +1,106 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class ImageCache:
+    """Persistent on-disk cache of downloaded image bytes.
+
+    Entries are stored as <cache_dir>/<xx>/<sha256 of key>, holding the content type on the
+    first line followed by the raw bytes. Writes go to a temporary file that is atomically
+    renamed into place, so several processes can share one cache directory. Reads refresh
+    the entry's mtime, and once the cache grows past max_bytes the least recently used
+    entries are evicted down to low_watermark * max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024 ** 3, low_watermark=0.9):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.low_watermark = low_watermark
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(size for _, _, size in self._entries())
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def _entries(self):
+        # Yield (mtime, path, size) for every cache entry, skipping files removed concurrently
+        for directory, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.startswith('.tmp'):
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, path, stat.st_size
+
+    def get(self, key):
+        # Return (content, content_type) or None on a miss
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                content_type = f.readline().decode('utf-8').rstrip('\n')
+                content = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return content, content_type
+
+    def put(self, key, content, content_type):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        header = content_type.encode('utf-8') + b'\n'
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header)
+                f.write(content)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+        with self._lock:
+            self._size += len(header) + len(content)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Rescan so that entries written by other processes are accounted for
+        entries = sorted(self._entries())
+        total = sum(size for _, _, size in entries)
+        target = self.max_bytes * self.low_watermark
+        for _, path, size in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        logger.info(f"Image cache evicted down to {total} bytes")
+        self._size = total
+
+
+_image_cache = None
+
+
+def configure_image_cache(cache_dir, max_bytes=10 * 1024 ** 3):
+    # Enable the shared cache used by utils.download_image; a falsy cache_dir disables it
+    global _image_cache
+    _image_cache = ImageCache(cache_dir, max_bytes) if cache_dir else None
+    return _image_cache
+
+
+def get_image_cache():
+    return _image_cache
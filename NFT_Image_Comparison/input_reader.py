@@ -0,0 +1,142 @@
+"""Read the comparison input (a collector CSV or its Parquet conversion) in typed chunks of
+only the columns the pipeline uses, and iterate it as compact InputRow tuples.
+
+    python input_reader.py convert dataset.csv dataset.parquet
+"""
+import argparse
+import logging
+import os
+from collections import namedtuple
+import pandas as pd
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Columns read from the input, with their types. asset_id stays a string so that ids
+# are never turned into floats by gaps in the column.
+INPUT_COLUMNS = {
+    'asset_id': str,
+    'asset_img_url': str,
+    'asset_img_org_url': str,
+    'collection_slug': str,
+    'chain_identifier': str,
+}
+
+_InputRow = namedtuple('InputRow', list(INPUT_COLUMNS))
+
+
+class InputRow(_InputRow):
+    """One input row. Supports the parts of the pandas Series interface the pipeline uses:
+    row['asset_id'], row.get('asset_id') and row.to_dict()."""
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return _InputRow.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def to_dict(self):
+        return dict(zip(self._fields, self))
+
+
+def is_parquet(path):
+    return path.endswith('.parquet') or os.path.isdir(path)
+
+
+def _prune(df):
+    # Missing optional columns become empty, and the column order matches InputRow
+    return df.reindex(columns=list(INPUT_COLUMNS))
+
+
+def _read_csv_pyarrow(path, chunk_size):
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+
+    header = pd.read_csv(path, nrows=0).columns
+    columns = [column for column in INPUT_COLUMNS if column in header]
+    convert_options = pa_csv.ConvertOptions(include_columns=columns,
+                                            column_types={column: pa.string() for column in columns})
+    # block_size is in bytes; rows are regrouped into chunks of chunk_size below
+    reader = pa_csv.open_csv(path, convert_options=convert_options, read_options=pa_csv.ReadOptions(block_size=1 << 22))
+    pending = []
+    pending_rows = 0
+    for batch in reader:
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        if pending_rows >= chunk_size:
+            df = pa.Table.from_batches(pending).to_pandas()
+            pending, pending_rows = [], 0
+            for start in range(0, len(df), chunk_size):
+                yield df.iloc[start:start + chunk_size]
+    if pending:
+        yield pa.Table.from_batches(pending).to_pandas()
+
+
+def _read_parquet(path, chunk_size):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    # Also reads the collectors' Parquet output, partitioned by chain_identifier and event_date
+    # directories with dictionary-encoded collection columns
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    columns = {column: ds.field(column).cast(pa.string()) for column in INPUT_COLUMNS if column in dataset.schema.names}
+    for batch in dataset.to_batches(columns=columns, batch_size=chunk_size):
+        if batch.num_rows:
+            yield batch.to_pandas()
+
+
+def read_input(path, chunk_size=10000, engine='c'):
+    """Yield the input at path in DataFrames of at most chunk_size rows holding INPUT_COLUMNS.
+
+    Paths ending in .parquet (or directories of Parquet files, such as the collectors'
+    partitioned output) are read with pyarrow. CSV files
+    are parsed by pandas' C parser, or streamed by pyarrow's CSV reader with engine='pyarrow'.
+    """
+    if is_parquet(path):
+        chunks = _read_parquet(path, chunk_size)
+    elif engine == 'pyarrow':
+        chunks = _read_csv_pyarrow(path, chunk_size)
+    else:
+        chunks = pd.read_csv(path, usecols=lambda column: column in INPUT_COLUMNS, dtype=INPUT_COLUMNS,
+                             chunksize=chunk_size)
+    for chunk in chunks:
+        yield _prune(chunk)
+
+
+def iter_rows(df):
+    # InputRow tuples of a chunk from read_input, without building a Series per row
+    return map(InputRow._make, df.itertuples(index=False, name=None))
+
+
+def convert_to_parquet(csv_path, parquet_path, chunk_size=100000):
+    """Write the INPUT_COLUMNS of a collector CSV to a Parquet file, once, for faster reruns."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(column, pa.string()) for column in INPUT_COLUMNS])
+    rows = 0
+    with pq.ParquetWriter(parquet_path, schema) as writer:
+        for chunk in read_input(csv_path, chunk_size):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            rows += len(chunk)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert = subparsers.add_parser('convert', help='Convert a collector CSV to the Parquet input format')
+    convert.add_argument('csv_path')
+    convert.add_argument('parquet_path')
+    args = parser.parse_args()
+
+    rows = convert_to_parquet(args.csv_path, args.parquet_path)
+    logger.info(f"Wrote {rows} rows to {args.parquet_path}")
+
+
+if __name__ == '__main__':
+    main()
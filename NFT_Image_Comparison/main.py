@@ -3,8 +3,30 @@ import pandas as pd
 from processing import *
 from comparison import *
 from utils import *
+from fetcher import AsyncFetcher
+from image_cache import configure_image_cache
+from rate_limiter import configure_rate_limiter
+from gateways import DEFAULT_GATEWAYS, configure_gateway_pool, get_gateway_pool
+from response_body import max_download_bytes, set_max_download_bytes
+from result_writer import open_writer, close_writers
+from checkpoint_store import CheckpointStore, DoneView, FailedView, asset_key
+from phash_index import PhashIndex
+from analytics import ResultAnalytics
+from svg_render import configure_svg_render_pool
+from cpu_worker import share_payload, inline_payload, release_payload, score_pairs_with_metrics
+from metrics import get_metrics, set_log_sample_every, start_metrics_server, SnapshotWriter
+from sharding import select_shard, shard_path, validate_shard
+from planner import plan_chunk, ActiveAssets
+from input_reader import read_input
+from backpressure import InFlightLimit
+from circuit_breaker import FAILURE_THRESHOLD, BASE_OPEN_SECONDS, configure_circuit_breakers, get_circuit_breakers
+from retry_queue import MAX_ATTEMPTS, BASE_RETRY_SECONDS, configure_retry_queue, get_retry_queue
+import argparse
+import asyncio
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import threading
 import time
 
@@ -28,73 +50,538 @@ logger.addHandler(console_handler)
 csv_path = "missed_november.csv"
 results_csv_path = "/data/comparison_results.csv"
 error_log_path = "/data/error_log.csv"
+image_cache_dir = "/data/image_cache"
+checkpoint_path = "/data/checkpoint.sqlite"
+phash_index_path = "/data/phash_index.sqlite"
+analytics_path = "/data/analytics.sqlite"
+metrics_snapshot_path = "/data/metrics.json"
 
+# Input columns copied into every comparison record, so that results can be broken down
+# by them (see analytics.py) without joining them with the dataset
+RECORD_INPUT_COLUMNS = ('collection_slug', 'chain_identifier')
 
-# Initialize sets for processed IDs and errors logged
+# pHash band of the cascade comparison mode (see comparison.cascade_similarity); None compares every pair in full
+phash_band = None
+
+
+# Processed IDs and errors logged; main() replaces these with views over the checkpoint store
 processed_ids = set()
 errors_logged = set()
 
+# Assets left out of planning: processed_ids plus those of rows still in flight
+active_assets = ActiveAssets(processed_ids)
+
 # Locks for thread safety
 processed_ids_lock = threading.Lock()
 errors_logged_lock = threading.Lock()
 
 
-def process_row(row, processed_ids, errors_logged, processed_ids_lock, errors_logged_lock):
+def process_row(row, processed_ids, errors_logged, processed_ids_lock, errors_logged_lock, downloader=download_image,
+                duplicates=()):
+    # duplicates are rows with the same image URLs (see planner.plan_chunk) that share this row's outcome
     asset_id = row.get('asset_id')
 
     with processed_ids_lock:
         if asset_id in processed_ids:
-            logger.info(f"Asset ID {asset_id} has already been processed.")
+            log_already_processed(asset_id)
             return None
 
     try:
-        result = download_and_process_image(row, errors_logged)
+        result = download_and_process_image(row, errors_logged, downloader=downloader)
         if result['opensea_image'] and result['original_image']:
             # Compare images and write results
-            compare_images(result['opensea_image'], result['original_image'], asset_id, results_csv_path, result['opensea_extension'], result['original_extension'])
+            record = compare_images(result['opensea_image'], result['original_image'], asset_id, results_csv_path, result['opensea_extension'], result['original_extension'],
+                                    identical=result['identical'], phash_band=phash_band, fields=record_fields(row))
+            if record is None:
+                # Nothing was written, so the asset goes to the error log instead of processed_ids
+                get_metrics().inc('rows_total', status='error')
+                log_row_error(row, errors_logged, "Error comparing images")
+                fan_out_failure(asset_id, duplicates, "Error comparing images")
+                return None
             with processed_ids_lock:
                 processed_ids.add(asset_id)
+            get_metrics().inc('rows_total', status='processed')
+            fan_out_result(record, duplicates)
+        else:
+            get_metrics().inc('rows_total', status=failure_status(asset_id))
+            fan_out_failure(asset_id, duplicates, "Error downloading image")
         return asset_id
     except Exception as e:
-        logger.error(f"Error processing asset ID {asset_id}: {e}")
-        with errors_logged_lock:  # Acquire lock before modifying errors_logged
-            errors_logged.add(asset_id)
+        get_metrics().inc('rows_total', status='error')
+        log_row_error(row, errors_logged, f"Error processing: {e}")
+        fan_out_failure(asset_id, duplicates, f"Error processing: {e}")
+        return None
+
+
+def record_fields(row):
+    # The RECORD_INPUT_COLUMNS of an input row, empty where missing
+    fields = {}
+    for column in RECORD_INPUT_COLUMNS:
+        value = row.get(column)
+        fields[column] = '' if pd.isna(value) else value
+    return fields
+
+
+def fan_out_result(record, duplicates):
+    # Save a copy of the comparison record for every duplicate row, with that row's own input columns
+    for row in duplicates:
+        duplicate_id = row.get('asset_id')
+        save_comparison_result({**record, 'asset_id': duplicate_id, **record_fields(row)}, results_csv_path)
+        with processed_ids_lock:
+            processed_ids.add(duplicate_id)
+        get_metrics().inc('rows_total', status='deduplicated')
+
+
+def fan_out_failure(asset_id, duplicates, error_type):
+    # Duplicates of an asset queued for a retry are retried with it
+    retry_queue = get_retry_queue()
+    deferred = retry_queue is not None and retry_queue.is_deferred(asset_id)
+    for row in duplicates:
+        error_type_of_row = f"{error_type} (same images as asset ID {asset_id})"
+        if deferred and retry_queue.defer(row.get('asset_id'), error_type_of_row):
+            get_metrics().inc('rows_total', status='deferred')
+            continue
+        log_row_error(row, errors_logged, error_type_of_row)
+        get_metrics().inc('rows_total', status='error')
+
+
+def failure_status(asset_id):
+    # rows_total status of a row whose download failed
+    retry_queue = get_retry_queue()
+    return 'deferred' if retry_queue is not None and retry_queue.is_deferred(asset_id) else 'error'
+
+
+def plan_batch(df_batch):
+    # Unique image pairs of the batch, leaving out assets that are already done or in flight.
+    # The pipeline releases the assets of each item once it has finished.
+    work = plan_chunk(df_batch, active_assets)
+    active_assets.claim(work)
+    planned = sum(1 + len(duplicates) for _, duplicates in work)
+    get_metrics().inc('rows_total', len(df_batch) - planned, status='skipped')
+    return work
+
+
+def log_already_processed(asset_id):
+    metrics = get_metrics()
+    metrics.inc('rows_total', status='skipped')
+    if metrics.should_log('already_processed'):
+        logger.info(f"Asset ID {asset_id} has already been processed.")
+
+
+def process_stream(work_chunks, processed_ids, errors_logged, limit, max_workers=5):
+    # work_chunks yields the planned (row, duplicates) items of each chunk; limit bounds the rows in progress
+    def handle_row(row, duplicates):
+        return process_row(row, processed_ids, errors_logged, processed_ids_lock, errors_logged_lock,
+                           download_image, duplicates)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        limit.run(executor, handle_row, work_chunks, on_done=active_assets.release)
+
+
+async def process_stream_async(work_chunks, processed_ids, errors_logged, fetcher, executor, limit):
+    # Downloads run on the event loop; decoding, processing and comparison run on the executor
+    loop = asyncio.get_running_loop()
+
+    async def handle_row(row, duplicates):
+        asset_id = row.get('asset_id')
+        with processed_ids_lock:
+            if asset_id in processed_ids:
+                log_already_processed(asset_id)
+                return None
+
+        payloads = await fetcher.prefetch_row_images(row)
+        downloader = make_prefetched_downloader(payloads)
+        return await loop.run_in_executor(executor, process_row, row, processed_ids, errors_logged,
+                                          processed_ids_lock, errors_logged_lock, downloader, duplicates)
+
+    await limit.run_async(handle_row, work_chunks, on_done=active_assets.release)
+
+
+def log_row_error(row, errors_logged, error_type):
+    asset_id = row.get('asset_id')
+    with errors_logged_lock:
+        if asset_id in errors_logged:
+            return
+        errors_logged.add(asset_id)
+    logger.error(f"{error_type} for asset ID {asset_id}")
+    error_data = row.to_dict()
+    error_data['error_type'] = error_type
+    log_error_to_csv(error_data, error_log_path)
+
+
+class PairBatcher:
+    """Collect image pairs from concurrent row handlers and score them in the process pool
+    in batches of batch_size, or whatever has accumulated after max_delay seconds."""
+
+    def __init__(self, process_pool, batch_size=8, max_delay=0.05, phash_band=None):
+        self.process_pool = process_pool
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.phash_band = phash_band
+        self._pending = []
+        self._timer = None
+        get_metrics().register_gauge('pairs_pending', lambda: len(self._pending))
+
+    async def score(self, asset_id, opensea_payload, original_payload, identical=False):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(((asset_id, opensea_payload, original_payload, identical), future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        loop = asyncio.get_running_loop()
+        task = loop.run_in_executor(self.process_pool, score_pairs_with_metrics, [item for item, _ in batch], (500, 500), self.phash_band)
+
+        def distribute(task):
+            futures = [future for _, future in batch]
+            if task.exception() is not None:
+                results = [task.exception()] * len(futures)
+            else:
+                results, worker_metrics = task.result()
+                get_metrics().merge(worker_metrics)
+            for future, result in zip(futures, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+        task.add_done_callback(distribute)
+
+
+async def process_stream_staged(work_chunks, processed_ids, errors_logged, fetcher, batcher, limit):
+    # Downloads run on the event loop. The raw bytes are handed to worker processes through
+    # shared memory, and decoding, normalization and batched comparison run there on every core.
+    async def handle_row(row, duplicates):
+        asset_id = row.get('asset_id')
+        with processed_ids_lock:
+            if asset_id in processed_ids:
+                log_already_processed(asset_id)
+                return None
+
+        payloads = await fetcher.prefetch_row_images(row)
+        shared_blocks = []
+        try:
+            pair = []
+            urls = get_image_urls(row)
+            for url in urls:
+                if url in payloads:
+                    if isinstance(payloads[url], Exception):
+                        log_download_error(url, row, errors_logged, payloads[url])
+                        get_metrics().inc('rows_total', status=failure_status(asset_id))
+                        fan_out_failure(asset_id, duplicates, "Error downloading image")
+                        return None
+                    payload, shm = share_payload(*payloads[url])
+                    shared_blocks.append(shm)
+                elif isinstance(url, str) and is_inline_image(url):
+                    payload, shm = inline_payload(url)
+                else:
+                    raise ValueError(f"Unsupported image URL: {url}")
+                pair.append(payload)
+
+            contents = [payloads[url][0] if url in payloads else None for url in urls]
+            record = await batcher.score(asset_id, *pair, identical=is_same_content(*urls, *contents))
+        except Exception as e:
+            get_metrics().inc('rows_total', status='error')
+            log_row_error(row, errors_logged, f"Error processing: {e}")
+            fan_out_failure(asset_id, duplicates, f"Error processing: {e}")
+            return None
+        finally:
+            for shm in shared_blocks:
+                release_payload(shm)
+
+        record = {**record, **record_fields(row)}
+        save_comparison_result(record, results_csv_path)
+        get_metrics().inc('rows_total', status='processed')
+        if get_metrics().should_log('comparison_saved'):
+            logger.info(f"Comparison for asset ID {asset_id} saved to {results_csv_path}")
         with processed_ids_lock:
             processed_ids.add(asset_id)
-        return None
+        fan_out_result(record, duplicates)
+        return asset_id
+
+    await limit.run_async(handle_row, work_chunks, on_done=active_assets.release)
+
+
+async def process_csv_async(csv_path, chunk_size, args, asset_ids=None):
+    async with AsyncFetcher(max_concurrency=args.max_concurrency, host_limits=args.host_limits,
+                            default_host_limit=args.default_host_limit, gateway_pool=get_gateway_pool()) as fetcher:
+        if args.mode == 'staged':
+            executor = ProcessPoolExecutor(max_workers=args.processes, mp_context=multiprocessing.get_context('spawn'),
+                                           initializer=set_max_image_pixels, initargs=(args.max_image_pixels,))
+        else:
+            executor = ThreadPoolExecutor(max_workers=args.workers)
+
+        limit = InFlightLimit(args.max_in_flight, args.max_rss_mb * 1024 * 1024)
+        work_chunks = iter_work_chunks(csv_path, chunk_size, args, asset_ids)
+        with executor:
+            if args.mode == 'staged':
+                batcher = PairBatcher(executor, batch_size=args.compare_batch_size, phash_band=phash_band)
+                await process_stream_staged(work_chunks, processed_ids, errors_logged, fetcher, batcher, limit)
+            else:
+                await process_stream_async(work_chunks, processed_ids, errors_logged, fetcher, executor, limit)
+
+
+def read_input_chunks(csv_path, chunk_size, args, asset_ids=None):
+    # The dataset in chunks of chunk_size rows, restricted to this process's shard and,
+    # if given, to the assets whose keys are in asset_ids
+    for chunk in read_input(csv_path, chunk_size, args.input_engine):
+        chunk = select_shard(chunk, args.shard_index, args.shard_count)
+        if asset_ids is not None:
+            chunk = chunk[chunk['asset_id'].map(asset_key).isin(asset_ids)]
+        if len(chunk):
+            yield chunk
+
+
+def iter_work_chunks(csv_path, chunk_size, args, asset_ids=None):
+    # The planned (row, duplicates) work items of each chunk, planned only when the pipeline needs more work
+    for chunk in read_input_chunks(csv_path, chunk_size, args, asset_ids):
+        yield plan_batch(chunk)
+
+
+def run_pass(args, asset_ids=None):
+    # One pass over the input, or over the rows of asset_ids only
+    if args.mode in ('staged', 'async'):
+        asyncio.run(process_csv_async(args.csv_path, args.chunk_size, args, asset_ids))
+    else:
+        process_stream(iter_work_chunks(args.csv_path, args.chunk_size, args, asset_ids), processed_ids, errors_logged,
+                       InFlightLimit(args.max_in_flight, args.max_rss_mb * 1024 * 1024), max_workers=args.workers)
+
 
+def run_retry_passes(args):
+    # Retry the assets whose downloads failed transiently, each pass once all of them are due
+    # and the open circuits accept probes again. An asset failing its last attempt is logged as an error.
+    retry_queue = get_retry_queue()
+    if retry_queue is None:
+        return
+    for retry_pass in range(1, retry_queue.max_attempts):
+        due_in = retry_queue.all_due_in()
+        if due_in is None:
+            return
+        due_in = max(due_in, get_circuit_breakers().all_probes_in())
+        if due_in > 0:
+            logger.info(f"Waiting {due_in:.0f}s before retry pass {retry_pass}")
+            time.sleep(due_in)
+        asset_ids = retry_queue.take_due()
+        logger.info(f"Retry pass {retry_pass}: retrying {len(asset_ids)} assets")
+        run_pass(args, asset_ids)
 
-def process_batch(df_batch, processed_ids, errors_logged):
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        future_to_row = {executor.submit(process_row, row, processed_ids, errors_logged, processed_ids_lock, errors_logged_lock): row for _, row in df_batch.iterrows()}
 
-        for future in as_completed(future_to_row):
-            future.result()
-def initialize_processed_and_error_sets(processed_ids, errors_logged, results_csv_path, error_log_path):
-    # Read asset_ids from comparison_results.csv
+def initialize_checkpoint_store(checkpoint_path, results_csv_path, error_log_path):
+    store = CheckpointStore(checkpoint_path)
+    # Seed a new store from the results and error log of runs made before it existed
+    if store.is_empty():
+        done = store.import_output(results_csv_path, 'done')
+        failed = store.import_output(error_log_path, 'failed')
+        logger.info(f"Imported {done} results and {failed} errors into {checkpoint_path}")
+    logger.info(f"Checkpoint store {checkpoint_path}: {store.counts()}")
+    return store
+
+
+def host_limit(value):
+    # Parse a HOST=N command line value, e.g. 'ipfs:8080=32'
     try:
-        comparison_results = pd.read_csv(results_csv_path)
-        for asset_id in comparison_results['asset_id']:
-            processed_ids.add(asset_id)
-    except FileNotFoundError:
-        logger.info(f"No existing comparison results found at {results_csv_path}")
+        host, limit = value.rsplit('=', 1)
+        return host, int(limit)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected HOST=N, got {value!r}")
+
+
+def host_rate(value):
+    # Parse a HOST=RATE[:MAX_RATE] command line value in requests per second, e.g. 'i.seadn.io=50:200'
+    try:
+        host, rates = value.rsplit('=', 1)
+        rate, _, max_rate = rates.partition(':')
+        return host, (float(rate), float(max_rate or rate))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected HOST=RATE[:MAX_RATE], got {value!r}")
+
+
+def phash_band_range(value):
+    # Parse a LOW:HIGH command line value, e.g. '8:64'
+    try:
+        low, high = value.split(':')
+        return int(low), int(high)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected LOW:HIGH, got {value!r}")
 
-    # Read asset_ids from error_log.csv
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--csv_path', default=csv_path,
+                        help='Input dataset: a collector CSV, or a .parquet file written by input_reader.py convert')
+    parser.add_argument('--input_engine', choices=['c', 'pyarrow'], default='c',
+                        help='CSV parser for the input: pandas C parser or the streaming pyarrow reader')
+    parser.add_argument('--mode', choices=['staged', 'async', 'threads'], default='staged',
+                        help='staged: asyncio downloads feeding a process pool for decoding and comparison. '
+                             'async: asyncio downloads feeding a thread pool. '
+                             'threads: the original thread pool, one blocking download per worker')
+    parser.add_argument('--workers', type=int, default=5,
+                        help='Worker threads for image processing and comparison (async mode; threads mode: for everything)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='Worker processes for decoding and comparison (staged mode)')
+    parser.add_argument('--svg_processes', type=int, default=2,
+                        help='Worker processes rendering SVGs (async and threads modes). 0 renders in the worker threads')
+    parser.add_argument('--compare_batch_size', type=int, default=8,
+                        help='Image pairs scored per batched comparison call (staged mode)')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='Input rows read and planned at a time')
+    parser.add_argument('--max_in_flight', type=int,
+                        help='Maximum rows downloaded or processed at once; the next rows start as earlier ones finish. '
+                             'Default: 4 per worker thread (threads mode), half of --max_concurrency (async and staged modes)')
+    parser.add_argument('--max_rss_mb', type=int, default=0,
+                        help='Start no new rows while the process uses more memory than this. 0 disables the ceiling')
+    parser.add_argument('--max_concurrency', type=int, default=256, help='Maximum downloads in flight (async mode)')
+    parser.add_argument('--default_host_limit', type=int, default=16,
+                        help='Maximum downloads in flight per host without an explicit --host_limit (async mode)')
+    parser.add_argument('--host_limit', dest='host_limits', type=host_limit, action='append', default=[],
+                        help='Per-host download limit as HOST=N, may be repeated (async mode)')
+    parser.add_argument('--host_rate', dest='host_rates', type=host_rate, action='append', default=[],
+                        help='Starting and maximum requests per second for a host as HOST=RATE[:MAX_RATE], may be repeated. '
+                             'The rate adapts between these to 429/503 responses')
+    parser.add_argument('--gateway', dest='gateways', action='append', default=[],
+                        help=f"IPFS gateway base URL, may be repeated. Default: {' '.join(DEFAULT_GATEWAYS)}")
+    parser.add_argument('--max_hedges', type=int, default=1,
+                        help='Extra gateways asked for an IPFS image while the first is slower than its p95 latency. '
+                             '0 only fails over to the next gateway after an error')
+    parser.add_argument('--breaker_failures', type=int, default=FAILURE_THRESHOLD,
+                        help='Consecutive network errors, timeouts or 429/5xx responses after which requests to a host '
+                             'fail at once until a probe request succeeds. 0 disables the circuit breakers')
+    parser.add_argument('--breaker_cooldown', type=float, default=BASE_OPEN_SECONDS,
+                        help='Seconds before the first probe of a host whose circuit opened, doubling after every failed probe')
+    parser.add_argument('--retry_attempts', type=int, default=MAX_ATTEMPTS,
+                        help='Attempts per asset whose download fails transiently; failures are retried in passes '
+                             'after the main pass and logged as errors after the last attempt. 1 logs them at once')
+    parser.add_argument('--retry_backoff', type=float, default=BASE_RETRY_SECONDS,
+                        help='Seconds between the failure of an asset and its first retry, doubling with every further attempt')
+    parser.add_argument('--shard_index', type=int, default=int(os.environ.get('SHARD_INDEX', 0)),
+                        help='Process only the assets of this shard (default: $SHARD_INDEX or 0)')
+    parser.add_argument('--shard_count', type=int, default=int(os.environ.get('SHARD_COUNT', 1)),
+                        help='Split the dataset by asset_id hash into this many shards, each with its own '
+                             'results, error log, checkpoint and pHash index files (default: $SHARD_COUNT or 1). '
+                             'Combine the shards with merge_shards.py')
+    parser.add_argument('--cascade', action='store_true',
+                        help='Decide pairs with identical content or a clear pHash difference without computing SSIM and MSE')
+    parser.add_argument('--phash_band', type=phash_band_range, default=CASCADE_PHASH_BAND,
+                        help='pHash differences LOW:HIGH between which --cascade computes SSIM and MSE (exclusive)')
+    parser.add_argument('--cache_dir', default=image_cache_dir,
+                        help='Directory of the persistent image cache shared by all workers. Empty string disables it')
+    parser.add_argument('--results_path', default=results_csv_path, help='Comparison results output')
+    parser.add_argument('--error_log_path', default=error_log_path, help='Error log output')
+    parser.add_argument('--checkpoint_path', default=checkpoint_path, help='SQLite file recording per-asset status for resume')
+    parser.add_argument('--phash_index', default=phash_index_path,
+                        help='pHash index updated with every written result (see phash_index.py). Empty string disables it')
+    parser.add_argument('--analytics', default=analytics_path,
+                        help='Score aggregates updated with every written result (see analytics.py). Empty string disables it')
+    parser.add_argument('--metrics_port', type=int, default=9108,
+                        help='Port of the HTTP metrics endpoint (/metrics, /metrics.json). 0 disables it')
+    parser.add_argument('--metrics_path', default=metrics_snapshot_path,
+                        help='JSON metrics snapshot rewritten every --metrics_interval seconds. Empty string disables it')
+    parser.add_argument('--metrics_interval', type=float, default=30.0, help='Seconds between metrics snapshots')
+    parser.add_argument('--log_sample_every', type=int, default=1000,
+                        help='Per-asset INFO messages are logged once per this many assets')
+    parser.add_argument('--output_format', choices=['csv', 'parquet'], default='csv',
+                        help='Format of the comparison results and error log')
+    parser.add_argument('--flush_rows', type=int, default=500, help='Rows buffered before the writers flush')
+    parser.add_argument('--flush_seconds', type=float, default=5.0, help='Maximum seconds between writer flushes')
+    parser.add_argument('--cache_max_mb', type=int, default=10240, help='Image cache size limit in MB')
+    parser.add_argument('--max_image_pixels', type=int, default=max_image_pixels,
+                        help='Images with more pixels are rejected before decoding. 0 disables the check')
+    parser.add_argument('--max_download_mb', type=float, default=max_download_bytes / (1024 * 1024),
+                        help='Downloads larger than this are aborted. 0 disables the limit')
+    args = parser.parse_args()
     try:
-        error_log = pd.read_csv(error_log_path)
-        for asset_id in error_log['asset_id']:
-            errors_logged.add(asset_id)
-    except FileNotFoundError:
-        logger.info(f"No existing error log found at {error_log_path}")
+        validate_shard(args.shard_index, args.shard_count)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.max_in_flight is None:
+        args.max_in_flight = 4 * args.workers if args.mode == 'threads' else max(args.max_concurrency // 2, 1)
+    args.host_limits = dict(args.host_limits)
+    args.host_rates = dict(args.host_rates)
+    return args
+
 
 def main():
-    # Initialize sets with existing processed IDs and errors
-    initialize_processed_and_error_sets(processed_ids, errors_logged, results_csv_path, error_log_path)
+    args = parse_args()
+    configure_image_cache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
+    configure_rate_limiter(args.host_rates)
+    configure_gateway_pool(args.gateways or DEFAULT_GATEWAYS, args.max_hedges, args.workers)
+    configure_circuit_breakers(args.breaker_failures, args.breaker_cooldown)
+    set_max_image_pixels(args.max_image_pixels)
+    set_max_download_bytes(int(args.max_download_mb * 1024 * 1024))
+    set_log_sample_every(args.log_sample_every)
+
+    # Every shard writes and resumes from its own files
+    if args.shard_count > 1:
+        logger.info(f"Processing shard {args.shard_index} of {args.shard_count}")
+        for option in ('results_path', 'error_log_path', 'checkpoint_path', 'phash_index', 'analytics', 'metrics_path'):
+            setattr(args, option, shard_path(getattr(args, option), args.shard_index, args.shard_count))
+
+    global processed_ids, errors_logged, active_assets, results_csv_path, error_log_path, phash_band
+    results_csv_path = args.results_path
+    phash_band = args.phash_band if args.cascade else None
+    error_log_path = args.error_log_path
+    set_error_log_path(error_log_path)
+
+    store = initialize_checkpoint_store(args.checkpoint_path, results_csv_path, error_log_path)
+    processed_ids = DoneView(store)
+    errors_logged = FailedView(store)
+    active_assets = ActiveAssets(processed_ids)
+    configure_retry_queue(store, args.retry_attempts, args.retry_backoff)
 
-    chunk_size = 10000
-    for chunk in pd.read_csv(csv_path, chunksize=chunk_size):
-        process_batch(chunk, processed_ids, errors_logged)
-        time.sleep(60)
+    # All results and errors go through one buffered writer per file, which commits
+    # the assets' status to the checkpoint store after each flush
+    on_results_flush = [processed_ids.commit]
+    if args.phash_index:
+        on_results_flush.append(PhashIndex(args.phash_index).add_records)
+    if args.analytics:
+        on_results_flush.append(ResultAnalytics(args.analytics).add_records)
+    open_writer(results_csv_path, file_format=args.output_format, batch_size=args.flush_rows,
+                flush_interval=args.flush_seconds, on_flush=on_results_flush)
+    open_writer(error_log_path, file_format=args.output_format, batch_size=args.flush_rows,
+                flush_interval=args.flush_seconds, on_flush=[errors_logged.commit])
+
+    # Latency histograms, byte and error counters and queue depths of every stage
+    metrics_server = start_metrics_server(args.metrics_port) if args.metrics_port else None
+    snapshot_writer = SnapshotWriter(args.metrics_path, args.metrics_interval).start() if args.metrics_path else None
+
+    # Staged mode already renders SVGs in its worker processes
+    svg_pool = None
+    if args.mode != 'staged' and args.svg_processes:
+        svg_pool = ProcessPoolExecutor(max_workers=args.svg_processes, mp_context=multiprocessing.get_context('spawn'))
+        configure_svg_render_pool(svg_pool)
+
+    try:
+        run_pass(args)
+        run_retry_passes(args)
+    finally:
+        # A writer that could not write all its records fails the run, after the cleanup below
+        try:
+            close_writers()
+        finally:
+            for stats in get_gateway_pool().snapshot():
+                logger.info(f"IPFS gateway {stats['gateway']}: {stats['successes']} ok, {stats['failures']} failed, "
+                            f"p50 {stats['p50']}, p95 {stats['p95']}")
+            for breaker in get_circuit_breakers().snapshot():
+                logger.info(f"Circuit for {breaker['host']} is {breaker['state']} after {breaker['trips']} trips")
+            logger.info(f"Checkpoint store {args.checkpoint_path}: {store.counts()}")
+            if svg_pool is not None:
+                svg_pool.shutdown()
+            if snapshot_writer is not None:
+                snapshot_writer.stop()
+            if metrics_server is not None:
+                metrics_server.shutdown()
 
 if __name__ == "__main__":
     main()
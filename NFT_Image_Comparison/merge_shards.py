@@ -0,0 +1,90 @@
+"""Combine the outputs of a sharded run (main.py --shard_count N) into one result set.
+
+Results of all shards, and of an unsharded run that wrote to the base path before, are
+concatenated and deduplicated by asset_id, keeping the last result written. Errors of assets
+that have a result in any shard are dropped.
+
+    python merge_shards.py --shard_count 4
+    python merge_shards.py --shard_count 4 --results_path /data/comparison_results.csv --output_format parquet
+"""
+import argparse
+import logging
+import os
+import pandas as pd
+from checkpoint_store import asset_key
+from result_writer import parquet_output_path, read_parquet_output
+from sharding import shard_path
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def read_output(path):
+    # A CSV output file or the Parquet directory written in its place; None if neither exists
+    if os.path.exists(path):
+        return pd.read_csv(path, dtype={'asset_id': str})
+    if os.path.isdir(parquet_output_path(path)):
+        return read_parquet_output(path)
+    return None
+
+
+def read_shards(path, shard_count):
+    frames = []
+    for shard_index in [None] + list(range(shard_count)):
+        part_path = path if shard_index is None else shard_path(path, shard_index, shard_count)
+        df = read_output(part_path)
+        if df is None:
+            if shard_index is not None:
+                logger.warning(f"No output for shard {shard_index} at {part_path}")
+            continue
+        logger.info(f"Read {len(df)} rows from {part_path}")
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=['asset_id'])
+    df = pd.concat(frames, ignore_index=True)
+    df['asset_id'] = df['asset_id'].map(asset_key)
+    return df
+
+
+def write_output(df, path, output_format):
+    # Written next to path and renamed over it, so an interrupted merge leaves the old file intact
+    temp_path = f"{path}.tmp"
+    if output_format == 'csv':
+        df.to_csv(temp_path, index=False)
+    else:
+        df.to_parquet(temp_path, index=False)
+    os.replace(temp_path, path)
+
+
+def merge_shards(results_path, error_log_path, shard_count, output_format='csv', out_dir=None):
+    results = read_shards(results_path, shard_count).drop_duplicates('asset_id', keep='last')
+    errors = read_shards(error_log_path, shard_count)
+    errors = errors[~errors['asset_id'].isin(results['asset_id'])].drop_duplicates('asset_id', keep='last')
+
+    paths = []
+    for df, path in ((results, results_path), (errors, error_log_path)):
+        if out_dir:
+            path = os.path.join(out_dir, os.path.basename(path))
+        if output_format == 'parquet':
+            path = os.path.splitext(path)[0] + '.merged.parquet'
+        write_output(df, path, output_format)
+        paths.append(path)
+        logger.info(f"Wrote {len(df)} rows to {path}")
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shard_count', type=int, required=True, help='Number of shards of the run')
+    parser.add_argument('--results_path', default='/data/comparison_results.csv', help='Base path of the results')
+    parser.add_argument('--error_log_path', default='/data/error_log.csv', help='Base path of the error log')
+    parser.add_argument('--output_format', choices=['csv', 'parquet'], default='csv',
+                        help='csv replaces the files at the base paths, parquet writes <base>.merged.parquet')
+    parser.add_argument('--out_dir', help='Write the merged files into this directory instead')
+    args = parser.parse_args()
+    merge_shards(args.results_path, args.error_log_path, args.shard_count, args.output_format, args.out_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds for stage latencies in seconds, and for sizes in bytes
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1 KiB .. 256 MiB
+
+# Per-asset INFO messages are logged once per this many occurrences of the same message kind
+log_sample_every = 1000
+
+
+class Histogram:
+    """Fixed-bucket histogram; quantiles are interpolated within the bucket."""
+
+    def __init__(self, bounds=SECONDS_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.bounds[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+    def merge(self, data):
+        for i, count in enumerate(data['counts']):
+            self.counts[i] += count
+        self.sum += data['sum']
+        self.count += data['count']
+
+    def to_dict(self):
+        return {
+            'bounds': list(self.bounds), 'counts': list(self.counts), 'sum': self.sum, 'count': self.count,
+            'p50': self.quantile(0.50), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99),
+        }
+
+
+class MetricsRegistry:
+    """Thread-safe counters, gauges and histograms keyed by name and labels.
+
+    Gauges registered with a callable are evaluated when a snapshot is taken, so queue
+    depths cost nothing on the hot path. Worker processes drain() their registry and the
+    parent merge()s the result.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._gauge_functions = {}
+        self._histograms = {}
+        self._log_counts = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def register_gauge(self, name, function, **labels):
+        with self._lock:
+            self._gauge_functions[(name, tuple(sorted(labels.items())))] = function
+
+    def observe(self, name, value, bounds=SECONDS_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(bounds)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def should_log(self, kind, every=None):
+        # True for the first and then every n-th message of this kind
+        every = every or log_sample_every
+        with self._lock:
+            count = self._log_counts.get(kind, 0)
+            self._log_counts[kind] = count + 1
+        return count % every == 0
+
+    def snapshot(self):
+        gauges = {}
+        for key, function in list(self._gauge_functions.items()):
+            try:
+                gauges[key] = function()
+            except Exception as e:
+                logger.warning(f"Gauge {key[0]} failed: {e}")
+        with self._lock:
+            gauges.update(self._gauges)
+            return {
+                'time': time.time(),
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self._counters.items())],
+                'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                           for (name, labels), value in sorted(gauges.items())],
+                'histograms': [{'name': name, 'labels': dict(labels), **histogram.to_dict()}
+                               for (name, labels), histogram in sorted(self._histograms.items())],
+            }
+
+    def drain(self):
+        # Counters and histograms recorded since the last drain, for merge() in another process
+        with self._lock:
+            data = {
+                'counters': [(name, labels, value) for (name, labels), value in self._counters.items()],
+                'histograms': [(name, labels, histogram.to_dict()) for (name, labels), histogram in self._histograms.items()],
+            }
+            self._counters = {}
+            self._histograms = {}
+        return data
+
+    def merge(self, data):
+        with self._lock:
+            for name, labels, value in data['counters']:
+                self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+            for name, labels, histogram_data in data['histograms']:
+                histogram = self._histograms.get((name, labels))
+                if histogram is None:
+                    histogram = self._histograms[(name, labels)] = Histogram(histogram_data['bounds'])
+                histogram.merge(histogram_data)
+
+    def prometheus_text(self):
+        # Prometheus text exposition format
+        snapshot = self.snapshot()
+        lines = []
+
+        def label_text(labels, **extra):
+            labels = dict(labels, **extra)
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{key}="{str(value)}"' for key, value in sorted(labels.items())) + '}'
+
+        for counter in snapshot['counters']:
+            lines.append(f"{counter['name']}{label_text(counter['labels'])} {counter['value']}")
+        for gauge in snapshot['gauges']:
+            lines.append(f"{gauge['name']}{label_text(gauge['labels'])} {gauge['value']}")
+        for histogram in snapshot['histograms']:
+            cumulative = 0
+            for bound, count in zip(histogram['bounds'] + ['+Inf'], histogram['counts']):
+                cumulative += count
+                lines.append(f"{histogram['name']}_bucket{label_text(histogram['labels'], le=bound)} {cumulative}")
+            lines.append(f"{histogram['name']}_sum{label_text(histogram['labels'])} {histogram['sum']}")
+            lines.append(f"{histogram['name']}_count{label_text(histogram['labels'])} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+
+_registry = MetricsRegistry()
+
+
+def get_metrics():
+    return _registry
+
+
+def set_log_sample_every(every):
+    global log_sample_every
+    log_sample_every = max(int(every), 1)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # GET /metrics: Prometheus text format, GET /metrics.json: the JSON snapshot
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = _registry.prometheus_text().encode('utf-8'), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(_registry.snapshot()).encode('utf-8'), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host='0.0.0.0'):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+def write_snapshot(path):
+    # Replace path atomically so readers never see a partial file
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(_registry.snapshot(), f, indent=1)
+    os.replace(temp_path, path)
+
+
+class SnapshotWriter:
+    """Write the metrics snapshot to path every interval seconds, and once more on stop()."""
+
+    def __init__(self, path, interval=30.0):
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='MetricsSnapshot', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self._write()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._write()
+
+    def _write(self):
+        try:
+            write_snapshot(self.path)
+        except Exception as e:
+            logger.error(f"Error writing metrics snapshot to {self.path}: {e}")
@@ -0,0 +1,342 @@
+"""Near-duplicate search over the 256-bit pHashes written to the comparison results.
+
+The index is an SQLite file using multi-index hashing: every distinct hash is split into
+NUM_CHUNKS chunks of CHUNK_BITS bits and each chunk value is indexed. Two hashes within
+Hamming distance k share at least one chunk that differs in at most k // NUM_CHUNKS bits, so
+a query only looks up those chunk values and checks the exact distance of the few candidates.
+
+    python phash_index.py build --results /data/comparison_results.csv --dataset dataset.csv
+    python phash_index.py query --asset_id 1574755038 --max_distance 20
+    python phash_index.py clusters --max_distance 10 --cross_collection --out clusters.csv
+"""
+import argparse
+import csv
+import itertools
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import pandas as pd
+from checkpoint_store import asset_key
+from result_writer import parquet_output_path, read_parquet_output
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 256
+CHUNK_BITS = 16
+NUM_CHUNKS = HASH_BITS // CHUNK_BITS
+
+# Image roles and the results column holding their hash
+ROLES = {'opensea': 'opensea_phash', 'original': 'original_phash'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    hash_id INTEGER PRIMARY KEY,
+    phash BLOB NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    chunk INTEGER NOT NULL,
+    value INTEGER NOT NULL,
+    hash_id INTEGER NOT NULL,
+    PRIMARY KEY (chunk, value, hash_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS images (
+    asset_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    hash_id INTEGER NOT NULL,
+    PRIMARY KEY (asset_id, role)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS images_hash_id ON images (hash_id);
+CREATE TABLE IF NOT EXISTS collections (
+    asset_id TEXT PRIMARY KEY,
+    collection_slug TEXT
+) WITHOUT ROWID;
+"""
+
+# SQLite limits the number of parameters of one statement
+MAX_PARAMETERS = 900
+
+
+def phash_bytes(phash):
+    # imagehash hex string (as written to the results) to the stored 32-byte form
+    return bytes.fromhex(phash.rjust(HASH_BITS // 4, '0'))
+
+
+def hash_chunks(phash):
+    value = int.from_bytes(phash, 'big')
+    mask = (1 << CHUNK_BITS) - 1
+    return [(value >> (CHUNK_BITS * (NUM_CHUNKS - 1 - i))) & mask for i in range(NUM_CHUNKS)]
+
+
+def hamming_distance(a, b):
+    return bin(int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).count('1')
+
+
+def flip_masks(radius):
+    # Every CHUNK_BITS-bit mask with at most radius bits set
+    masks = [0]
+    for bits in range(1, radius + 1):
+        for positions in itertools.combinations(range(CHUNK_BITS), bits):
+            masks.append(sum(1 << position for position in positions))
+    return masks
+
+
+def batched(items, size=MAX_PARAMETERS):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class PhashIndex:
+    """Multi-index hashing index of image pHashes, one connection per thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _hash_id(self, conn, phash):
+        row = conn.execute('SELECT hash_id FROM hashes WHERE phash = ?', (phash,)).fetchone()
+        if row:
+            return row[0]
+        hash_id = conn.execute('INSERT INTO hashes (phash) VALUES (?)', (phash,)).lastrowid
+        conn.executemany('INSERT INTO chunks (chunk, value, hash_id) VALUES (?, ?, ?)',
+                         [(i, value, hash_id) for i, value in enumerate(hash_chunks(phash))])
+        return hash_id
+
+    def add_images(self, images):
+        # images: iterable of (asset_id, role, phash hex string); empty hashes are skipped
+        added = 0
+        with self._connection() as conn:
+            for asset_id, role, phash in images:
+                if not isinstance(phash, str) or not phash:
+                    continue
+                hash_id = self._hash_id(conn, phash_bytes(phash))
+                conn.execute('INSERT OR REPLACE INTO images (asset_id, role, hash_id) VALUES (?, ?, ?)',
+                             (asset_key(asset_id), role, hash_id))
+                added += 1
+        return added
+
+    def add_collections(self, collections):
+        # collections: iterable of (asset_id, collection_slug); empty slugs are stored as NULL
+        with self._connection() as conn:
+            conn.executemany('INSERT OR REPLACE INTO collections (asset_id, collection_slug) VALUES (?, ?)',
+                             [(asset_key(asset_id), None if pd.isna(slug) or slug == '' else slug)
+                              for asset_id, slug in collections])
+
+    def add_records(self, records):
+        # ResultWriter on_flush callback for the comparison results. Records carry their asset's
+        # collection_slug (see main.RECORD_INPUT_COLUMNS), which cross-collection clustering uses.
+        self.add_images((record['asset_id'], role, record.get(column))
+                        for record in records for role, column in ROLES.items())
+        self.add_collections((record['asset_id'], record['collection_slug'])
+                             for record in records if 'collection_slug' in record)
+
+    def import_results(self, path, chunk_size=100000):
+        # Index the hashes of an existing comparison_results.csv or its Parquet output directory
+        columns = ['asset_id', 'collection_slug'] + list(ROLES.values())
+        if not os.path.exists(path) and os.path.isdir(parquet_output_path(path)):
+            df = read_parquet_output(path)
+            chunks = [df[[c for c in columns if c in df]]]
+        else:
+            chunks = pd.read_csv(path, usecols=lambda c: c in columns,
+                                 dtype={c: str for c in ['collection_slug'] + list(ROLES.values())}, chunksize=chunk_size)
+        imported = 0
+        for chunk in chunks:
+            for role, column in ROLES.items():
+                if column in chunk:
+                    imported += self.add_images(zip(chunk['asset_id'], itertools.repeat(role), chunk[column]))
+            if 'collection_slug' in chunk:
+                self.add_collections(zip(chunk['asset_id'], chunk['collection_slug']))
+        return imported
+
+    def import_collections(self, dataset_path, chunk_size=100000):
+        # Record each asset's collection_slug from a dataset CSV, used by cross-collection clustering
+        imported = 0
+        for chunk in pd.read_csv(dataset_path, usecols=['asset_id', 'collection_slug'], chunksize=chunk_size):
+            self.add_collections(zip(chunk['asset_id'], chunk['collection_slug']))
+            imported += len(chunk)
+        return imported
+
+    def hash_of(self, asset_id, role='original'):
+        row = self._connection().execute(
+            'SELECT phash FROM hashes JOIN images USING (hash_id) WHERE asset_id = ? AND role = ?',
+            (asset_key(asset_id), role)).fetchone()
+        return row[0].hex() if row else None
+
+    def _similar_hashes(self, phash, max_distance):
+        # Return {hash_id: (phash, distance)} for every indexed hash within max_distance of phash
+        conn = self._connection()
+        masks = flip_masks(max_distance // NUM_CHUNKS)
+        candidates = set()
+        for i, value in enumerate(hash_chunks(phash)):
+            for values in batched(value ^ mask for mask in masks):
+                candidates.update(hash_id for hash_id, in conn.execute(
+                    f"SELECT hash_id FROM chunks WHERE chunk = ? AND value IN ({','.join('?' * len(values))})",
+                    [i] + values))
+
+        similar = {}
+        for hash_ids in batched(candidates):
+            rows = conn.execute(f"SELECT hash_id, phash FROM hashes WHERE hash_id IN ({','.join('?' * len(hash_ids))})",
+                                hash_ids)
+            for hash_id, candidate in rows:
+                distance = hamming_distance(phash, candidate)
+                if distance <= max_distance:
+                    similar[hash_id] = (candidate, distance)
+        return similar
+
+    def query(self, phash, max_distance=10, role=None):
+        """Every indexed image within Hamming distance max_distance of a hash, nearest first.
+
+        Returns a list of {'asset_id', 'role', 'phash', 'distance'}. role restricts the
+        result to 'opensea' or 'original' images.
+        """
+        similar = self._similar_hashes(phash_bytes(phash), max_distance)
+        conn = self._connection()
+        matches = []
+        for hash_ids in batched(similar):
+            rows = conn.execute(
+                f"SELECT asset_id, role, hash_id FROM images WHERE hash_id IN ({','.join('?' * len(hash_ids))})", hash_ids)
+            for asset_id, image_role, hash_id in rows:
+                if role is None or image_role == role:
+                    candidate, distance = similar[hash_id]
+                    matches.append({'asset_id': asset_id, 'role': image_role, 'phash': candidate.hex(), 'distance': distance})
+        return sorted(matches, key=lambda match: (match['distance'], match['asset_id'], match['role']))
+
+    def clusters(self, max_distance=10, role='original', cross_collection=False):
+        """Yield groups of images whose hashes are linked by chains of distance <= max_distance.
+
+        Each cluster is a list of {'asset_id', 'role', 'phash', 'collection_slug'} covering at
+        least two assets. cross_collection only yields clusters spanning several collections.
+        """
+        conn = self._connection()
+        parent = {}
+
+        def find(hash_id):
+            root = hash_id
+            while parent.get(root, root) != root:
+                root = parent[root]
+            while hash_id != root:
+                parent[hash_id], hash_id = root, parent.get(hash_id, hash_id)
+            return root
+
+        role_filter = 'WHERE hash_id IN (SELECT hash_id FROM images WHERE role = ?)' if role else ''
+        role_parameters = [role] if role else []
+        phashes = {hash_id: int.from_bytes(phash, 'big') for hash_id, phash in
+                   conn.execute(f"SELECT hash_id, phash FROM hashes {role_filter}", role_parameters)}
+        for hash_id in phashes:
+            parent[hash_id] = hash_id
+
+        # Candidate pairs share a chunk whose values differ in at most max_distance // NUM_CHUNKS
+        # bits (SQLite has no XOR operator: a ^ b == (a | b) - (a & b))
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS flip_masks (mask INTEGER PRIMARY KEY)')
+        conn.execute('DELETE FROM flip_masks')
+        conn.executemany('INSERT INTO flip_masks (mask) VALUES (?)', [(mask,) for mask in flip_masks(max_distance // NUM_CHUNKS)])
+        pairs = conn.execute(f"""SELECT DISTINCT a.hash_id, b.hash_id FROM chunks a CROSS JOIN flip_masks m
+                                JOIN chunks b ON b.chunk = a.chunk AND b.value = (a.value | m.mask) - (a.value & m.mask)
+                                AND b.hash_id > a.hash_id {'WHERE a.hash_id IN (SELECT hash_id FROM images WHERE role = ?) '
+                                'AND b.hash_id IN (SELECT hash_id FROM images WHERE role = ?)' if role else ''}""",
+                             role_parameters * 2)
+        for hash_id, other_id in pairs:
+            if hash_id not in phashes or other_id not in phashes:
+                continue
+            if bin(phashes[hash_id] ^ phashes[other_id]).count('1') > max_distance:
+                continue
+            root, other_root = find(hash_id), find(other_id)
+            if root != other_root:
+                parent[max(root, other_root)] = min(root, other_root)
+
+        # Hashes shared by several assets are clusters even without any similar hash
+        shared = {hash_id for hash_id, in conn.execute(
+            f"""SELECT hash_id FROM images {'WHERE role = ?' if role else ''}
+                GROUP BY hash_id HAVING COUNT(DISTINCT asset_id) > 1""", role_parameters)}
+
+        groups = {}
+        for hash_id in list(parent):
+            groups.setdefault(find(hash_id), []).append(hash_id)
+
+        for hash_ids in groups.values():
+            if len(hash_ids) == 1 and hash_ids[0] not in shared:
+                continue
+            members = []
+            for batch in batched(hash_ids):
+                members.extend(conn.execute(
+                    f"""SELECT images.asset_id, images.role, hashes.phash, collections.collection_slug
+                        FROM images JOIN hashes USING (hash_id) LEFT JOIN collections USING (asset_id)
+                        WHERE images.hash_id IN ({','.join('?' * len(batch))}) {'AND images.role = ?' if role else ''}""",
+                    batch + ([role] if role else [])))
+            if len({asset_id for asset_id, _, _, _ in members}) < 2:
+                continue
+            if cross_collection and len({slug for _, _, _, slug in members if slug is not None}) < 2:
+                continue
+            yield [{'asset_id': asset_id, 'role': image_role, 'phash': phash.hex(), 'collection_slug': slug}
+                   for asset_id, image_role, phash, slug in members]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--index', default='/data/phash_index.sqlite', help='Index file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='Index the hashes of a comparison results file')
+    build.add_argument('--results', default='/data/comparison_results.csv', help='Comparison results CSV')
+    build.add_argument('--dataset', help='Dataset CSV providing the collection_slug of each asset')
+
+    query = subparsers.add_parser('query', help='Images within a Hamming distance of a hash or an asset')
+    target = query.add_mutually_exclusive_group(required=True)
+    target.add_argument('--phash', help='Hex pHash to search for')
+    target.add_argument('--asset_id', help='Search for the hash of this asset')
+    query.add_argument('--asset_role', choices=list(ROLES), default='original', help='Which image of --asset_id to use')
+    query.add_argument('--max_distance', type=int, default=10)
+    query.add_argument('--role', choices=list(ROLES), help='Only return images of this role')
+
+    clusters = subparsers.add_parser('clusters', help='Write near-duplicate clusters to a CSV file')
+    clusters.add_argument('--max_distance', type=int, default=10)
+    clusters.add_argument('--role', choices=list(ROLES) + ['any'], default='original',
+                          help='Cluster these images. Default: the originals')
+    clusters.add_argument('--cross_collection', action='store_true', help='Only clusters spanning several collections')
+    clusters.add_argument('--out', default='/data/phash_clusters.csv')
+    args = parser.parse_args()
+
+    index = PhashIndex(args.index)
+    if args.command == 'build':
+        logger.info(f"Indexed {index.import_results(args.results)} image hashes from {args.results}")
+        if args.dataset:
+            logger.info(f"Recorded collections of {index.import_collections(args.dataset)} assets from {args.dataset}")
+
+    elif args.command == 'query':
+        phash = args.phash or index.hash_of(args.asset_id, args.asset_role)
+        if phash is None:
+            sys.exit(f"No {args.asset_role} image hash indexed for asset {args.asset_id}")
+        writer = csv.DictWriter(sys.stdout, fieldnames=['asset_id', 'role', 'phash', 'distance'])
+        writer.writeheader()
+        writer.writerows(index.query(phash, args.max_distance, args.role))
+
+    else:
+        role = None if args.role == 'any' else args.role
+        count = 0
+        with open(args.out, mode='w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=['cluster_id', 'asset_id', 'role', 'phash', 'collection_slug'])
+            writer.writeheader()
+            for count, members in enumerate(index.clusters(args.max_distance, role, args.cross_collection), 1):
+                writer.writerows({'cluster_id': count, **member} for member in members)
+        logger.info(f"Wrote {count} clusters to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
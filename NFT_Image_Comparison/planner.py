@@ -0,0 +1,72 @@
+import hashlib
+import threading
+from checkpoint_store import asset_key
+from input_reader import iter_rows
+from processing import get_image_urls
+from utils import image_cache_key, is_inline_image
+
+
+def url_key(url):
+    # Rows whose images have equal keys download the same bytes: IPFS URLs by CID and path,
+    # other URLs normalized as in the image cache, inline images by their content
+    if not isinstance(url, str):
+        return None
+    if is_inline_image(url):
+        return 'inline:' + hashlib.sha256(url.encode('utf-8')).hexdigest()
+    return image_cache_key(url)
+
+
+def pair_key(row):
+    opensea_key, original_key = (url_key(url) for url in get_image_urls(row))
+    if opensea_key is None or original_key is None:
+        return None
+    return opensea_key, original_key
+
+
+def plan_chunk(df, done=()):
+    """Group the rows of df that need the same downloads and comparison.
+
+    Returns a list of (row, duplicates): only row is downloaded and compared, and its result
+    is copied to the rows in duplicates. Rows whose asset_id is in done or repeats an earlier
+    row of the chunk (e.g. several sale events of one asset) are left out.
+    """
+    groups = {}
+    seen = set()
+    for row in iter_rows(df):
+        asset = asset_key(row.asset_id)
+        if asset in seen or row.asset_id in done:
+            continue
+        seen.add(asset)
+        # Rows without two usable image URLs fail on their own
+        key = pair_key(row) or ('asset', asset)
+        groups.setdefault(key, []).append(row)
+    return [(rows[0], rows[1:]) for rows in groups.values()]
+
+
+class ActiveAssets:
+    """Set-like view of the assets plan_chunk must leave out: those in done, and those of
+    planned work that has not finished yet. The pipeline plans the next chunk while rows of
+    the previous one are still in flight, and an asset that repeats across the chunk boundary
+    must not be processed twice."""
+
+    def __init__(self, done):
+        self.done = done
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, asset_id):
+        with self._lock:
+            if asset_key(asset_id) in self._active:
+                return True
+        return asset_id in self.done
+
+    def claim(self, work):
+        with self._lock:
+            for row, duplicates in work:
+                self._active.add(asset_key(row.asset_id))
+                self._active.update(asset_key(duplicate.asset_id) for duplicate in duplicates)
+
+    def release(self, row, duplicates):
+        with self._lock:
+            self._active.discard(asset_key(row.asset_id))
+            self._active.difference_update(asset_key(duplicate.asset_id) for duplicate in duplicates)
@@ -5,7 +5,26 @@ import pandas as pd
 # Set up logging
 logger = logging.getLogger(__name__)
 
-def download_and_process_image(row, errors_logged, timeout=60):
+def get_image_urls(row):
+    # The OpenSea and original image URLs exactly as download_and_process_image requests them
+    opensea_image_url = row['asset_img_url']
+    original_image_url = row['asset_img_org_url']
+    if isinstance(original_image_url, str):
+        original_image_url = modify_ipfs_url(original_image_url)
+    return opensea_image_url, original_image_url
+
+
+def make_prefetched_downloader(payloads):
+    # Build a download_image replacement that serves bytes fetched ahead of time.
+    # URLs that were not prefetched (e.g. inline SVG or data URLs) go through download_image.
+    def downloader(url, row, errors_logged, timeout=60, is_original_image=False):
+        if url not in payloads:
+            return download_image(url, row, errors_logged, timeout, is_original_image=is_original_image)
+        return load_prefetched_image(url, payloads[url], row, errors_logged)
+    return downloader
+
+
+def download_and_process_image(row, errors_logged, timeout=60, downloader=download_image):
     asset_id = row.get('asset_id')
     # Initialize the result dictionary
     result = {
@@ -14,8 +33,10 @@ def download_and_process_image(row, errors_logged, timeout=60):
         'asset_id': asset_id,
         'error_message': '',
         'opensea_extension': None,
-        'original_extension': None
+        'original_extension': None,
+        'identical': False
     }
+    opensea_digest = original_digest = None
 
     def log_error(message, add_to_errors=True):
         if add_to_errors:
@@ -28,7 +49,8 @@ def download_and_process_image(row, errors_logged, timeout=60):
     # Download and process the OpenSea image
     try:
         opensea_image_url = row['asset_img_url']
-        opensea_image, opensea_content_type = download_image(opensea_image_url, row, errors_logged, timeout)  
+        opensea_image, opensea_content_type = downloader(opensea_image_url, row, errors_logged, timeout)  
+        opensea_digest = opensea_image.info.get('content_digest') if opensea_image else None
         result['opensea_image'] = process_image(opensea_image, row, errors_logged)
         result['opensea_extension'] = get_extension(opensea_content_type)
     except Exception as e:
@@ -38,13 +60,15 @@ def download_and_process_image(row, errors_logged, timeout=60):
     # Download and process the original image
     try:
         original_image_url = modify_ipfs_url(row['asset_img_org_url'])
-        original_image, original_content_type = download_image(original_image_url, row, errors_logged, timeout, is_original_image=True)
+        original_image, original_content_type = downloader(original_image_url, row, errors_logged, timeout, is_original_image=True)
+        original_digest = original_image.info.get('content_digest') if original_image else None
         result['original_image'] = process_image(original_image, row, errors_logged)
         result['original_extension'] = get_extension(original_content_type)
     except Exception as e:
         error_message = f"Error downloading original image {asset_id}: {e}"
         log_error(error_message, add_to_errors=False)
 
+    result['identical'] = is_same_content(*get_image_urls(row), opensea_digest, original_digest)
     return result
 
 
@@ -0,0 +1,143 @@
+# Shared by NFT_Image_Comparison and Data_Collection, which are deployed separately: the two
+# copies must stay identical (tests/test_rate_limiter.py checks this).
+import asyncio
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+# Status codes that mean the host wants us to slow down
+THROTTLE_STATUS_CODES = (429, 503)
+
+# Starting and maximum requests per second per host. Hosts not listed use DEFAULT_HOST_RATE;
+# a rate of None means the host is not rate limited.
+DEFAULT_HOST_RATES = {
+    'api.opensea.io': (1.0, 4.0),
+    'i.seadn.io': (50.0, 200.0),
+    'ipfs:8080': None,
+    'ipfs.io': (5.0, 20.0),
+    'cloudflare-ipfs.com': (5.0, 20.0),
+    'dweb.link': (5.0, 20.0),
+}
+DEFAULT_HOST_RATE = (10.0, 50.0)
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class HostBucket:
+    """Token bucket for one host whose rate adapts to the host's responses.
+
+    Successful responses raise the rate additively up to max_rate. A 429/503 halves it (down
+    to min_rate) and blocks the host for the Retry-After period, or for an exponential backoff
+    when the header is missing.
+    """
+
+    def __init__(self, rate, max_rate, min_rate=0.1, burst=1, increase_step=None, base_backoff=1.0, max_backoff=300.0):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.increase_step = increase_step or max_rate / 100
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.consecutive_throttles = 0
+        self._tat = 0.0  # theoretical arrival time of the next request
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # Reserve the next request slot and return how many seconds to wait for it
+        with self._lock:
+            now = time.monotonic()
+            interval = 1.0 / self.rate
+            send_at = max(now, self._tat - (self.burst - 1) * interval, self._blocked_until)
+            self._tat = max(self._tat, send_at) + interval
+            return send_at - now
+
+    def on_success(self):
+        with self._lock:
+            self.consecutive_throttles = 0
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self, retry_after=None):
+        with self._lock:
+            self.consecutive_throttles += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after is None:
+                retry_after = min(self.max_backoff, self.base_backoff * 2 ** (self.consecutive_throttles - 1))
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+
+class RateLimiter:
+    """Per-host adaptive rate limiting shared by every thread or coroutine of a process.
+
+    Call acquire(url) (or await acquire_async(url)) before each request and feedback(url, ...)
+    with the response. feedback returns True when the response was a throttle response that
+    should be retried after the next acquire.
+    """
+
+    def __init__(self, host_rates=None, default_rate=DEFAULT_HOST_RATE):
+        self.host_rates = dict(DEFAULT_HOST_RATES, **(host_rates or {}))
+        self.default_rate = default_rate
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, url):
+        host = urlparse(url).netloc or url
+        with self._lock:
+            if host not in self._buckets:
+                rates = self.host_rates.get(host, self.default_rate)
+                self._buckets[host] = HostBucket(*rates) if rates else None
+            return self._buckets[host]
+
+    def acquire(self, url):
+        bucket = self.bucket(url)
+        if bucket is not None:
+            delay = bucket.reserve()
+            if delay > 0:
+                time.sleep(delay)
+
+    async def acquire_async(self, url):
+        bucket = self.bucket(url)
+        if bucket is not None:
+            delay = bucket.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    def feedback(self, url, status_code, headers=None):
+        bucket = self.bucket(url)
+        if bucket is None:
+            return False
+        if status_code in THROTTLE_STATUS_CODES:
+            bucket.on_throttle(parse_retry_after((headers or {}).get('Retry-After')))
+            return True
+        if status_code < 400:
+            bucket.on_success()
+        return False
+
+
+_rate_limiter = RateLimiter()
+
+
+def configure_rate_limiter(host_rates=None, default_rate=DEFAULT_HOST_RATE):
+    global _rate_limiter
+    _rate_limiter = RateLimiter(host_rates, default_rate)
+    return _rate_limiter
+
+
+def get_rate_limiter():
+    return _rate_limiter
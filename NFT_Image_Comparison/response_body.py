@@ -0,0 +1,115 @@
+import re
+
+# Downloads larger than this are aborted. 0 disables the limit.
+max_download_bytes = 64 * 1024 * 1024
+
+# Chunk size for streamed downloads
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Bytes needed to recognize every format below
+SNIFF_BYTES = 512
+
+# Content type when neither the magic bytes nor the Content-Type header identify the image
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+
+# Leading bytes of the image formats Pillow decodes
+IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+    (b'\x00\x00\x01\x00', 'image/x-icon'),
+]
+
+# Leading bytes of responses that are certainly not images
+NON_IMAGE_SIGNATURES = [
+    (b'\x1aE\xdf\xa3', 'video/webm'),
+    (b'OggS', 'audio/ogg'),
+    (b'ID3', 'audio/mpeg'),
+    (b'%PDF', 'application/pdf'),
+    (b'PK\x03\x04', 'application/zip'),
+]
+
+# ISO base media (ftyp) brands that are images; every other brand is video (mp4, mov, 3gp, ...)
+IMAGE_BRANDS = {
+    b'avif': 'image/avif', b'avis': 'image/avif',
+    b'heic': 'image/heic', b'heix': 'image/heic', b'mif1': 'image/heif', b'msf1': 'image/heif',
+}
+
+HTML_PATTERN = re.compile(rb'^\s*<(!doctype\s+html|html|head|body)', re.IGNORECASE)
+SVG_PATTERN = re.compile(rb'<svg[\s>]', re.IGNORECASE)
+
+
+def set_max_download_bytes(limit):
+    global max_download_bytes
+    max_download_bytes = limit
+
+
+def sniff_content_type(head, declared_type=None):
+    """Return the content type of a response from its first bytes and its Content-Type header.
+
+    Raises ValueError for responses that are not images (video, audio, HTML, JSON, ...). The
+    header is only used when the bytes match no known format.
+    """
+    declared_type = (declared_type or '').split(';')[0].strip().lower()
+
+    for signature, content_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head[4:8] == b'ftyp':
+        brand = head[8:12]
+        if brand in IMAGE_BRANDS:
+            return IMAGE_BRANDS[brand]
+        raise ValueError(f"Response is not an image: ISO media with brand {brand.decode('latin-1')!r}")
+    for signature, content_type in NON_IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            raise ValueError(f"Response is not an image: {content_type}")
+
+    text = head.lstrip(b'\xef\xbb\xbf')
+    if HTML_PATTERN.match(text):
+        raise ValueError("Response is not an image: text/html")
+    if text.lstrip().startswith((b'<?xml', b'<svg', b'<!DOCTYPE svg')):
+        return 'image/svg+xml'
+    if text.lstrip().startswith(b'<!--') and (SVG_PATTERN.search(text) or declared_type == 'image/svg+xml'):
+        return 'image/svg+xml'
+    if text.lstrip().startswith((b'{', b'[')):
+        raise ValueError("Response is not an image: application/json")
+
+    if declared_type.startswith(('text/', 'video/', 'audio/')) or declared_type in ('application/json', 'application/pdf'):
+        raise ValueError(f"Response is not an image: {declared_type}")
+    return declared_type if declared_type.startswith('image/') else DEFAULT_CONTENT_TYPE
+
+
+class ResponseBody:
+    """Collect a streamed response body.
+
+    Raises ValueError as soon as the body exceeds max_bytes (or Content-Length announces that
+    it will) or once the first SNIFF_BYTES show that it is not an image, so the rest of the
+    body is never downloaded.
+    """
+
+    def __init__(self, declared_type=None, content_length=None, max_bytes=None):
+        self.declared_type = declared_type
+        self.max_bytes = max_download_bytes if max_bytes is None else max_bytes
+        self.content = bytearray()
+        self.content_type = None
+        if self.max_bytes and content_length and int(content_length) > self.max_bytes:
+            raise ValueError(f"Response of {content_length} bytes exceeds the limit of {self.max_bytes} bytes")
+
+    def feed(self, chunk):
+        self.content += chunk
+        if self.max_bytes and len(self.content) > self.max_bytes:
+            raise ValueError(f"Response exceeds the limit of {self.max_bytes} bytes")
+        if self.content_type is None and len(self.content) >= SNIFF_BYTES:
+            self.content_type = sniff_content_type(bytes(self.content[:SNIFF_BYTES]), self.declared_type)
+
+    def finish(self):
+        # Return (content, content_type)
+        if self.content_type is None:
+            self.content_type = sniff_content_type(bytes(self.content), self.declared_type)
+        return bytes(self.content), self.content_type
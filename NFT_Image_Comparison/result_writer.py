@@ -0,0 +1,336 @@
+import csv
+import logging
+import os
+import queue
+import threading
+import time
+import pandas as pd
+from metrics import get_metrics
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+# Attempts close() makes, flush_interval apart, at writing records whose last write failed
+CLOSE_WRITE_ATTEMPTS = 3
+
+
+def parquet_output_path(path):
+    # Parquet output for 'x/results.csv' is the directory 'x/results.parquet', one or more part files per writer
+    return os.path.splitext(path)[0] + '.parquet'
+
+
+def read_parquet_output(path):
+    # The part files of the Parquet output of path as one DataFrame. Part files may differ in
+    # their columns and types (see ResultWriter); they are combined with merge_schemas.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    directory = parquet_output_path(path)
+    tables = [pq.read_table(os.path.join(directory, name)) for name in sorted(os.listdir(directory))
+              if name.endswith('.parquet') and not name.startswith('.')]
+    if not tables:
+        return pd.DataFrame(columns=['asset_id'])
+    schema = tables[0].schema
+    for table in tables[1:]:
+        schema = merge_schemas(schema, table.schema)
+    return pa.concat_tables([conform_table(table, schema) for table in tables]).to_pandas()
+
+
+class ResultWriter:
+    """Append records to one output file from a single background thread.
+
+    Producers call write() from any thread. Records are queued and written in batches once
+    batch_size records are pending or flush_interval seconds have passed. close() drains the
+    queue, flushes and fsyncs the file. Each callable in on_flush is called with every batch
+    after it has been written. A batch that fails to write stays pending and is retried with
+    the next one every flush_interval. close() makes CLOSE_WRITE_ATTEMPTS more attempts and
+    raises if records are still unwritten after them.
+
+    file_format 'csv' appends to path, keeping the column order of an existing header. Columns
+    the header lacks are added to its end, rewriting the file once with the longer header.
+    file_format 'parquet' writes a new part file into the directory parquet_output_path(path),
+    one row group per batch. A batch with new columns, or with values of another type than
+    their column's (see merge_type), starts another part file with the merged schema;
+    read_parquet_output() combines the part files.
+    """
+
+    def __init__(self, path, file_format='csv', batch_size=500, flush_interval=5.0, on_flush=None, max_queue_size=10000):
+        if file_format not in ('csv', 'parquet'):
+            raise ValueError(f"Unsupported output format: {file_format}")
+        self.path = path
+        self.file_format = file_format
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_flush = list(on_flush or [])
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._run, name=f"ResultWriter({os.path.basename(path)})", daemon=True)
+        self._file = None
+        self._csv_writer = None
+        self._parquet_writer = None
+        self._schema = None
+        self._parts = 0
+        self._written_size = None
+        self._error = None
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def write(self, record):
+        self._queue.put(record)
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        stopping = False
+        failing = False
+        while not stopping:
+            try:
+                record = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                if record is _STOP:
+                    stopping = True
+                else:
+                    batch.append(record)
+            except queue.Empty:
+                pass
+
+            # After a failed write the pending records are only retried every flush_interval
+            full = len(batch) >= self.batch_size and not failing
+            if batch and (stopping or full or time.monotonic() >= deadline):
+                failing = not self._flush(batch)
+                if not failing:
+                    batch = []
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.flush_interval
+
+        for _ in range(CLOSE_WRITE_ATTEMPTS):
+            if not batch:
+                break
+            time.sleep(self.flush_interval)
+            if self._flush(batch):
+                batch = []
+
+        try:
+            self._close_file()
+        except Exception as e:
+            logger.error(f"Error closing {self.path}: {e}")
+            self._error = e
+        if batch:
+            self._error = IOError(f"{len(batch)} records could not be written to {self.path}")
+
+    def _flush(self, batch):
+        # Write batch; on an error it is logged and False returned, the caller keeps the batch
+        metrics = get_metrics()
+        name = os.path.basename(self.path)
+        try:
+            with metrics.timer('stage_seconds', stage='write_results', file=name):
+                if self.file_format == 'csv':
+                    self._write_csv(batch)
+                else:
+                    self._write_parquet(batch)
+        except Exception as e:
+            metrics.inc('errors_total', stage='write_results', type=type(e).__name__)
+            logger.error(f"Error writing {len(batch)} records to {self.path}, will retry: {e}")
+            self._discard_file()
+            return False
+        metrics.inc('rows_written_total', len(batch), file=name)
+
+        for callback in self.on_flush:
+            try:
+                callback(batch)
+            except Exception as e:
+                logger.error(f"Error in flush callback for {self.path}: {e}")
+        return True
+
+    def _write_csv(self, batch):
+        self._written_size = None
+        if self._csv_writer is None:
+            fieldnames = None
+            if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                with open(self.path, newline='', encoding='utf-8') as f:
+                    fieldnames = next(csv.reader(f), None)
+            self._file = open(self.path, mode='a', newline='', encoding='utf-8')
+            write_header = fieldnames is None
+            if write_header:
+                fieldnames = list(batch[0].keys())
+            self._csv_writer = csv.DictWriter(self._file, fieldnames=fieldnames, extrasaction='ignore')
+            if write_header:
+                self._csv_writer.writeheader()
+
+        known = set(self._csv_writer.fieldnames)
+        new_fields = [name for name in dict.fromkeys(key for record in batch for key in record) if name not in known]
+        if new_fields:
+            self._add_csv_columns(new_fields)
+        # Where a failed write is truncated back to by _discard_file
+        self._file.flush()
+        self._written_size = os.fstat(self._file.fileno()).st_size
+        self._csv_writer.writerows(batch)
+        self._file.flush()
+
+    def _add_csv_columns(self, new_fields):
+        # Rewrite the file with new_fields appended to its header and empty values for them in the
+        # rows already written. Written next to path and renamed over it, so a crash leaves the old file.
+        fieldnames = list(self._csv_writer.fieldnames) + new_fields
+        logger.info(f"Adding columns {new_fields} to {self.path}")
+        self._file.close()
+        temp_path = f"{self.path}.tmp"
+        with open(self.path, newline='', encoding='utf-8') as source, \
+                open(temp_path, mode='w', newline='', encoding='utf-8') as target:
+            reader = csv.reader(source)
+            writer = csv.writer(target)
+            next(reader, None)
+            writer.writerow(fieldnames)
+            for row in reader:
+                writer.writerow(row + [''] * (len(fieldnames) - len(row)))
+            target.flush()
+            os.fsync(target.fileno())
+        os.replace(temp_path, self.path)
+        self._file = open(self.path, mode='a', newline='', encoding='utf-8')
+        self._csv_writer = csv.DictWriter(self._file, fieldnames=fieldnames, extrasaction='ignore')
+
+    def _write_parquet(self, batch):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = records_table(batch)
+        schema = table.schema if self._schema is None else merge_schemas(self._schema, table.schema)
+        table = conform_table(table, schema)
+
+        if schema != self._schema:
+            if self._parquet_writer is not None:
+                columns = ', '.join(f"{field.name}: {field.type}" for field in schema)
+                logger.info(f"Columns of {self.path} changed to {columns}; starting a new part file")
+                self._close_file()
+            self._schema = schema
+            directory = parquet_output_path(self.path)
+            os.makedirs(directory, exist_ok=True)
+            self._parts += 1
+            name = f"part-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self._parts}.parquet"
+            self._file = open(os.path.join(directory, name), 'wb')
+            self._parquet_writer = pq.ParquetWriter(self._file, self._schema)
+
+        self._parquet_writer.write_table(table)
+        self._file.flush()
+
+    def _discard_file(self):
+        # After a failed write: drop the open file and what the batch left in it, so the retry
+        # starts from a clean state. A Parquet batch is one row group, which the footer only lists
+        # once it is complete; the part file is closed with the earlier ones and the retry starts a new one.
+        try:
+            if self.file_format == 'csv':
+                if self._file is not None:
+                    self._file.close()
+                if self._written_size is not None:
+                    os.truncate(self.path, self._written_size)
+            else:
+                self._close_file()
+        except Exception as e:
+            logger.error(f"Error closing {self.path} after a failed write: {e}")
+        self._file = None
+        self._csv_writer = None
+        self._parquet_writer = None
+        self._schema = None
+
+    def _close_file(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+
+def records_table(records):
+    # Table with a column for every key of any record. A column whose values have no common
+    # type is stored as strings.
+    import pyarrow as pa
+
+    columns = {}
+    for name in dict.fromkeys(key for record in records for key in record):
+        values = [record.get(name) for record in records]
+        try:
+            columns[name] = pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            columns[name] = pa.array([None if value is None else str(value) for value in values], pa.string())
+    return pa.table(columns)
+
+
+def merge_type(current, other):
+    # Type of a column holding values of both types: the other type for an all-null column,
+    # float64 for mixed numbers, else string
+    import pyarrow as pa
+
+    if current == other or pa.types.is_null(other):
+        return current
+    if pa.types.is_null(current):
+        return other
+    if pa.types.is_integer(current) and pa.types.is_integer(other):
+        return pa.int64()
+    numeric = (pa.types.is_integer, pa.types.is_floating)
+    if any(f(current) for f in numeric) and any(f(other) for f in numeric):
+        return pa.float64()
+    return pa.string()
+
+
+def merge_schemas(schema, other):
+    # schema with each column's type merged with its type in other, and the columns only other has appended
+    import pyarrow as pa
+
+    fields = [field.with_type(merge_type(field.type, other.field(field.name).type)) if field.name in other.names
+              else field for field in schema]
+    fields += [field for field in other if field.name not in schema.names]
+    return pa.schema(fields)
+
+
+def conform_table(table, schema):
+    # table cast to schema, with null columns for the fields it lacks
+    import pyarrow as pa
+
+    columns = [table.column(field.name).cast(field.type) if field.name in table.column_names
+               else pa.nulls(len(table), field.type) for field in schema]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+_writers = {}
+
+
+def open_writer(path, **kwargs):
+    # Start a ResultWriter and route save_comparison_result / log_error_to_csv calls for path through it
+    writer = ResultWriter(path, **kwargs).start()
+    _writers[path] = writer
+    get_metrics().register_gauge('writer_queue_depth', writer._queue.qsize, file=os.path.basename(path))
+    return writer
+
+
+def get_writer(path):
+    return _writers.get(path)
+
+
+def close_writers():
+    # Close every writer, then raise the first error of one that could not write all its records
+    error = None
+    while _writers:
+        _, writer = _writers.popitem()
+        try:
+            writer.close()
+        except Exception as e:
+            logger.error(f"Error closing the writer for {writer.path}: {e}")
+            error = error or e
+    if error is not None:
+        raise error
@@ -0,0 +1,81 @@
+import logging
+import time
+from circuit_breaker import is_transient
+from checkpoint_store import asset_key
+from metrics import get_metrics
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Attempts per asset before a transient failure is logged as an error, and the delay before
+# the first retry, doubling with every further attempt
+MAX_ATTEMPTS = 3
+BASE_RETRY_SECONDS = 60.0
+MAX_RETRY_SECONDS = 3600.0
+
+
+class RetryQueue:
+    """Assets whose download failed transiently, kept in the checkpoint store with status
+    'retry' instead of being logged as errors, and processed again after the main pass.
+
+    An asset is retried after a backoff counted from its last attempt, until it has been
+    attempted max_attempts times; its last failure is then logged like any other error.
+    """
+
+    def __init__(self, store, max_attempts=MAX_ATTEMPTS, base_retry_seconds=BASE_RETRY_SECONDS,
+                 max_retry_seconds=MAX_RETRY_SECONDS):
+        self.store = store
+        self.max_attempts = max_attempts
+        self.base_retry_seconds = base_retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+
+    def defer(self, asset_id, reason, error=None):
+        # Queue the asset for a retry and return True, or return False if its failure must be
+        # logged now: error is permanent, or the asset has no attempts left
+        if error is not None and not is_transient(error):
+            return False
+        entry = self.store.get(asset_id)
+        if entry is not None and entry['status'] in ('done', 'failed'):
+            return False
+        attempts = entry['attempts'] if entry is not None else 0
+        if attempts + 1 >= self.max_attempts:
+            return False
+        self.store.mark_retry(asset_id, reason)
+        get_metrics().inc('retries_deferred_total')
+        return True
+
+    def is_deferred(self, asset_id):
+        return self.store.status(asset_id) == 'retry'
+
+    def delay(self, attempts):
+        return min(self.max_retry_seconds, self.base_retry_seconds * 2 ** max(attempts - 1, 0))
+
+    def all_due_in(self):
+        # Seconds until every queued asset is due (0 if they all are), None if the queue is empty
+        now = time.time()
+        due = [updated_at + self.delay(attempts) for _, attempts, updated_at in self.store.retries()]
+        return max(max(due) - now, 0.0) if due else None
+
+    def take_due(self):
+        # Move the assets that are due to status 'retrying', which the next pass processes
+        # like new assets, and return their keys
+        now = time.time()
+        asset_ids = [asset_id for asset_id, attempts, updated_at in self.store.retries()
+                     if updated_at + self.delay(attempts) <= now]
+        self.store.begin_retry(asset_ids)
+        return {asset_key(asset_id) for asset_id in asset_ids}
+
+
+_retry_queue = None
+
+
+def configure_retry_queue(store, max_attempts=MAX_ATTEMPTS, base_retry_seconds=BASE_RETRY_SECONDS,
+                          max_retry_seconds=MAX_RETRY_SECONDS):
+    # max_attempts below 2 disables retries: every failure is logged at once
+    global _retry_queue
+    _retry_queue = RetryQueue(store, max_attempts, base_retry_seconds, max_retry_seconds) if max_attempts > 1 else None
+    return _retry_queue
+
+
+def get_retry_queue():
+    return _retry_queue
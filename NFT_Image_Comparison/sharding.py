@@ -0,0 +1,29 @@
+import hashlib
+import os
+from checkpoint_store import asset_key
+
+
+def shard_of(asset_id, shard_count):
+    # Stable across processes and hosts, unlike hash(); 123.0 and 123 land in the same shard
+    digest = hashlib.blake2b(asset_key(asset_id).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shard_count
+
+
+def select_shard(df, shard_index, shard_count):
+    # Rows of df whose asset_id belongs to shard shard_index of shard_count
+    if shard_count <= 1:
+        return df
+    return df[df['asset_id'].map(lambda asset_id: shard_of(asset_id, shard_count) == shard_index)]
+
+
+def shard_path(path, shard_index, shard_count):
+    # 'x/results.csv' -> 'x/results.shard-2-of-8.csv'; unchanged for an unsharded run
+    if shard_count <= 1 or not path:
+        return path
+    stem, extension = os.path.splitext(path)
+    return f"{stem}.shard-{shard_index}-of-{shard_count}{extension}"
+
+
+def validate_shard(shard_index, shard_count):
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError(f"Invalid shard {shard_index} of {shard_count}")
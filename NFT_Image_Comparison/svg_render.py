@@ -0,0 +1,75 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import Image
+from cairosvg.helpers import node_format, size as svg_size
+from cairosvg.parser import Tree
+from cairosvg.surface import PNGSurface
+
+# Rasterized SVGs kept per process, keyed by the hash of the SVG source and the target size.
+# On-chain collections repeat the same SVG for many assets.
+SVG_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Cairo stores ARGB32 pixels as native-endian premultiplied 32-bit words, i.e. premultiplied
+# BGRA bytes on little-endian hosts
+CAIRO_RAW_MODE = 'BGRa'
+
+_cache = OrderedDict()
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+_render_pool = None
+
+
+class RasterSurface(PNGSurface):
+    """cairosvg surface drawn at the scale where the SVG just covers target_size, the area
+    ImageOps.fit crops from. The pixels stay in the cairo buffer, nothing is encoded."""
+
+    def __init__(self, tree, target_size, dpi=96):
+        # Resolve the SVG's own size the way Surface.__init__ does
+        self.dpi = dpi
+        self.context_width = self.context_height = None
+        self.font_size = svg_size(self, '12pt')
+        width, height, _ = node_format(self, tree)
+        scale = max(target_size[0] / width, target_size[1] / height) if width and height else 1
+        super().__init__(tree, None, dpi, scale=scale)
+
+    def to_image(self):
+        self.cairo.flush()
+        return Image.frombuffer('RGBA', (self.width, self.height), bytes(self.cairo.get_data()),
+                                'raw', CAIRO_RAW_MODE, self.cairo.get_stride(), 1)
+
+
+def render_svg(svg_bytes, target_size=(500, 500)):
+    # Rasterize without the cache; runs in the render pool when one is configured
+    return RasterSurface(Tree(bytestring=svg_bytes), target_size).to_image()
+
+
+def configure_svg_render_pool(pool):
+    # Render SVGs in pool (a ProcessPoolExecutor) instead of the calling thread; None renders in place
+    global _render_pool
+    _render_pool = pool
+
+
+def rasterize_svg(svg_bytes, target_size=(500, 500)):
+    """Return the SVG rendered as an RGBA image covering target_size, from the cache if possible."""
+    global _cache_bytes
+    key = (hashlib.sha256(svg_bytes).hexdigest(), tuple(target_size))
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key].copy()
+
+    if _render_pool is not None:
+        image = _render_pool.submit(render_svg, svg_bytes, tuple(target_size)).result()
+    else:
+        image = render_svg(svg_bytes, target_size)
+
+    image_bytes = image.width * image.height * 4
+    with _cache_lock:
+        if key not in _cache and image_bytes <= SVG_CACHE_MAX_BYTES:
+            _cache[key] = image
+            _cache_bytes += image_bytes
+            while _cache_bytes > SVG_CACHE_MAX_BYTES:
+                _, evicted = _cache.popitem(last=False)
+                _cache_bytes -= evicted.width * evicted.height * 4
+    return image.copy()
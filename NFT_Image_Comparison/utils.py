@@ -2,13 +2,25 @@
 import requests
 from PIL import Image, ImageOps
 from io import BytesIO
-import cairosvg
 import logging
 import pandas as pd
 import time
 import base64
+import hashlib
 import logging
-from urllib.parse import unquote
+import math
+import re
+import warnings
+from urllib.parse import unquote, urlsplit, urlunsplit, parse_qsl, urlencode
+from image_cache import get_image_cache
+from result_writer import get_writer
+from rate_limiter import get_rate_limiter
+from svg_render import rasterize_svg
+from response_body import ResponseBody, DOWNLOAD_CHUNK_SIZE
+from gateways import get_gateway_pool
+from metrics import get_metrics, BYTES_BUCKETS
+from circuit_breaker import CircuitOpenError, get_circuit_breakers
+from retry_queue import get_retry_queue
 from requests.exceptions import ConnectionError, Timeout, HTTPError
 
 
@@ -16,17 +28,70 @@ from requests.exceptions import ConnectionError, Timeout, HTTPError
 
 error_log_path = "/data/error_log.csv"
 
+# Images with more pixels than this are rejected before they are decoded (decompression bombs)
+max_image_pixels = 100_000_000
+
+# Large images are decoded at reduced resolution (JPEG DCT scaling) and shrunk by an integer
+# factor with Image.reduce, keeping at least REDUCING_GAP times the target size for the final
+# LANCZOS resample. None always resamples from full resolution.
+REDUCING_GAP = 2.0
+
+# Modes Image.reduce handles correctly; palette images are resampled as before
+REDUCIBLE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'CMYK')
+
+# Subdomain gateway URLs carry the CID in the host name, e.g. https://<cid>.ipfs.nftstorage.link/1.png
+SUBDOMAIN_GATEWAY_PATTERN = re.compile(r'^https?://(?P<cid>[a-zA-Z0-9]+)\.ipfs\.[^/?#]+(?P<path>.*)$')
+
+# Errors after which an IPFS download is retried on another gateway
+GATEWAY_ERRORS = (ConnectionError, Timeout, HTTPError, CircuitOpenError)
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def log_error_to_csv(error_data, error_log_path):
+def set_error_log_path(path):
+    # Error log used by the functions below when they are not given one explicitly
+    global error_log_path
+    error_log_path = path
+
+
+def get_error_log_path():
+    return error_log_path
+
+
+def set_max_image_pixels(limit):
+    # Pillow raises on open above twice its limit and only warns below that; check_image_pixels
+    # rejects everything above limit. 0 disables both checks.
+    global max_image_pixels
+    max_image_pixels = limit
+    Image.MAX_IMAGE_PIXELS = limit or None
+
+
+def check_image_pixels(image):
+    # Call right after Image.open, before the pixel data is decoded
+    if max_image_pixels and image.size[0] * image.size[1] > max_image_pixels:
+        raise ValueError(f"Image of {image.size[0]}x{image.size[1]} pixels exceeds the limit of {max_image_pixels} pixels")
+    return image
+
+
+set_max_image_pixels(max_image_pixels)
+warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+
+
+def log_error_to_csv(error_data, error_log_path=None):
+    if error_log_path is None:
+        error_log_path = get_error_log_path()
+    writer = get_writer(error_log_path)
+    if writer is not None:
+        writer.write(error_data)
+        return
     df_error = pd.DataFrame([error_data])
     df_error.to_csv(error_log_path, mode='a', header=not pd.io.common.file_exists(error_log_path), index=False)
     
  
-def svg_to_png(svg_data):
+def svg_to_png(svg_data, size=(500, 500)):
+    # Despite the name, renders straight to an RGBA image covering size (see svg_render)
     try:
         # Ensure svg_data is a string for startswith checks
         if isinstance(svg_data, bytes):
@@ -50,37 +115,64 @@ def svg_to_png(svg_data):
             logger.error(f"Unexpected SVG data format: {svg_data[:30]}...")
             return None
 
-        # Convert SVG to PNG
-        png_image = cairosvg.svg2png(bytestring=svg_data.encode('utf-8'))
-        return Image.open(BytesIO(png_image))
+        # Render the SVG at the size normalize_image will fit it to
+        with get_metrics().timer('stage_seconds', stage='svg_to_png'):
+            return rasterize_svg(svg_data.encode('utf-8'), size)
 
     except Exception as e:
+        get_metrics().inc('errors_total', stage='svg_to_png', type=type(e).__name__)
         logger.error(f"Error converting SVG to PNG: {e}")
         return None
 
 
-def process_image(image, row, errors_logged, size=(500, 500), transparency_gray_value=255, error_log_path=error_log_path):
+def reduce_for_fit(image, size, reducing_gap=REDUCING_GAP):
+    # Shrink an image that has not been loaded yet as far as possible before ImageOps.fit(image, size)
+    if not reducing_gap:
+        return image
+
+    # ImageOps.fit crops to the target aspect ratio and scales the crop by this factor
+    scale = max(size[0] / image.size[0], size[1] / image.size[1])
+    image.draft(image.mode, (math.ceil(image.size[0] * scale * reducing_gap),
+                             math.ceil(image.size[1] * scale * reducing_gap)))
+
+    scale = max(size[0] / image.size[0], size[1] / image.size[1])
+    factor = int(1 / (scale * reducing_gap))
+    if factor >= 2 and image.mode in REDUCIBLE_MODES:
+        image = image.reduce(factor)
+    return image
+
+
+def normalize_image(image, size=(500, 500), transparency_gray_value=255):
+    image = reduce_for_fit(image, size, REDUCING_GAP)
+
+    # Convert 'P' mode images to 'RGBA' to ensure consistency
+    if image.mode == 'P' and 'transparency' in image.info:
+        image = image.convert('RGBA')
+
+    # Process RGBA images to replace transparent pixels with gray
+    if image.mode == 'RGBA':
+        r, g, b, a = image.split()
+        grayscale = Image.merge('RGB', (r, g, b)).convert('L')
+        mask = Image.eval(a, lambda x: 0 if x == 0 else 255)
+        background = Image.new('L', image.size, transparency_gray_value)
+        background.paste(grayscale, mask=mask)
+        image = background
+
+    # Resize the image to the desired size
+    image = ImageOps.fit(image, size, Image.Resampling.LANCZOS)
+    return image
+
+
+def process_image(image, row, errors_logged, size=(500, 500), transparency_gray_value=255, error_log_path=None):
     asset_id = row.get('asset_id')
 
+    metrics = get_metrics()
     try:
-        # Convert 'P' mode images to 'RGBA' to ensure consistency
-        if image.mode == 'P' and 'transparency' in image.info:
-            image = image.convert('RGBA')
-
-        # Process RGBA images to replace transparent pixels with gray
-        if image.mode == 'RGBA':
-            r, g, b, a = image.split()
-            grayscale = Image.merge('RGB', (r, g, b)).convert('L')
-            mask = Image.eval(a, lambda x: 0 if x == 0 else 255)
-            background = Image.new('L', image.size, transparency_gray_value)
-            background.paste(grayscale, mask=mask)
-            image = background
-
-        # Resize the image to the desired size
-        image = ImageOps.fit(image, size, Image.Resampling.LANCZOS)
-        return image
+        with metrics.timer('stage_seconds', stage='process_image'):
+            return normalize_image(image, size, transparency_gray_value)
 
     except ValueError as e:
+        metrics.inc('errors_total', stage='process_image', type='ValueError')
         if asset_id not in errors_logged:  # Check if asset ID error is already logged
             logger.error(f"Invalid image format for {asset_id}: {e}")
             error_data = row.to_dict()
@@ -89,6 +181,7 @@ def process_image(image, row, errors_logged, size=(500, 500), transparency_gray_
             errors_logged.add(asset_id)
 
     except Exception as e:
+        metrics.inc('errors_total', stage='process_image', type=type(e).__name__)
         if asset_id not in errors_logged:  # Check if asset ID error is already logged
             error_message = f"Error processing {asset_id}: {e}"
             logger.error(error_message)
@@ -107,7 +200,12 @@ def get_extension(content_type):
 
 # Modify IPFS URL to a downloadable link
 def modify_ipfs_url(url):
-    if url.startswith('ipfs://'):
+    subdomain_match = SUBDOMAIN_GATEWAY_PATTERN.match(url)
+    if subdomain_match:
+        return 'http://ipfs:8080/ipfs/' + subdomain_match.group('cid') + subdomain_match.group('path')
+    elif url.startswith('ipfs://ipfs/'):
+        return url.replace('ipfs://ipfs/', 'http://ipfs:8080/ipfs/')
+    elif url.startswith('ipfs://'):
         return url.replace('ipfs://', 'http://ipfs:8080/ipfs/')
     elif 'ipfs.io' in url:  
     	return url.replace('https://ipfs.io/ipfs/', 'http://ipfs:8080/ipfs/')
@@ -118,6 +216,34 @@ def modify_ipfs_url(url):
     return url  
 
 
+def get_ipfs_path(url):
+    # Return '<cid>[/path]' for URLs that modify_ipfs_url maps onto the IPFS gateway, otherwise None
+    gateway_prefix = 'http://ipfs:8080/ipfs/'
+    modified_url = modify_ipfs_url(url)
+    if modified_url.startswith(gateway_prefix):
+        return modified_url[len(gateway_prefix):].split('?')[0].split('#')[0]
+    return None
+
+
+def is_same_content(url, other_url, content=None, other_content=None):
+    # Same IPFS CID and path, or equal content (bytes or their digests) from different URLs
+    if isinstance(url, str) and isinstance(other_url, str):
+        ipfs_path = get_ipfs_path(url)
+        if ipfs_path and ipfs_path == get_ipfs_path(other_url):
+            return True
+    return content is not None and content == other_content
+
+
+def image_cache_key(url):
+    # IPFS content is addressed by CID, so every gateway URL for it shares one cache entry
+    ipfs_path = get_ipfs_path(url)
+    if ipfs_path:
+        return 'ipfs:' + ipfs_path
+    # Otherwise normalize the URL: lowercase scheme and host, sorted query, no fragment
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+
 
 def process_json(json_data, original_url, row, error_log_path):
     
@@ -133,10 +259,112 @@ def process_json(json_data, original_url, row, error_log_path):
 
 
 
-def download_image(url, row, errors_logged, timeout=60, error_log_path=error_log_path, retry=False, is_original_image=False):
+def fetch_image_bytes(url, timeout=60, max_throttle_retries=3):
+    metrics = get_metrics()
+    cache = get_image_cache()
+    if cache is not None:
+        cached = cache.get(image_cache_key(url))
+        if cached is not None:
+            metrics.inc('image_cache_hits_total')
+            return cached
+
+    host = urlsplit(url).netloc
+    start = time.perf_counter()
+    try:
+        # Fails at once while the host's circuit breaker is open
+        with get_circuit_breakers().attempt(url):
+            content, content_type = request_image_bytes(url, timeout, max_throttle_retries)
+    except Exception as e:
+        metrics.inc('download_errors_total', host=host, type=type(e).__name__)
+        raise
+    metrics.observe('download_seconds', time.perf_counter() - start, host=host)
+    metrics.observe('download_size_bytes', len(content), bounds=BYTES_BUCKETS, host=host)
+    metrics.inc('download_bytes_total', len(content), host=host)
+
+    if cache is not None:
+        cache.put(image_cache_key(url), content, content_type)
+    return content, content_type
+
+
+def request_image_bytes(url, timeout=60, max_throttle_retries=3):
+    # The rate limiter paces requests per host and backs off on 429/503 responses
+    rate_limiter = get_rate_limiter()
+    for attempt in range(max_throttle_retries + 1):
+        rate_limiter.acquire(url)
+        response = requests.get(url, timeout=timeout, stream=True)
+        if not rate_limiter.feedback(url, response.status_code, response.headers):
+            break
+        response.close()
+
+    # Stream the body so oversized or non-image responses are dropped after the first chunks
+    with response:
+        response.raise_for_status()
+        body = ResponseBody(response.headers.get('Content-Type'), response.headers.get('Content-Length'))
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            body.feed(chunk)
+        content, content_type = body.finish()
+    return content, content_type
+
+
+def fetch_ipfs_bytes(ipfs_path, timeout=60):
+    # Fetch '<cid>[/path]' from the fastest healthy gateway, hedged with the next one when it is slow
+    return get_gateway_pool().fetch_sync(ipfs_path, lambda url: fetch_image_bytes(url, timeout=timeout), GATEWAY_ERRORS)
+
+
+def decode_image(content, content_type):
+    if 'image/svg+xml' in content_type:
+        image = svg_to_png(content)
+        return image, 'image/svg+xml'
+    else:
+        image = check_image_pixels(Image.open(BytesIO(content)))
+        # Lets cascade mode recognize byte-identical images after decoding
+        image.info['content_digest'] = hashlib.sha256(content).hexdigest()
+        return image, content_type
+
+
+def log_download_error(url, row, errors_logged, e, error_log_path=None):
+    asset_id = row.get('asset_id')
+    error_message = f"Error downloading image {asset_id} : {url}: {e}"
+    if asset_id not in errors_logged:
+        # Transient failures are retried after the main pass instead of being logged
+        retry_queue = get_retry_queue()
+        if retry_queue is not None and retry_queue.defer(asset_id, f"Error downloading image : {url}: {e}", e):
+            logger.warning(f"{error_message}; will retry")
+            return
+        logger.error(error_message)
+        error_data = row.to_dict()
+        error_data['error_type'] = f"Error downloading image : {url}: {e}"
+        log_error_to_csv(error_data, error_log_path)
+        errors_logged.add(asset_id)
+
+
+def is_inline_image(url):
+    # Raw SVG markup and data URLs carry the image in the URL itself
+    return url.startswith('<?xml') or url.startswith('<svg') or url.startswith('data:image/')
+
+
+def decode_inline_image(url):
+    if url.startswith('<?xml') or url.startswith('<svg'):
+        # Handle raw SVG XML strings
+        image = svg_to_png(url)
+        return image, 'image/png'
+    elif url.startswith('data:image/svg+xml;utf8,') or url.startswith('data:image/svg+xml,') or url.startswith('data:image/svg+xml;base64,'):
+        # Handle different SVG data URL formats
+        image = svg_to_png(url)
+        return image, 'image/png'
+    else:
+        # Handle other image data URLs (PNG, JPEG, etc.)
+        content_type = url.split(';')[0].split('/')[1]
+        encoded_data = url.split(',')[1]
+        data = base64.b64decode(encoded_data)
+        image = check_image_pixels(Image.open(BytesIO(data)))
+        return image, f'image/{content_type}'
+
+
+def download_image(url, row, errors_logged, timeout=60, error_log_path=None, retry=False, is_original_image=False):
     asset_id = row.get('asset_id')
 
-    if not isinstance(errors_logged, set):
+    if errors_logged is None:
         errors_logged = set()
 
     if asset_id in errors_logged:
@@ -144,50 +372,46 @@ def download_image(url, row, errors_logged, timeout=60, error_log_path=error_log
 
     retry_timeout = 20 if retry else timeout
     try:
-        if url.startswith('<?xml') or url.startswith('<svg'):
-            # Handle raw SVG XML strings
-            image = svg_to_png(url)
-            return image, 'image/png'
-        elif url.startswith('data:image/svg+xml;utf8,') or url.startswith('data:image/svg+xml,') or url.startswith('data:image/svg+xml;base64,'):
-            # Handle different SVG data URL formats
-            image = svg_to_png(url)
-            return image, 'image/png'
-        elif url.startswith('data:image/'):
-            # Handle other image data URLs (PNG, JPEG, etc.)
-            content_type = url.split(';')[0].split('/')[1]
-            encoded_data = url.split(',')[1]
-            data = base64.b64decode(encoded_data)
-            image = Image.open(BytesIO(data))
-            return image, f'image/{content_type}'
-        else:
-            # Regular image URLs
-            response = requests.get(url, timeout=retry_timeout)
-            response.raise_for_status()
-            time.sleep(0.01)  # Delay after each request
-
-            if 'image/svg+xml' in response.headers['Content-Type']:
-                image = svg_to_png(response.content)
-                return image, 'image/svg+xml'
+        with get_metrics().timer('stage_seconds', stage='download_image'):
+            if is_inline_image(url):
+                return decode_inline_image(url)
+            elif get_ipfs_path(url) and get_gateway_pool() is not None:
+                # IPFS content can come from any gateway in the pool
+                content, content_type = fetch_ipfs_bytes(get_ipfs_path(url), timeout=timeout)
+                return decode_image(content, content_type)
             else:
-                image = Image.open(BytesIO(response.content))
-                return image, response.headers['Content-Type']
+                # Regular image URLs
+                content, content_type = fetch_image_bytes(url, timeout=retry_timeout)
+                return decode_image(content, content_type)
 
     except Exception as e:
     
-        if 'ipfs:8080' in url and not retry and is_original_image and isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,requests.exceptions.HTTPError)):  
+        if 'ipfs:8080' in url and not retry and is_original_image and get_gateway_pool() is None and isinstance(e, GATEWAY_ERRORS):  
             logger.error(f"Error downloading image asset ID: {asset_id} : {url}: {e}")
             new_url = url.replace('http://ipfs:8080/ipfs/', 'https://ipfs.io/ipfs/')
             logger.warning(f"Retrying with public gateway for asset ID: {asset_id}")
             return download_image(new_url, row, errors_logged, timeout, error_log_path, retry=True)
 
+        get_metrics().inc('errors_total', stage='download_image', type=type(e).__name__)
+        log_download_error(url, row, errors_logged, e, error_log_path)
+        return None, None
 
-        error_message = f"Error downloading image {asset_id} : {url}: {e}"
-        if asset_id not in errors_logged:
-            logger.error(error_message)
-            error_data = row.to_dict()
-            error_data['error_type'] = f"Error downloading image : {url}: {e}"
-            log_error_to_csv(error_data, error_log_path)
-            errors_logged.add(asset_id)
 
+def load_prefetched_image(url, payload, row, errors_logged, error_log_path=None):
+    """Decode an image whose bytes were already fetched, e.g. by the async fetcher.
+
+    payload is either a (content, content_type) tuple or the exception raised while fetching.
+    """
+    asset_id = row.get('asset_id')
+
+    if asset_id in errors_logged:
         return None, None
 
+    try:
+        if isinstance(payload, Exception):
+            raise payload
+        content, content_type = payload
+        return decode_image(content, content_type)
+    except Exception as e:
+        log_download_error(url, row, errors_logged, e, error_log_path)
+        return None, None
@@ -0,0 +1,316 @@
+"""End-to-end throughput benchmarks against the local stand-in server.
+
+Starts standin_server.py and runs each scenario in a fresh child process. For every
+scenario it reports rows/sec, p50/p99 latency per stage and peak RSS (of the scenario
+process and of its worker processes).
+
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --scenarios main_staged main_threads --rows 500
+    python benchmarks/run_benchmarks.py --save baseline.json
+    python benchmarks/run_benchmarks.py --compare baseline.json
+
+Scenarios:
+    retrieve          retrieve_opensea_events.fetch_all_events + write_csv
+    retrieve_stream   retrieve_opensea_events.stream_events
+    select_random     select_random_nfts_skip_errors.main
+    main_staged       NFT_Image_Comparison main.py --mode staged
+    main_async        NFT_Image_Comparison main.py --mode async
+    main_threads      NFT_Image_Comparison main.py --mode threads
+
+Rate limits are raised far above the stand-in's capacity so that the benchmarks measure
+the pipeline, not the configured pace.
+"""
+import argparse
+import asyncio
+import csv
+import functools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COLLECTION_DIR = os.path.join(REPO_DIR, 'Data_Collection')
+COMPARISON_DIR = os.path.join(REPO_DIR, 'NFT_Image_Comparison')
+SERVER_SCRIPT = os.path.join(REPO_DIR, 'benchmarks', 'standin_server.py')
+
+SCENARIOS = ['retrieve', 'retrieve_stream', 'select_random', 'main_staged', 'main_async', 'main_threads']
+
+# Start of the time range the collector scenarios query
+BENCHMARK_START = datetime(2022, 4, 20, tzinfo=timezone.utc)
+
+
+class StageTimer:
+    # Latency samples per stage, collected by wrapping the functions that implement each stage
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timed
+
+    def wrap_async(self, stage, fn):
+        @functools.wraps(fn)
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timed
+
+    def summary(self):
+        result = {}
+        for stage, samples in self.samples.items():
+            samples = sorted(samples)
+            result[stage] = {
+                'count': len(samples),
+                'p50_ms': 1000 * samples[int(0.50 * (len(samples) - 1))],
+                'p99_ms': 1000 * samples[int(0.99 * (len(samples) - 1))],
+            }
+        return result
+
+
+def write_config_modules(workdir):
+    # The collectors import api_key.py / config.py at import time
+    for name in ('api_key.py', 'config.py'):
+        with open(os.path.join(workdir, name), 'w') as f:
+            f.write("OPENSEA_APIKEY = 'standin'\n")
+
+
+def count_csv_rows(path):
+    try:
+        with open(path, newline='', encoding='utf-8') as f:
+            return max(sum(1 for _ in csv.reader(f)) - 1, 0)
+    except FileNotFoundError:
+        return 0
+
+
+# Scenarios, each run inside a child process; they return the number of rows produced
+
+def run_retrieve(timer, options, stream=False):
+    import retrieve_opensea_events as collector
+    from rate_limiter import configure_rate_limiter
+
+    collector.OPENSEA_API_ENDPOINT = options.base_url + '/api/v1/events'
+    configure_rate_limiter({urlparse(options.base_url).netloc: (100000.0, 100000.0)})
+    collector.get_events = timer.wrap('get_events', collector.get_events)
+
+    start_date = BENCHMARK_START
+    end_date = start_date + timedelta(hours=options.hours)
+    outfile = os.path.join(options.workdir, 'retrieve_stream.csv' if stream else 'retrieve.csv')
+    if stream:
+        checkpoint = outfile + '.checkpoint.json'
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        rows, _ = collector.stream_events(start_date, end_date, outfile, checkpoint)
+        return rows
+
+    events = collector.fetch_all_events(start_date, end_date)
+    collector.write_csv = timer.wrap('write', collector.write_csv)
+    collector.write_csv(events, outfile)
+    return len(events)
+
+
+def run_select_random(timer, options):
+    import select_random_nfts_skip_errors as collector
+    from rate_limiter import configure_rate_limiter
+
+    collector.OPENSEA_API_ENDPOINT = options.base_url + '/api/v1/events'
+    # main() starts the API at 1 request/s and ramps up; start at full rate instead
+    collector.configure_rate_limiter = lambda *args: configure_rate_limiter(
+        {urlparse(options.base_url).netloc: (100000.0, 100000.0)})
+    collector.get_events = timer.wrap('get_events', collector.get_events)
+    collector.collect_window = timer.wrap('window', collector.collect_window)
+
+    # select_random always collects whole days
+    start = BENCHMARK_START.strftime('%Y-%m-%d %H:%M')
+    outfile = os.path.join(options.workdir, 'select_random.csv')
+    sys.argv = ['select_random_nfts_skip_errors.py', '-s', start, '-e', start, '-o', outfile, '--max_rate', '100000']
+    collector.main()
+    return count_csv_rows(outfile)
+
+
+def run_main(timer, options, mode):
+    import main as pipeline
+    import fetcher
+    import processing
+    import result_writer
+    import utils
+
+    utils.fetch_image_bytes = timer.wrap('download', utils.fetch_image_bytes)
+    fetcher.AsyncFetcher.fetch = timer.wrap_async('download', fetcher.AsyncFetcher.fetch)
+    processing.process_image = timer.wrap('process', processing.process_image)
+    pipeline.compare_images = timer.wrap('compare', pipeline.compare_images)
+    pipeline.PairBatcher.score = timer.wrap_async('decode_process_compare', pipeline.PairBatcher.score)
+    result_writer.ResultWriter._flush = timer.wrap('write', result_writer.ResultWriter._flush)
+
+    outputs = {name: os.path.join(options.workdir, f'{mode}_{name}')
+               for name in ('results.csv', 'errors.csv', 'checkpoint.sqlite', 'phash_index.sqlite', 'analytics.sqlite',
+                            'metrics.json', 'cache')}
+    for path in outputs.values():
+        if os.path.isfile(path):
+            os.remove(path)
+
+    sys.argv = ['main.py', '--csv_path', options.dataset, '--mode', mode,
+                '--results_path', outputs['results.csv'], '--error_log_path', outputs['errors.csv'],
+                '--checkpoint_path', outputs['checkpoint.sqlite'], '--phash_index', outputs['phash_index.sqlite'],
+                '--analytics', outputs['analytics.sqlite'],
+                '--metrics_path', outputs['metrics.json'], '--metrics_port', '0',
+                '--cache_dir', outputs['cache'] if options.cache else '',
+                '--host_rate', f"{urlparse(options.base_url).netloc}=100000"]
+    pipeline.main()
+    return count_csv_rows(outputs['results.csv'])
+
+
+def run_child(options):
+    sys.path[:0] = [options.workdir, COLLECTION_DIR, COMPARISON_DIR]
+    timer = StageTimer()
+    scenario = options.child
+    start = time.perf_counter()
+    if scenario == 'retrieve':
+        rows = run_retrieve(timer, options)
+    elif scenario == 'retrieve_stream':
+        rows = run_retrieve(timer, options, stream=True)
+    elif scenario == 'select_random':
+        rows = run_select_random(timer, options)
+    else:
+        rows = run_main(timer, options, scenario[len('main_'):])
+    seconds = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux
+    report = {
+        'scenario': scenario,
+        'rows': rows,
+        'seconds': seconds,
+        'rows_per_sec': rows / seconds if seconds else 0.0,
+        'stages': timer.summary(),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_worker_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+    print('BENCHMARK_RESULT ' + json.dumps(report), flush=True)
+
+
+def start_server(options):
+    command = [sys.executable, SERVER_SCRIPT, '--port', '0', '--latency_ms', str(options.latency_ms),
+               '--jitter_ms', str(options.jitter_ms), '--error_rate', str(options.error_rate),
+               '--throttle_rate', str(options.throttle_rate), '--events_per_hour', str(options.events_per_hour)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = server.stdout.readline()
+    return server, line.strip().rsplit(' ', 1)[-1]
+
+
+def build_dataset(options):
+    # Input for the main.py scenarios: collector output for enough hours to have options.rows events
+    sys.path[:0] = [options.workdir, COLLECTION_DIR]
+    import retrieve_opensea_events as collector
+    from rate_limiter import configure_rate_limiter
+
+    collector.OPENSEA_API_ENDPOINT = options.base_url + '/api/v1/events'
+    configure_rate_limiter({urlparse(options.base_url).netloc: (100000.0, 100000.0)})
+    hours = -(-options.rows // options.events_per_hour)
+    events = collector.fetch_all_events(BENCHMARK_START, BENCHMARK_START + timedelta(hours=hours))[:options.rows]
+    collector.write_csv(events, options.dataset)
+
+
+def run_scenario(scenario, options):
+    command = [sys.executable, os.path.abspath(__file__), '--child', scenario, '--base_url', options.base_url,
+               '--workdir', options.workdir, '--dataset', options.dataset, '--hours', str(options.hours)]
+    if options.cache:
+        command.append('--cache')
+    completed = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    for line in completed.stdout.splitlines():
+        if line.startswith('BENCHMARK_RESULT '):
+            return json.loads(line[len('BENCHMARK_RESULT '):])
+    return {'scenario': scenario, 'error': f"exit code {completed.returncode}"}
+
+
+def print_report(reports, baseline=None):
+    baseline = {report['scenario']: report for report in (baseline or [])}
+    for report in reports:
+        if 'error' in report:
+            print(f"{report['scenario']}: failed ({report['error']})")
+            continue
+        line = (f"{report['scenario']}: {report['rows']} rows in {report['seconds']:.2f}s, "
+                f"{report['rows_per_sec']:.1f} rows/s, peak RSS {report['peak_rss_mb']:.0f} MB "
+                f"(workers {report['peak_worker_rss_mb']:.0f} MB)")
+        previous = baseline.get(report['scenario'])
+        if previous and previous.get('rows_per_sec'):
+            line += f", {report['rows_per_sec'] / previous['rows_per_sec']:.2f}x baseline rows/s"
+        print(line)
+        for stage, stats in sorted(report['stages'].items()):
+            print(f"    {stage:<24} n={stats['count']:<7} p50={stats['p50_ms']:9.2f} ms  p99={stats['p99_ms']:9.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--rows', type=int, default=300, help='Input rows for the main.py scenarios')
+    parser.add_argument('--hours', type=int, default=6, help='Hours of events for the retrieve scenarios')
+    parser.add_argument('--events_per_hour', type=int, default=600)
+    parser.add_argument('--latency_ms', type=float, default=20.0)
+    parser.add_argument('--jitter_ms', type=float, default=10.0)
+    parser.add_argument('--error_rate', type=float, default=0.0)
+    parser.add_argument('--throttle_rate', type=float, default=0.0)
+    parser.add_argument('--cache', action='store_true', help='Enable the image cache in the main.py scenarios')
+    parser.add_argument('--save', help='Write the results as JSON, e.g. as a baseline')
+    parser.add_argument('--compare', help='Baseline JSON written by --save to compare against')
+    # Used internally to run one scenario in a child process
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--base_url', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--dataset', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.child:
+        return run_child(options)
+
+    server, options.base_url = start_server(options)
+    try:
+        with tempfile.TemporaryDirectory(prefix='nft-benchmark-') as workdir:
+            options.workdir = workdir
+            options.dataset = os.path.join(workdir, 'dataset.csv')
+            write_config_modules(workdir)
+            if any(scenario.startswith('main_') for scenario in options.scenarios):
+                build_dataset(options)
+
+            reports = []
+            for scenario in options.scenarios:
+                print(f"Running {scenario}...", flush=True)
+                reports.append(run_scenario(scenario, options))
+    finally:
+        server.terminate()
+        server.wait()
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+    print()
+    print_report(reports, baseline)
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
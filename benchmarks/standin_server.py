@@ -0,0 +1,277 @@
+"""Local stand-in for the OpenSea events API and the image hosts.
+
+Serves, on one port:
+
+    /api/v1/events          paginated events in the shape parse_event expects, newest first
+                            like the OpenSea API (--oldest_first reverses it). Supports
+                            occurred_after, occurred_before, cursor and limit. The cursor is
+                            returned both as 'next' (retrieve_opensea_events.py) and as
+                            'cursor' (select_random_nfts_skip_errors.py).
+    /images/<n>             OpenSea-style 500px JPEG preview of asset n
+    /originals/<kind>/<n>   original of asset n, kind is one of ORIGINAL_KINDS
+
+Latency, error rate and 429 rate are configurable. Everything generated is deterministic,
+so runs against the same settings are comparable.
+
+    python standin_server.py --port 8765 --latency_ms 50 --throttle_rate 0.01
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+from PIL import Image
+
+# Original image formats served under /originals/<kind>/<n>
+ORIGINAL_KINDS = ['jpeg', 'png_palette', 'png_rgba', 'svg', 'large_jpeg', 'large_png']
+
+# Distinct artworks; asset n shows artwork n % VARIANTS so the server can cache encoded bytes
+VARIANTS = 8
+
+
+def artwork(variant, size):
+    # Smooth gradients with a few shapes: compresses like real artwork, unlike noise.
+    # Large sizes are drawn at 1000px and upscaled, which is much cheaper to generate.
+    if max(size) > 1000:
+        return artwork(variant, (1000, 1000)).resize(size[::-1], Image.Resampling.BICUBIC)
+    rng = np.random.default_rng(variant)
+    h, w = size
+    y, x = np.mgrid[0:h, 0:w]
+    pixels = np.zeros((h, w, 3), dtype=np.float64)
+    for channel in range(3):
+        fx, fy, phase = rng.uniform(1, 6), rng.uniform(1, 6), rng.uniform(0, np.pi)
+        pixels[..., channel] = 127 + 120 * np.sin(fx * x / w * np.pi + phase) * np.cos(fy * y / h * np.pi)
+    for _ in range(6):
+        cx, cy, r = rng.integers(0, w), rng.integers(0, h), rng.integers(min(h, w) // 20, min(h, w) // 5)
+        mask = (x - cx) ** 2 + (y - cy) ** 2 < r ** 2
+        pixels[mask] = rng.integers(0, 255, 3)
+    return Image.fromarray(pixels.clip(0, 255).astype(np.uint8))
+
+
+def encode(image, fmt, **kwargs):
+    buffer = BytesIO()
+    image.save(buffer, fmt, **kwargs)
+    return buffer.getvalue()
+
+
+def render_original(kind, variant):
+    # Return (content, content_type) for an original image
+    if kind == 'jpeg':
+        return encode(artwork(variant, (1000, 1000)), 'JPEG', quality=90), 'image/jpeg'
+    if kind == 'png_palette':
+        return encode(artwork(variant, (800, 800)).quantize(64), 'PNG'), 'image/png'
+    if kind == 'png_rgba':
+        image = artwork(variant, (800, 800)).convert('RGBA')
+        alpha = np.full((800, 800), 255, dtype=np.uint8)
+        alpha[:100] = 0
+        alpha[:, :100] = 0
+        image.putalpha(Image.fromarray(alpha))
+        return encode(image, 'PNG'), 'image/png'
+    if kind == 'svg':
+        rng = random.Random(variant)
+        shapes = ''.join(
+            f'<circle cx="{rng.randint(0, 512)}" cy="{rng.randint(0, 512)}" r="{rng.randint(20, 120)}" '
+            f'fill="#{rng.randint(0, 0xFFFFFF):06x}"/>' for _ in range(12))
+        svg = (f'<svg xmlns="http://www.w3.org/2000/svg" width="512" height="512">'
+               f'<rect width="512" height="512" fill="#{rng.randint(0, 0xFFFFFF):06x}"/>{shapes}</svg>')
+        return svg.encode('utf-8'), 'image/svg+xml'
+    if kind == 'large_jpeg':
+        return encode(artwork(variant, (4000, 4000)), 'JPEG', quality=92), 'image/jpeg'
+    if kind == 'large_png':
+        return encode(artwork(variant, (3000, 3000)), 'PNG'), 'image/png'
+    raise KeyError(kind)
+
+
+def render_preview(variant):
+    return encode(artwork(variant, (1000, 1000)).resize((500, 500), Image.Resampling.LANCZOS), 'JPEG', quality=85), 'image/jpeg'
+
+
+class StandinState:
+    def __init__(self, base_url, events_per_hour=600, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0,
+                 throttle_rate=0.0, retry_after=1, seed=0, oldest_first=False):
+        self.base_url = base_url
+        self.oldest_first = oldest_first
+        self.events_per_hour = events_per_hour
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+
+    def roll(self):
+        with self.random_lock:
+            return self.random.random(), self.random.gauss(0, 1)
+
+    def cached(self, key, render):
+        with self.cache_lock:
+            if key not in self.cache:
+                self.cache[key] = render()
+            return self.cache[key]
+
+    def warm(self):
+        # Render every image up front so the first benchmark run does not pay for it
+        for variant in range(VARIANTS):
+            self.cached(('preview', variant), lambda: render_preview(variant))
+            for kind in ORIGINAL_KINDS:
+                self.cached((kind, variant), lambda: render_original(kind, variant))
+
+    def event_times(self, after, before):
+        # Events happen every 3600 / events_per_hour seconds, aligned to the epoch
+        step = 3600.0 / self.events_per_hour
+        first = int(np.ceil(after / step))
+        last = int(np.ceil(before / step))
+        return first, last, step
+
+    def make_event(self, n, timestamp):
+        kind = ORIGINAL_KINDS[n % len(ORIGINAL_KINDS)]
+        created = datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')
+        collection = f"standin-collection-{n % 50}"
+        return {
+            'id': n,
+            'created_date': created,
+            'contract_address': '0x00000000000000adc04c56bf30ac9d3c0aaf14dc',
+            'asset': {
+                'id': 1000000 + n,
+                'name': f"Standin #{n}",
+                'token_id': str(n),
+                'asset_contract': {
+                    'created_date': '2023-11-04T09:00:40.397906',
+                    'address': f"0x{n % 50:040x}",
+                    'chain_identifier': ['ethereum', 'matic', 'arbitrum'][n % 3],
+                    'asset_contract_type': 'non-fungible',
+                    'owner': 1234,
+                    'schema_name': 'ERC721',
+                    'symbol': 'STAND',
+                },
+                'external_link': None,
+                'permalink': f"https://opensea.io/assets/ethereum/0x{n % 50:040x}/{n}",
+                'image_url': f"{self.base_url}/images/{n}?w=500&auto=format",
+                'animation_url': None,
+                'image_original_url': f"{self.base_url}/originals/{kind}/{n}",
+                'animation_original_url': None,
+                'token_metadata': f"ipfs://bafystandin{n % 50}/{n}.json",
+                'collection': {
+                    'slug': collection,
+                    'name': collection.replace('-', ' ').title(),
+                    'created_date': '2023-11-06T02:33:40.270639+00:00',
+                    'featured': False,
+                    'featured_image_url': f"{self.base_url}/images/{n % 50}",
+                    'safelist_request_status': 'not_requested',
+                    'is_nsfw': False,
+                    'hidden': False,
+                    'fees': {'seller_fees': {}},
+                    'discord_url': None,
+                },
+            },
+        }
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, content, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        state = self.state
+        chance, noise = state.roll()
+        delay = max(state.latency_ms + state.jitter_ms * noise, 0) / 1000
+        if delay:
+            time.sleep(delay)
+
+        if chance < state.throttle_rate:
+            return self.send_body(429, b'Too Many Requests', 'text/plain', {'Retry-After': str(state.retry_after)})
+        if chance < state.throttle_rate + state.error_rate:
+            return self.send_body(500, b'Internal Server Error', 'text/plain')
+
+        parts = urlsplit(self.path)
+        segments = [segment for segment in parts.path.split('/') if segment]
+        try:
+            if parts.path == '/api/v1/events':
+                return self.events(parse_qs(parts.query))
+            if len(segments) == 2 and segments[0] == 'images':
+                content, content_type = state.cached(('preview', int(segments[1]) % VARIANTS),
+                                                     lambda: render_preview(int(segments[1]) % VARIANTS))
+                return self.send_body(200, content, content_type)
+            if len(segments) == 3 and segments[0] == 'originals':
+                kind, variant = segments[1], int(segments[2]) % VARIANTS
+                content, content_type = state.cached((kind, variant), lambda: render_original(kind, variant))
+                return self.send_body(200, content, content_type)
+        except (KeyError, ValueError):
+            pass
+        self.send_body(404, b'Not Found', 'text/plain')
+
+    def events(self, query):
+        state = self.state
+        after = int(query.get('occurred_after', ['0'])[0])
+        before = int(query.get('occurred_before', [str(int(time.time()))])[0])
+        limit = int(query.get('limit', ['50'])[0] or 50)
+        offset = int(query.get('cursor', ['0'])[0] or 0)
+
+        first, last, step = state.event_times(after, before)
+        if state.oldest_first:
+            page = range(first + offset, min(first + offset + limit, last))
+        else:
+            page = range(last - 1 - offset, max(last - 1 - offset - limit, first - 1), -1)
+        next_cursor = str(offset + limit) if first + offset + limit < last else None
+        body = {
+            'asset_events': [state.make_event(n, n * step) for n in page],
+            'next': next_cursor,
+            'cursor': next_cursor,
+        }
+        self.send_body(200, json.dumps(body).encode('utf-8'), 'application/json')
+
+
+def make_server(host='127.0.0.1', port=8765, **options):
+    server = ThreadingHTTPServer((host, port), None)
+    server.daemon_threads = True
+    state = StandinState(f"http://{host}:{server.server_port}", **options)
+    server.RequestHandlerClass = type('BoundStandinHandler', (StandinHandler,), {'state': state})
+    state.warm()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--events_per_hour', type=int, default=600)
+    parser.add_argument('--latency_ms', type=float, default=0.0, help='Mean added latency per request')
+    parser.add_argument('--jitter_ms', type=float, default=0.0, help='Standard deviation of the added latency')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of requests answered with 500')
+    parser.add_argument('--throttle_rate', type=float, default=0.0, help='Fraction of requests answered with 429')
+    parser.add_argument('--retry_after', type=int, default=1, help='Retry-After seconds sent with 429 responses')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--oldest_first', action='store_true', help='Return events oldest first instead of newest first')
+    args = parser.parse_args()
+
+    options = vars(args)
+    server = make_server(options.pop('host'), options.pop('port'), **options)
+    print(f"Stand-in server listening on http://{server.server_address[0]}:{server.server_port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
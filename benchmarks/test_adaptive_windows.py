@@ -0,0 +1,83 @@
+"""The adaptive windows of the collectors must return exactly the events of the fixed windows,
+whichever order the API returns a page in.
+
+    python -m pytest benchmarks/test_adaptive_windows.py
+"""
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
+import pytest
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+COLLECTION_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'Data_Collection')
+sys.path[:0] = [BENCHMARKS_DIR, COLLECTION_DIR]
+
+from standin_server import make_server
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+END = START + timedelta(hours=24) - timedelta(minutes=1)
+
+
+@pytest.fixture(scope='module')
+def server():
+    server = make_server(port=0, events_per_hour=600)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture(scope='module')
+def collectors(server, tmp_path_factory):
+    # The collectors import api_key.py / config.py at import time
+    config_dir = tmp_path_factory.mktemp('config')
+    for name in ('api_key.py', 'config.py'):
+        (config_dir / name).write_text("OPENSEA_APIKEY = 'standin'\n")
+    sys.path.insert(0, str(config_dir))
+    import retrieve_opensea_events
+    import select_random_nfts_skip_errors
+    from rate_limiter import configure_rate_limiter
+
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    for collector in (retrieve_opensea_events, select_random_nfts_skip_errors):
+        collector.OPENSEA_API_ENDPOINT = base_url + '/api/v1/events'
+    configure_rate_limiter({urlparse(base_url).netloc: (100000.0, 100000.0)})
+    return retrieve_opensea_events, select_random_nfts_skip_errors
+
+
+def event_ids(records):
+    ids = [record['event_id'] for record in records]
+    assert len(ids) == len(set(ids)), 'duplicate events'
+    return set(ids)
+
+
+@pytest.mark.parametrize('oldest_first', [False, True])
+def test_retrieve_adaptive_matches_single_cursor(server, collectors, oldest_first):
+    retrieve, _ = collectors
+    server.RequestHandlerClass.state.oldest_first = oldest_first
+    expected = event_ids(retrieve.fetch_all_events(START, END))
+    assert len(expected) > 0
+    assert event_ids(retrieve.fetch_events_adaptive(START, END, workers=4)) == expected
+
+
+@pytest.mark.parametrize('oldest_first', [False, True])
+def test_select_random_adaptive_matches_hourly(server, collectors, oldest_first):
+    _, select_random = collectors
+    server.RequestHandlerClass.state.oldest_first = oldest_first
+    start = START.replace(hour=0, minute=0)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        expected = event_ids(record for _, _, records in select_random.collect_hourly(start, start, executor, 4)
+                             for record in records)
+        windows = select_random.AdaptiveWindows(select_random.collect_first_page, select_random.collect_window)
+        collected = select_random.collect_adaptive(windows, start, start, executor, 4)
+        chronological = [(window_start, window_end) for window_start, window_end, _ in collected]
+        assert all(a[1] <= b[0] for a, b in zip(chronological, chronological[1:]))
+        windows = select_random.AdaptiveWindows(select_random.collect_first_page, select_random.collect_window)
+        actual = event_ids(record for _, _, records in select_random.collect_adaptive(windows, start, start, executor, 4)
+                           for record in records)
+    assert len(expected) == 24 * 600
+    assert actual == expected
+    assert windows.splits > 0
@@ -0,0 +1,83 @@
+"""ResultAnalytics aggregates: counting each asset once and merging shards.
+
+    python -m pytest tests/test_analytics.py
+"""
+import math
+import numpy as np
+import pytest
+from analytics import ResultAnalytics, UNKNOWN_VALUE
+
+
+def record(asset_id, ssim_score, phash_difference, collection_slug='punks', extensions=('png', 'png'), mse_score=10.0):
+    return {'asset_id': asset_id, 'ssim_score': ssim_score, 'mse_score': mse_score,
+            'phash_difference': phash_difference, 'collection_slug': collection_slug,
+            'chain_identifier': 'ethereum', 'opensea_extension': extensions[0], 'original_extension': extensions[1]}
+
+
+@pytest.fixture
+def analytics(tmp_path):
+    return ResultAnalytics(str(tmp_path / 'analytics.sqlite'), mismatch_threshold=8)
+
+
+def summary_of(analytics, dimension, value):
+    rows = analytics.summary(dimension, value)
+    assert len(rows) == 1
+    return rows[0]
+
+
+def test_statistics_of_added_records(analytics):
+    ssim = [0.9, 0.5, 0.2, 0.95]
+    phash = [2, 30, 120, 8]
+    assert analytics.add_records([record(i, s, p) for i, (s, p) in enumerate(zip(ssim, phash))]) == 4
+
+    row = summary_of(analytics, 'collection_slug', 'punks')
+    assert row['results'] == 4
+    assert row['mismatches'] == 2
+    assert row['ssim_score_mean'] == pytest.approx(np.mean(ssim))
+    assert row['ssim_score_std'] == pytest.approx(np.std(ssim))
+    assert (row['ssim_score_min'], row['ssim_score_max']) == (0.2, 0.95)
+    assert row['ssim_score_min'] <= row['ssim_score_p50'] <= row['ssim_score_max']
+    assert analytics.histogram('all', 'all', 'phash_difference').count == 4
+
+
+def test_each_asset_is_counted_once(analytics):
+    assert analytics.add_records([record(1, 0.9, 2), record(2, 0.5, 30)]) == 2
+    # A resumed run or a re-import writes the same assets again, possibly as floats
+    assert analytics.add_records([record(1.0, 0.1, 200), record('2', 0.1, 200), record(3, 0.7, 4)]) == 1
+    row = summary_of(analytics, 'all', 'all')
+    assert (row['results'], row['mismatches']) == (3, 1)
+    assert row['ssim_score_max'] == 0.9
+
+
+def test_missing_scores_and_dimensions(analytics):
+    analytics.add_records([record(1, math.nan, 3, collection_slug=None, extensions=('svg+xml', '')),
+                           record(2, '', 40, collection_slug='')])
+    row = summary_of(analytics, 'collection_slug', UNKNOWN_VALUE)
+    assert row['results'] == 2
+    assert 'ssim_score_mean' not in row
+    assert row['phash_difference_mean'] == 21.5
+    assert summary_of(analytics, 'extension_pair', f"svg+xml->{UNKNOWN_VALUE}")['results'] == 1
+
+
+def test_merge_adds_disjoint_shards(tmp_path, analytics):
+    shard = ResultAnalytics(str(tmp_path / 'analytics.shard-1-of-2.sqlite'))
+    analytics.add_records([record(1, 0.9, 2), record(2, 0.4, 60, collection_slug='apes')])
+    shard.add_records([record(3, 0.3, 90), record(4, 0.8, 1, collection_slug='apes')])
+
+    combined = ResultAnalytics(str(tmp_path / 'combined.sqlite'))
+    combined.add_records([record(i, s, p, collection_slug=c) for i, s, p, c in
+                          [(1, 0.9, 2, 'punks'), (2, 0.4, 60, 'apes'), (3, 0.3, 90, 'punks'), (4, 0.8, 1, 'apes')]])
+
+    analytics.merge(shard.path)
+    for dimension in ('all', 'collection_slug', 'extension_pair'):
+        assert analytics.summary(dimension) == combined.summary(dimension)
+
+
+def test_merge_rejects_overlapping_assets(tmp_path, analytics):
+    shard = ResultAnalytics(str(tmp_path / 'other.sqlite'))
+    analytics.add_records([record(1, 0.9, 2)])
+    shard.add_records([record(1.0, 0.9, 2), record(2, 0.5, 50)])
+    with pytest.raises(ValueError):
+        analytics.merge(shard.path)
+    assert summary_of(analytics, 'all', 'all')['results'] == 1
+    assert analytics.add_records([record(2, 0.5, 50)]) == 1
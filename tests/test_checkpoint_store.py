@@ -0,0 +1,91 @@
+"""CheckpointStore and the DoneView / FailedView sets the pipeline uses in its place.
+
+    python -m pytest tests/test_checkpoint_store.py
+"""
+import pytest
+from checkpoint_store import CheckpointStore, DoneView, FailedView
+from result_writer import ResultWriter
+
+
+@pytest.fixture
+def store(tmp_path):
+    return CheckpointStore(str(tmp_path / 'checkpoint.sqlite'))
+
+
+def test_asset_ids_of_any_type_are_one_key(store):
+    store.mark_done([123.0])
+    assert store.status(123) == 'done'
+    assert store.status('123') == 'done'
+    # As read back with dtype str from a CSV written from a float column
+    assert store.status('123.0') == 'done'
+    assert store.status('1.5') is None
+
+
+def test_done_view_commits_only_written_results(store):
+    done = DoneView(store)
+    done.add(1)
+    done.add(2)
+    assert 1 in done and 2 in done
+    assert store.status(1) is None
+
+    done.commit([{'asset_id': 1}])
+    assert store.status(1) == 'done'
+    assert store.status(2) is None
+    assert 2 in done
+    assert 2 not in DoneView(store), 'an uncommitted result is not remembered by the next run'
+
+
+def test_failed_view_commits_only_written_errors(store):
+    failed = FailedView(store)
+    failed.add(1)
+    failed.add(2)
+    assert 1 in failed and 2 in failed
+    assert store.status(1) is None
+
+    failed.commit([{'asset_id': 1, 'error_type': 'Error downloading image'}])
+    assert store.get(1)['status'] == 'failed'
+    assert store.get(1)['reason'] == 'Error downloading image'
+    assert store.status(2) is None
+    assert 2 not in FailedView(store)
+
+
+def test_failed_view_counts_attempts_of_retried_assets(store):
+    store.mark_retry(1, 'Timeout')
+    failed = FailedView(store)
+    assert 1 in failed, 'the rest of the row is skipped until the retry'
+    store.begin_retry([1])
+    assert 1 not in failed
+
+    failed.add(1)
+    failed.commit([{'asset_id': 1, 'error_type': 'Timeout'}])
+    assert store.get(1)['status'] == 'failed'
+    assert store.get(1)['attempts'] == 2
+
+
+def test_done_view_ignores_failed_assets(store):
+    FailedView(store).commit([{'asset_id': 1, 'error_type': 'Error'}])
+    done = DoneView(store)
+    done.add(1)
+    done.commit([])
+    assert store.status(1) == 'failed'
+
+
+def test_error_writer_commits_after_flush(tmp_path, store):
+    path = str(tmp_path / 'error_log.csv')
+    failed = FailedView(store)
+    with ResultWriter(path, batch_size=100, flush_interval=60, on_flush=[failed.commit]) as writer:
+        failed.add(1)
+        writer.write({'asset_id': 1, 'error_type': 'Error downloading image'})
+        assert store.status(1) is None
+    assert store.status(1) == 'failed'
+
+
+def test_import_output_seeds_a_new_store(tmp_path, store):
+    results = tmp_path / 'results.csv'
+    results.write_text('asset_id,ssim_score\n1,0.5\n2.0,0.7\n')
+    errors = tmp_path / 'error_log.csv'
+    errors.write_text('asset_id,error_type\n3,Error downloading image\n')
+    assert store.import_output(str(results), 'done') == 2
+    assert store.import_output(str(errors), 'failed') == 1
+    assert store.counts() == {'done': 2, 'failed': 1}
+    assert store.get(3)['reason'] == 'Error downloading image'
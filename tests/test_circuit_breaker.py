@@ -0,0 +1,79 @@
+"""Per-host circuit breakers.
+
+    python -m pytest tests/test_circuit_breaker.py
+"""
+import time
+import pytest
+import requests
+from requests.exceptions import ConnectionError, HTTPError
+from circuit_breaker import BreakerRegistry, CircuitOpenError, is_transient
+
+URL = 'http://ipfs:8080/ipfs/Qm'
+
+
+def http_error(status):
+    response = requests.models.Response()
+    response.status_code = status
+    return HTTPError(f"{status} Error", response=response)
+
+
+def fail(breakers, error, url=URL):
+    with pytest.raises(type(error)):
+        with breakers.attempt(url):
+            raise error
+
+
+def test_is_transient():
+    assert is_transient(ConnectionError())
+    assert is_transient(http_error(503))
+    assert is_transient(http_error(429))
+    assert not is_transient(http_error(404))
+    assert not is_transient(ValueError('not an image'))
+
+
+def test_opens_after_consecutive_transient_failures():
+    breakers = BreakerRegistry(failure_threshold=3, base_open_seconds=60)
+    for _ in range(3):
+        fail(breakers, ConnectionError())
+    with pytest.raises(CircuitOpenError):
+        with breakers.attempt(URL):
+            pass
+    assert breakers.open_count() == 1
+    with breakers.attempt('http://other-host/x'):
+        pass
+
+
+def test_permanent_errors_and_successes_reset_the_count():
+    breakers = BreakerRegistry(failure_threshold=3, base_open_seconds=60)
+    for error in (ConnectionError(), ConnectionError(), http_error(404), ConnectionError(), ConnectionError()):
+        fail(breakers, error)
+    with breakers.attempt(URL):
+        pass
+    assert breakers.breaker(URL).state == 'closed'
+
+
+def test_probe_closes_or_reopens_the_circuit():
+    breakers = BreakerRegistry(failure_threshold=2, base_open_seconds=0.05)
+    fail(breakers, ConnectionError())
+    fail(breakers, ConnectionError())
+    breaker = breakers.breaker(URL)
+    assert breaker.state == 'open'
+
+    time.sleep(0.06)
+    assert breaker.state == 'half_open'
+    fail(breakers, http_error(503))
+    assert breaker.state == 'open'
+    assert breaker.retry_in() > 0.05, 'a failed probe doubles the cooldown'
+
+    time.sleep(0.11)
+    with breakers.attempt(URL):
+        pass
+    assert breaker.state == 'closed'
+
+
+def test_threshold_zero_disables_breakers():
+    breakers = BreakerRegistry(failure_threshold=0)
+    for _ in range(10):
+        fail(breakers, ConnectionError())
+    with breakers.attempt(URL):
+        pass
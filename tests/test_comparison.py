@@ -0,0 +1,70 @@
+"""The batched comparison engine against the per-pair metrics.
+
+    python -m pytest tests/test_comparison.py
+"""
+import numpy as np
+import pytest
+from PIL import Image
+from comparison import CASCADE_PHASH_BAND, compare_image_batch, compute_similarity, cascade_similarity, to_grey_array
+
+SIZE = 160
+
+
+def make_pairs(seed=0):
+    # Pairs ranging from identical over slightly and heavily changed to unrelated images
+    rng = np.random.default_rng(seed)
+    gradient = np.add.outer(np.arange(SIZE), np.arange(SIZE)) * 255.0 / (2 * SIZE)
+    pairs = []
+    for noise in (0, 2, 20, 80):
+        base = np.clip(gradient[..., None] + rng.normal(0, 30, (SIZE, SIZE, 3)), 0, 255)
+        other = np.clip(base + rng.normal(0, noise, base.shape), 0, 255)
+        pairs.append((base, other))
+    pairs.append((rng.uniform(0, 255, (SIZE, SIZE, 3)), rng.uniform(0, 255, (SIZE, SIZE, 3))))
+    # Black against white: the difference overflowed uint8 arithmetic before
+    pairs.append((np.zeros((SIZE, SIZE, 3)), np.full((SIZE, SIZE, 3), 255.0)))
+    return [(Image.fromarray(a.astype(np.uint8)), Image.fromarray(b.astype(np.uint8))) for a, b in pairs]
+
+
+def batch_scores(pairs, phash_band=None):
+    return compare_image_batch(np.stack([to_grey_array(a) for a, _ in pairs]),
+                               np.stack([to_grey_array(b) for _, b in pairs]), phash_band)
+
+
+def test_batch_matches_compute_similarity():
+    pairs = make_pairs()
+    scores = batch_scores(pairs)
+    for i, (opensea_image, original_image) in enumerate(pairs):
+        expected = compute_similarity(opensea_image, original_image)
+        assert scores['ssim_score'][i] == pytest.approx(expected['ssim_score'], abs=1e-6)
+        assert scores['mse_score'][i] == pytest.approx(expected['mse_score'], rel=1e-9)
+        assert scores['opensea_phash'][i] == expected['opensea_phash']
+        assert scores['original_phash'][i] == expected['original_phash']
+        assert scores['phash_difference'][i] == expected['phash_difference']
+        assert scores['comparison_tier'][i] == 'full'
+
+
+def test_mse_does_not_wrap_around():
+    opensea_image, original_image = make_pairs()[-1]
+    assert compute_similarity(opensea_image, original_image)['mse_score'] == 255.0 ** 2
+    assert batch_scores([(opensea_image, original_image)])['mse_score'][0] == 255.0 ** 2
+
+
+def test_batch_cascade_matches_cascade_similarity():
+    pairs = make_pairs(seed=1)
+    scores = batch_scores(pairs, CASCADE_PHASH_BAND)
+    tiers = set()
+    for i, (opensea_image, original_image) in enumerate(pairs):
+        expected = cascade_similarity(opensea_image, original_image, phash_band=CASCADE_PHASH_BAND)
+        tiers.add(expected['comparison_tier'])
+        assert scores['comparison_tier'][i] == expected['comparison_tier']
+        assert scores['phash_difference'][i] == expected['phash_difference']
+        if expected['comparison_tier'] == 'phash':
+            assert np.isnan(scores['ssim_score'][i]) and np.isnan(scores['mse_score'][i])
+        else:
+            assert scores['ssim_score'][i] == pytest.approx(expected['ssim_score'], abs=1e-6)
+    assert tiers == {'phash', 'full'}
+
+
+def test_batch_rejects_different_sizes():
+    with pytest.raises(ValueError):
+        compare_image_batch(np.zeros((1, 8, 8), np.float32), np.zeros((1, 8, 9), np.float32))
@@ -0,0 +1,33 @@
+"""The worker-side scoring of image pairs.
+
+    python -m pytest tests/test_cpu_worker.py
+"""
+import base64
+from io import BytesIO
+from PIL import Image
+from comparison import CASCADE_PHASH_BAND
+from cpu_worker import score_pairs, share_payload, inline_payload
+
+
+def png_bytes(color='red'):
+    buffer = BytesIO()
+    Image.new('RGB', (40, 40), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def test_identical_pair_keeps_original_extension():
+    content = png_bytes()
+    data_url = 'data:image/gif;base64,' + base64.b64encode(content).decode()
+    items = [
+        (1, share_payload(content, 'image/png')[0], share_payload(content, 'image/webp')[0], True),
+        (2, share_payload(content, 'image/png')[0], inline_payload(data_url)[0], True),
+    ]
+    results = score_pairs(items, phash_band=CASCADE_PHASH_BAND)
+    assert [r['comparison_tier'] for r in results] == ['identical', 'identical']
+    assert [(r['opensea_extension'], r['original_extension']) for r in results] == [('png', 'webp'), ('png', 'gif')]
+
+
+def test_compared_pair_keeps_both_extensions():
+    items = [(1, share_payload(png_bytes(), 'image/png')[0], share_payload(png_bytes('blue'), 'image/jpeg')[0], False)]
+    result, = score_pairs(items, phash_band=CASCADE_PHASH_BAND)
+    assert (result['opensea_extension'], result['original_extension']) == ('png', 'jpeg')
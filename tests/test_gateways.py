@@ -0,0 +1,52 @@
+"""Gateway health and failover of GatewayPool.
+
+    python -m pytest tests/test_gateways.py
+"""
+import pytest
+import requests
+from requests.exceptions import ConnectionError, HTTPError
+from gateways import GatewayPool, MAX_CONSECUTIVE_FAILURES
+from utils import GATEWAY_ERRORS
+
+GATEWAYS = ['http://a', 'http://b']
+
+
+def http_error(status):
+    response = requests.models.Response()
+    response.status_code = status
+    return HTTPError(f"{status} Error", response=response)
+
+
+def failing_fetch(error):
+    def fetch(url):
+        raise error
+    return fetch
+
+
+def test_missing_cid_does_not_mark_gateways_unhealthy():
+    pool = GatewayPool(GATEWAYS, max_hedges=0, workers=1)
+    for i in range(MAX_CONSECUTIVE_FAILURES + 1):
+        with pytest.raises(HTTPError):
+            pool.fetch_sync(f"Qm{i}", failing_fetch(http_error(404)), GATEWAY_ERRORS)
+    assert all(gateway['healthy'] and gateway['failures'] == 0 for gateway in pool.snapshot())
+    assert pool.fetch_sync('Qm', lambda url: url, GATEWAY_ERRORS) == 'http://a/ipfs/Qm'
+
+
+@pytest.mark.parametrize('error', [ConnectionError('refused'), http_error(503), http_error(429)])
+def test_transient_failures_mark_gateways_unhealthy(error):
+    pool = GatewayPool(GATEWAYS, max_hedges=0, workers=1)
+    for i in range(MAX_CONSECUTIVE_FAILURES):
+        with pytest.raises(type(error)):
+            pool.fetch_sync(f"Qm{i}", failing_fetch(error), GATEWAY_ERRORS)
+    assert not any(gateway['healthy'] for gateway in pool.snapshot())
+
+
+def test_not_found_tries_next_gateway():
+    pool = GatewayPool(GATEWAYS, max_hedges=0, workers=1)
+
+    def fetch(url):
+        if url.startswith('http://a'):
+            raise http_error(404)
+        return url
+
+    assert pool.fetch_sync('Qm', fetch, GATEWAY_ERRORS) == 'http://b/ipfs/Qm'
@@ -0,0 +1,107 @@
+"""PhashIndex radius queries and clusters against a brute-force scan.
+
+    python -m pytest tests/test_phash_index.py
+"""
+import random
+import pytest
+from phash_index import HASH_BITS, PhashIndex
+
+RADII = [0, 5, 15, 16, 20, 33, 40]
+
+
+def random_hash(rng):
+    return rng.getrandbits(HASH_BITS)
+
+
+def near(rng, value, distance):
+    for position in rng.sample(range(HASH_BITS), distance):
+        value ^= 1 << position
+    return value
+
+
+def to_hex(value):
+    return f"{value:064x}"
+
+
+def distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+@pytest.fixture(scope='module')
+def images():
+    # (asset_id, role, hash): groups of near-duplicates at distances up to 45, spread over
+    # every chunk, shared hashes and unrelated images
+    rng = random.Random(7)
+    images = []
+    for group in range(12):
+        base = random_hash(rng)
+        for member in range(8):
+            value = near(rng, base, rng.choice([0, 1, 3, 8, 15, 16, 17, 24, 31, 32, 45]))
+            images.append((f"{group}-{member}", rng.choice(['opensea', 'original']), value))
+    images += [(f"unrelated-{i}", 'original', random_hash(rng)) for i in range(60)]
+    return images
+
+
+@pytest.fixture(scope='module')
+def index(images, tmp_path_factory):
+    index = PhashIndex(str(tmp_path_factory.mktemp('phash') / 'index.sqlite'))
+    index.add_records([{'asset_id': asset_id, f"{role}_phash": to_hex(value), 'collection_slug': asset_id.split('-')[0]}
+                       for asset_id, role, value in images])
+    return index
+
+
+@pytest.mark.parametrize('max_distance', RADII)
+def test_query_matches_brute_force(images, index, max_distance):
+    rng = random.Random(max_distance)
+    for _, _, value in rng.sample(images, 10):
+        query = near(rng, value, rng.randrange(0, 6))
+        expected = sorted((distance(query, other), asset_id, role) for asset_id, role, other in images
+                          if distance(query, other) <= max_distance)
+        matches = index.query(to_hex(query), max_distance)
+        assert [(match['distance'], match['asset_id'], match['role']) for match in matches] == expected
+
+
+def test_query_by_role(images, index):
+    _, _, value = images[0]
+    matches = index.query(to_hex(value), 40, role='opensea')
+    expected = {asset_id for asset_id, role, other in images if role == 'opensea' and distance(value, other) <= 40}
+    assert {match['asset_id'] for match in matches} == expected
+
+
+def brute_force_clusters(images, max_distance):
+    parent = list(range(len(images)))
+
+    def find(i):
+        while parent[i] != i:
+            i = parent[i]
+        return i
+
+    for i, (_, _, a) in enumerate(images):
+        for j in range(i + 1, len(images)):
+            if distance(a, images[j][2]) <= max_distance:
+                parent[find(j)] = find(i)
+    groups = {}
+    for i, (asset_id, _, _) in enumerate(images):
+        groups.setdefault(find(i), set()).add(asset_id)
+    return sorted(sorted(group) for group in groups.values() if len(group) > 1)
+
+
+@pytest.mark.parametrize('max_distance', [0, 16, 33])
+def test_clusters_match_brute_force(images, index, max_distance):
+    clusters = index.clusters(max_distance, role=None)
+    actual = sorted(sorted({member['asset_id'] for member in cluster}) for cluster in clusters)
+    assert actual == brute_force_clusters(images, max_distance)
+
+
+def test_cross_collection_clusters(tmp_path):
+    index = PhashIndex(str(tmp_path / 'index.sqlite'))
+    rng = random.Random(1)
+    a, b = random_hash(rng), random_hash(rng)
+    index.add_records([
+        {'asset_id': 1, 'original_phash': to_hex(a), 'collection_slug': 'punks'},
+        {'asset_id': 2, 'original_phash': to_hex(near(rng, a, 3)), 'collection_slug': 'punks'},
+        {'asset_id': 3, 'original_phash': to_hex(b), 'collection_slug': 'punks'},
+        {'asset_id': 4, 'original_phash': to_hex(near(rng, b, 3)), 'collection_slug': 'copies'},
+    ])
+    clusters = list(index.clusters(5, cross_collection=True))
+    assert [sorted(member['asset_id'] for member in cluster) for cluster in clusters] == [['3', '4']]
@@ -0,0 +1,40 @@
+"""The adaptive per-host rate limiter.
+
+    python -m pytest tests/test_rate_limiter.py
+"""
+import os
+from rate_limiter import HostBucket, RateLimiter, parse_retry_after
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_data_collection_copy_is_identical():
+    paths = [os.path.join(ROOT, directory, 'rate_limiter.py') for directory in ('NFT_Image_Comparison', 'Data_Collection')]
+    contents = [open(path, 'rb').read() for path in paths]
+    assert contents[0] == contents[1], 'Data_Collection/rate_limiter.py differs from NFT_Image_Comparison/rate_limiter.py'
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('12') == 12.0
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
+    assert parse_retry_after('soon') is None
+    assert parse_retry_after(None) is None
+
+
+def test_throttle_halves_rate_and_success_raises_it():
+    bucket = HostBucket(4.0, 8.0, increase_step=1.0)
+    bucket.on_throttle(retry_after=0)
+    assert bucket.rate == 2.0
+    bucket.on_success()
+    assert bucket.rate == 3.0
+    for _ in range(10):
+        bucket.on_success()
+    assert bucket.rate == 8.0
+
+
+def test_feedback_reports_throttle_responses():
+    limiter = RateLimiter({'api.example': (100.0, 100.0)})
+    assert limiter.feedback('https://api.example/x', 429, {'Retry-After': '0'}) is True
+    assert limiter.bucket('https://api.example/y').rate == 50.0
+    assert limiter.feedback('https://api.example/x', 200) is False
+    assert limiter.feedback('https://api.example/x', 404) is False
@@ -0,0 +1,67 @@
+"""ResultWriter batching, schema changes and write failures.
+
+    python -m pytest tests/test_result_writer.py
+"""
+import pandas as pd
+import pytest
+from result_writer import ResultWriter, read_parquet_output
+
+
+def read_output(path, file_format):
+    return pd.read_csv(path) if file_format == 'csv' else read_parquet_output(path)
+
+
+class FailingWrites:
+    """Makes the first `failures` writes of a ResultWriter raise. A CSV write fails after writing
+    half the batch; a Parquet batch is a single row group, which is only listed once complete."""
+
+    def __init__(self, writer, failures):
+        self.failures = failures
+        method = '_write_csv' if writer.file_format == 'csv' else '_write_parquet'
+        self.write = getattr(writer, method)
+        self.partial = writer.file_format == 'csv'
+        setattr(writer, method, self)
+
+    def __call__(self, batch):
+        if self.failures:
+            self.failures -= 1
+            if self.partial:
+                self.write(batch[:len(batch) // 2])
+            raise OSError('disk full')
+        self.write(batch)
+
+
+@pytest.mark.parametrize('file_format', ['csv', 'parquet'])
+def test_new_columns_and_types_are_kept(tmp_path, file_format):
+    path = str(tmp_path / 'results.csv')
+    with ResultWriter(path, file_format, batch_size=2) as writer:
+        for record in [{'asset_id': 1, 'score': 1}, {'asset_id': 2, 'score': 2},
+                       {'asset_id': 3, 'score': 0.5, 'collection_slug': 'a'}, {'asset_id': 4, 'score': 1}]:
+            writer.write(record)
+    df = read_output(path, file_format).sort_values('asset_id')
+    assert df['score'].tolist() == [1, 2, 0.5, 1]
+    assert df['collection_slug'].tolist()[2] == 'a'
+
+
+@pytest.mark.parametrize('file_format', ['csv', 'parquet'])
+def test_failed_batch_is_retried_without_duplicates(tmp_path, file_format):
+    path = str(tmp_path / 'results.csv')
+    flushed = []
+    writer = ResultWriter(path, file_format, batch_size=4, flush_interval=0.05, on_flush=[flushed.extend])
+    FailingWrites(writer, failures=2)
+    with writer:
+        for i in range(10):
+            writer.write({'asset_id': i, 'score': i / 10})
+    assert sorted(read_output(path, file_format)['asset_id']) == list(range(10))
+    assert sorted(record['asset_id'] for record in flushed) == list(range(10))
+
+
+def test_close_raises_when_records_stay_unwritten(tmp_path):
+    path = str(tmp_path / 'results.csv')
+    flushed = []
+    writer = ResultWriter(path, batch_size=4, flush_interval=0.01, on_flush=[flushed.extend]).start()
+    FailingWrites(writer, failures=1000)
+    writer.write({'asset_id': 1})
+    with pytest.raises(OSError):
+        writer.close()
+    assert flushed == []
@@ -0,0 +1,49 @@
+"""Deferring transient failures to retry passes.
+
+    python -m pytest tests/test_retry_queue.py
+"""
+import pytest
+import requests
+from requests.exceptions import Timeout, HTTPError
+from checkpoint_store import CheckpointStore
+from retry_queue import RetryQueue
+
+
+@pytest.fixture
+def store(tmp_path):
+    return CheckpointStore(str(tmp_path / 'checkpoint.sqlite'))
+
+
+def not_found():
+    response = requests.models.Response()
+    response.status_code = 404
+    return HTTPError('404 Error', response=response)
+
+
+def test_transient_failures_are_deferred_until_the_last_attempt(store):
+    queue = RetryQueue(store, max_attempts=3, base_retry_seconds=0)
+    assert queue.defer(1, 'Error downloading image', Timeout())
+    assert queue.is_deferred(1)
+    assert queue.all_due_in() == 0.0
+    assert queue.take_due() == {'1'}
+    assert store.status(1) == 'retrying'
+
+    assert queue.defer(1, 'Error downloading image', Timeout())
+    assert queue.take_due() == {'1'}
+    assert not queue.defer(1, 'Error downloading image', Timeout()), 'the third attempt is the last'
+    assert queue.all_due_in() is None
+
+
+def test_permanent_failures_are_not_deferred(store):
+    queue = RetryQueue(store, max_attempts=3, base_retry_seconds=0)
+    assert not queue.defer(1, 'Error downloading image', not_found())
+    store.mark_done([2])
+    assert not queue.defer(2, 'Error downloading image', Timeout())
+
+
+def test_retries_wait_for_the_backoff(store):
+    queue = RetryQueue(store, max_attempts=5, base_retry_seconds=60)
+    queue.defer(1, 'Error downloading image', Timeout())
+    assert 59 < queue.all_due_in() <= 60
+    assert queue.take_due() == set()
+    assert queue.delay(3) == 240
@@ -0,0 +1,44 @@
+"""Splitting the input into shards and merging the shards' outputs.
+
+    python -m pytest tests/test_sharding.py
+"""
+import pandas as pd
+import pytest
+from merge_shards import merge_shards
+from sharding import select_shard, shard_of, shard_path, validate_shard
+
+
+def test_shards_partition_the_input():
+    df = pd.DataFrame({'asset_id': list(range(1000)) + [5.0, '7']})
+    shards = [select_shard(df, index, 4) for index in range(4)]
+    assert sum(len(shard) for shard in shards) == len(df)
+    assert all(len(shard) > 150 for shard in shards)
+    assert shard_of(5, 4) == shard_of(5.0, 4) == shard_of('5', 4)
+    assert select_shard(df, 0, 1) is df
+
+
+def test_shard_path():
+    assert shard_path('/data/results.csv', 2, 8) == '/data/results.shard-2-of-8.csv'
+    assert shard_path('/data/results.csv', 0, 1) == '/data/results.csv'
+    with pytest.raises(ValueError):
+        validate_shard(4, 4)
+
+
+def test_merge_keeps_last_result_and_drops_resolved_errors(tmp_path):
+    results = str(tmp_path / 'results.csv')
+    errors = str(tmp_path / 'error_log.csv')
+    # An unsharded run before the sharded one
+    pd.DataFrame({'asset_id': [1, 2], 'ssim_score': [0.1, 0.2]}).to_csv(results, index=False)
+    pd.DataFrame({'asset_id': [3], 'error_type': ['Error downloading image']}).to_csv(errors, index=False)
+    pd.DataFrame({'asset_id': [2.0, 3], 'ssim_score': [0.9, 0.3]}).to_csv(shard_path(results, 0, 2), index=False)
+    pd.DataFrame({'asset_id': [4], 'ssim_score': [0.4]}).to_csv(shard_path(results, 1, 2), index=False)
+    pd.DataFrame({'asset_id': [5], 'error_type': ['Error comparing images']}).to_csv(shard_path(errors, 1, 2), index=False)
+
+    out_dir = tmp_path / 'merged'
+    out_dir.mkdir()
+    results_path, errors_path = merge_shards(results, errors, 2, out_dir=str(out_dir))
+
+    merged = pd.read_csv(results_path).sort_values('asset_id')
+    assert merged['asset_id'].tolist() == [1, 2, 3, 4]
+    assert merged['ssim_score'].tolist() == [0.1, 0.9, 0.3, 0.4]
+    assert pd.read_csv(errors_path)['asset_id'].tolist() == [5]
@@ -0,0 +1,75 @@
+"""SVG rasterization straight from the cairo buffer (svg_render) against the PNG output of
+cairosvg.svg2png that utils.svg_to_png used before.
+
+    python -m pytest tests/test_svg_render.py
+
+The comparisons with cairosvg need the cairo library and are skipped without it.
+"""
+from io import BytesIO
+import numpy as np
+import pytest
+from PIL import Image
+from svg_render import CAIRO_RAW_MODE, RasterSurface, render_svg
+
+try:
+    import cairocffi  # noqa: F401 (loads libcairo)
+    import cairosvg
+    from cairosvg.parser import Tree
+    HAVE_CAIRO = True
+except (ImportError, OSError):
+    HAVE_CAIRO = False
+
+requires_cairo = pytest.mark.skipif(not HAVE_CAIRO, reason='cairo library not available')
+
+TARGET_SIZE = (500, 500)
+
+# (svg, width, height): opaque colours, partial transparency, antialiased edges on a
+# transparent background, an alpha gradient and a non-square canvas
+SVGS = [
+    ('<svg xmlns="http://www.w3.org/2000/svg" width="24" height="24">'
+     '<rect width="12" height="24" fill="#ff0000"/><rect x="12" width="12" height="24" fill="#0000ff"/></svg>', 24, 24),
+    ('<svg xmlns="http://www.w3.org/2000/svg" width="32" height="32">'
+     '<rect width="32" height="32" fill="#20c040" fill-opacity="0.5"/></svg>', 32, 32),
+    ('<svg xmlns="http://www.w3.org/2000/svg" width="40" height="40">'
+     '<circle cx="20" cy="20" r="13.3" fill="#f0a000"/></svg>', 40, 40),
+    ('<svg xmlns="http://www.w3.org/2000/svg" width="64" height="64"><defs><linearGradient id="g">'
+     '<stop offset="0" stop-color="#ff00ff" stop-opacity="0"/><stop offset="1" stop-color="#00ffff"/>'
+     '</linearGradient></defs><rect width="64" height="64" fill="url(#g)"/></svg>', 64, 64),
+    ('<svg xmlns="http://www.w3.org/2000/svg" width="30" height="10">'
+     '<rect width="30" height="10" fill="#123456"/><rect x="10" width="10" height="10" fill="#fedcba"/></svg>', 30, 10),
+]
+
+
+def test_raw_mode_reads_premultiplied_bgra():
+    # Cairo's ARGB32 pixels as stored on a little-endian host: premultiplied B, G, R, A bytes
+    pixels = [(0, 0, 255, 255), (255, 0, 0, 255), (0, 0, 128, 128), (0, 64, 0, 64), (0, 0, 0, 0)]
+    image = Image.frombuffer('RGBA', (len(pixels), 1), bytes(b for pixel in pixels for b in pixel),
+                             'raw', CAIRO_RAW_MODE, 0, 1)
+    expected = [(255, 0, 0, 255), (0, 0, 255, 255), (255, 0, 0, 128), (0, 255, 0, 64), (0, 0, 0, 0)]
+    assert [tuple(image.getpixel((x, 0))) for x in range(len(pixels))] == expected
+
+
+@requires_cairo
+@pytest.mark.parametrize('svg, width, height', SVGS)
+def test_raw_surface_matches_png_output(svg, width, height):
+    svg = svg.encode('utf-8')
+    image = RasterSurface(Tree(bytestring=svg), TARGET_SIZE).to_image()
+    scale = max(TARGET_SIZE[0] / width, TARGET_SIZE[1] / height)
+    png = Image.open(BytesIO(cairosvg.svg2png(bytestring=svg, scale=scale))).convert('RGBA')
+    assert image.size == png.size
+
+    raw, expected = np.asarray(image, dtype=np.int16), np.asarray(png, dtype=np.int16)
+    assert np.array_equal(raw[..., 3], expected[..., 3])
+    # Colours are only defined where a pixel is not fully transparent; un-premultiplying may
+    # round differently in cairo's PNG writer and in PIL
+    visible = expected[..., 3] > 0
+    assert np.abs(raw[visible][:, :3] - expected[visible][:, :3]).max() <= 1
+
+
+@requires_cairo
+def test_render_covers_target_size():
+    svg, width, height = SVGS[-1]
+    image = render_svg(svg.encode('utf-8'), TARGET_SIZE)
+    assert image.mode == 'RGBA'
+    assert image.size[0] >= TARGET_SIZE[0] and image.size[1] >= TARGET_SIZE[1]
+    assert min(image.size) == min(TARGET_SIZE)